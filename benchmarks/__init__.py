@@ -0,0 +1,2 @@
+"""Benchmarks of webpub. Run them with ``python -m benchmarks run``,
+from the root of the repository."""
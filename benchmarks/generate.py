@@ -0,0 +1,315 @@
+"""Generators of synthetic inputs. The same arguments and seed always
+give the same input."""
+import os
+import random
+import zipfile as zf
+from xml.sax.saxutils import escape, quoteattr
+
+words = (
+    "the monk dwells contemplating body in and of itself ardent alert"
+    " mindful putting aside greed distress with reference to world"
+    " feelings mind mental qualities noble truth path stress origination"
+    " cessation practice leading release seclusion stillness"
+).split()
+
+# Sutta references, and the path of their page in the site trees that
+# are generated, if they are to be found at the fallback.
+sutta_refs = (
+    ("MN {}", range(1, 153), 'suttas/MN/MN{}.html'),
+    ("DN {}", range(1, 35), 'suttas/DN/DN{:0>2}.html'),
+    ("SN {}.{}", range(1, 57), 'suttas/SN/SN{}_{}.html'),
+    ("AN {}.{}", range(1, 12), None),
+    ("Dhp {}", range(1, 424), None),
+)
+sutta_texts = range(1, 4)
+
+# A 1x1 transparent PNG.
+png = bytes.fromhex(
+    "89504e470d0a1a0a0000000d49484452000000010000000108060000001f15c489"
+    "0000000d49444154789c6360000002000001e221bc330000000049454e44ae426082"
+)
+
+stylesheet = """body {{ font-family: serif; }}
+h1, h2 {{ background: url("{}") no-repeat; }}
+/* url(not-a-url.png) */
+a.sutta-ref {{ color: #630; }}
+"""
+
+
+def _sentence(rng, sutta_density):
+    sentence = [rng.choice(words) for _i in range(rng.randint(6, 18))]
+    if rng.random() < sutta_density:
+        fmt, numbers, _path = rng.choice(sutta_refs)
+        sentence.insert(
+            rng.randrange(len(sentence)),
+            fmt.format(rng.choice(numbers), rng.choice(sutta_texts))
+        )
+    sentence = ' '.join(sentence)
+    # Only the first letter, the references are case sensitive.
+    return sentence[:1].upper() + sentence[1:] + '.'
+
+
+def _paragraph(rng, sutta_density, links=()):
+    sentences = [
+        escape(_sentence(rng, sutta_density))
+        for _i in range(rng.randint(2, 6))
+    ]
+    for href, text in links:
+        sentences.insert(
+            rng.randrange(len(sentences) + 1),
+            '<a href={}>{}</a>'.format(quoteattr(href), escape(text))
+        )
+    return '<p>{}</p>'.format(' '.join(sentences))
+
+
+def sutta_paths():
+    """The paths of the sutta pages in the generated site trees."""
+    for _fmt, numbers, path in sutta_refs:
+        if path is None:
+            continue
+        for n in numbers:
+            for text in sutta_texts:
+                yield path.format(n, text)
+
+
+# EPUBs
+
+container_xml = """<?xml version="1.0"?>
+<container version="1.0"
+    xmlns="urn:oasis:names:tc:opendocument:xmlns:container">
+  <rootfiles>
+    <rootfile full-path="OEBPS/content.opf"
+        media-type="application/oebps-package+xml"/>
+  </rootfiles>
+</container>
+"""
+
+chapter_xhtml = """<?xml version="1.0" encoding="utf-8"?>
+<!DOCTYPE html>
+<html xmlns="http://www.w3.org/1999/xhtml">
+<head><title>{title}</title>
+<link rel="stylesheet" type="text/css" href="../css/style.css"/></head>
+<body>
+{body}
+</body>
+</html>
+"""
+
+
+def _nav_points(rng, chapter, depth, sections, counter, prefix=''):
+    """Nested navPoints to the sections of a chapter, `depth` levels
+    deep."""
+    if depth == 0:
+        return ''
+    points = []
+    for i in range(1, sections + 1):
+        counter[0] += 1
+        label = '{}{}'.format(prefix, i)
+        points.append(
+            '<navPoint id="np{n}" playOrder="{n}">'
+            '<navLabel><text>Section {label}</text></navLabel>'
+            '<content src="text/chapter{chapter}.xhtml#s{label}"/>'
+            '{children}</navPoint>'.format(
+                n=counter[0], label=label, chapter=chapter,
+                children=_nav_points(
+                    rng, chapter, depth - 1, sections, counter, label + '-'
+                ),
+            )
+        )
+    return ''.join(points)
+
+
+def _section_ids(depth, sections, prefix=''):
+    if depth == 0:
+        return
+    for i in range(1, sections + 1):
+        label = '{}{}'.format(prefix, i)
+        yield label
+        yield from _section_ids(depth - 1, sections, label + '-')
+
+
+def make_epub(filename, chapters=20, ncx_depth=2, images=10,
+              paragraphs=30, sutta_density=0.2, seed=0):
+    """Writes an EPUB with `chapters` chapters of `paragraphs`
+    paragraphs, a table of contents that is `ncx_depth` levels deep and
+    `images` images. `sutta_density` is the chance that a sentence
+    contains a sutta reference."""
+    rng = random.Random(seed)
+    sections = 3
+    with zf.ZipFile(filename, 'w', zf.ZIP_DEFLATED) as epub:
+        epub.writestr('mimetype', 'application/epub+zip', zf.ZIP_STORED)
+        epub.writestr('META-INF/container.xml', container_xml)
+
+        image_names = ['image{}.png'.format(i) for i in range(images)]
+        for name in image_names:
+            epub.writestr('OEBPS/images/' + name, png)
+        epub.writestr(
+            'OEBPS/css/style.css',
+            stylesheet.format('../images/' + image_names[0]
+                              if image_names else 'none.png')
+        )
+
+        for chapter in range(1, chapters + 1):
+            body = ['<h1>Chapter {}</h1>'.format(chapter)]
+            # The sections are spread evenly over the paragraphs.
+            ids = list(_section_ids(ncx_depth - 1, sections))
+            step = max(1, paragraphs // max(1, len(ids)))
+            for i in range(paragraphs):
+                if i % step == 0 and i // step < len(ids):
+                    body.append('<h2 id="s{0}">Section {0}</h2>'.format(
+                        ids[i // step]
+                    ))
+                links = []
+                if rng.random() < 0.3:
+                    other = rng.randint(1, chapters)
+                    links.append((
+                        'chapter{}.xhtml'.format(other),
+                        'chapter {}'.format(other)
+                    ))
+                body.append(_paragraph(rng, sutta_density, links))
+                if image_names and rng.random() < 0.1:
+                    body.append('<img src="../images/{}" alt=""/>'.format(
+                        rng.choice(image_names)
+                    ))
+            epub.writestr(
+                'OEBPS/text/chapter{}.xhtml'.format(chapter),
+                chapter_xhtml.format(
+                    title='Chapter {}'.format(chapter),
+                    body='\n'.join(body)
+                )
+            )
+
+        counter = [0]
+        nav_points = []
+        for chapter in range(1, chapters + 1):
+            counter[0] += 1
+            nav_points.append(
+                '<navPoint id="np{n}" playOrder="{n}">'
+                '<navLabel><text>Chapter {chapter}</text></navLabel>'
+                '<content src="text/chapter{chapter}.xhtml"/>'
+                '{children}</navPoint>'.format(
+                    n=counter[0], chapter=chapter,
+                    children=_nav_points(
+                        rng, chapter, ncx_depth - 1, sections, counter
+                    ),
+                )
+            )
+        epub.writestr('OEBPS/toc.ncx', (
+            '<?xml version="1.0" encoding="utf-8"?>\n'
+            '<ncx xmlns="http://www.daisy.org/z3986/2005/ncx/"'
+            ' version="2005-1"><head/>'
+            '<docTitle><text>Synthetic book</text></docTitle>'
+            '<navMap>{}</navMap></ncx>\n'
+        ).format(''.join(nav_points)))
+
+        manifest = [
+            '<item id="ncx" href="toc.ncx"'
+            ' media-type="application/x-dtbncx+xml"/>',
+            '<item id="css" href="css/style.css" media-type="text/css"/>',
+        ]
+        manifest.extend(
+            '<item id="chapter{0}" href="text/chapter{0}.xhtml"'
+            ' media-type="application/xhtml+xml"/>'.format(chapter)
+            for chapter in range(1, chapters + 1)
+        )
+        manifest.extend(
+            '<item id="image{0}" href="images/image{0}.png"'
+            ' media-type="image/png"/>'.format(i)
+            for i in range(images)
+        )
+        spine = ''.join(
+            '<itemref idref="chapter{}"/>'.format(chapter)
+            for chapter in range(1, chapters + 1)
+        )
+        epub.writestr('OEBPS/content.opf', (
+            '<?xml version="1.0" encoding="utf-8"?>\n'
+            '<package xmlns="http://www.idpf.org/2007/opf" version="2.0"'
+            ' unique-identifier="id">'
+            '<metadata xmlns:dc="http://purl.org/dc/elements/1.1/"'
+            ' xmlns:opf="http://www.idpf.org/2007/opf">'
+            '<dc:title>Synthetic book</dc:title>'
+            '<dc:creator opf:role="aut">Benchmark</dc:creator>'
+            '<dc:identifier id="id">synthetic-{seed}</dc:identifier>'
+            '</metadata>'
+            '<manifest>{manifest}</manifest>'
+            '<spine toc="ncx">{spine}</spine>'
+            '</package>\n'
+        ).format(seed=seed, manifest=''.join(manifest), spine=spine))
+
+
+# Site trees
+
+page_html = """<!DOCTYPE html>
+<html>
+<head><title>{title}</title>
+<link rel="stylesheet" href="{css}"></head>
+<body>
+<h1>{title}</h1>
+{body}
+</body>
+</html>
+"""
+
+
+def make_site(root, pages=200, dirs=10, paragraphs=20, links_per_page=10,
+              broken_ratio=0.1, sutta_density=0.2, media=0, seed=0):
+    """Writes a site tree of `pages` HTML pages in `dirs` directories,
+    with `links_per_page` links each, of which `broken_ratio` point to
+    pages that don't exist. Pages that were moved to another directory
+    are linked to by their old path, which can be fixed. `media` media
+    files are added too, which are never processed. Pages for the sutta
+    references that exist are written in `suttas/`."""
+    rng = random.Random(seed)
+    dirnames = ['section{}'.format(i) for i in range(dirs)]
+    paths = [
+        '{}/page{}.html'.format(rng.choice(dirnames), i)
+        for i in range(pages)
+    ]
+    for path in sutta_paths():
+        os.makedirs(os.path.join(root, os.path.dirname(path)),
+                    exist_ok=True)
+        with open(os.path.join(root, path), 'w') as f:
+            f.write(page_html.format(title=path, css='/style.css', body=''))
+    with open(os.path.join(root, 'style.css'), 'w') as f:
+        f.write(stylesheet.format('/media/bg.png'))
+
+    os.makedirs(os.path.join(root, 'media'), exist_ok=True)
+    with open(os.path.join(root, 'media', 'bg.png'), 'wb') as f:
+        f.write(png)
+    for i in range(media):
+        with open(os.path.join(root, 'media', 'img{}.png'.format(i)),
+                  'wb') as f:
+            f.write(png + bytes(rng.randrange(256) for _i in range(1024)))
+
+    for i, path in enumerate(paths):
+        links = []
+        for _i in range(links_per_page):
+            target = rng.choice(paths)
+            if rng.random() < broken_ratio:
+                if rng.random() < 0.5:
+                    # Moved: the same name in another directory.
+                    target = '{}/{}'.format(
+                        rng.choice(dirnames), os.path.basename(target)
+                    )
+                else:
+                    target = 'gone/page{}.html'.format(rng.randrange(pages))
+            if rng.random() < 0.5:
+                href = '/' + target
+            else:
+                href = os.path.relpath(target, os.path.dirname(path))
+            links.append((href, 'page'))
+        body = []
+        per_paragraph = max(1, -(-len(links) // paragraphs))
+        for p in range(paragraphs):
+            body.append(_paragraph(
+                rng, sutta_density,
+                links[p * per_paragraph:(p + 1) * per_paragraph]
+            ))
+        os.makedirs(os.path.join(root, os.path.dirname(path)),
+                    exist_ok=True)
+        with open(os.path.join(root, path), 'w') as f:
+            f.write(page_html.format(
+                title='Page {}'.format(i),
+                css=os.path.relpath('style.css', os.path.dirname(path)),
+                body='\n'.join(body),
+            ))
@@ -0,0 +1,325 @@
+"""Runs the benchmarks and stores their results, to compare them across
+commits."""
+from collections import namedtuple
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import zipfile as zf
+
+import click
+import lxml.etree
+
+from benchmarks.generate import make_epub, make_site
+from benchmarks.server import FallbackServer
+
+repo_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+results_dir = os.path.join(repo_dir, 'benchmarks', 'results')
+
+sizes = {
+    'small': {
+        'epub': dict(chapters=10, ncx_depth=2, images=5, paragraphs=20),
+        'site': dict(pages=50, dirs=5, links_per_page=5),
+    },
+    'medium': {
+        'epub': dict(chapters=50, ncx_depth=3, images=50, paragraphs=50),
+        'site': dict(pages=500, dirs=20, links_per_page=10),
+    },
+    'large': {
+        'epub': dict(chapters=200, ncx_depth=3, images=500, paragraphs=100),
+        'site': dict(pages=5000, dirs=100, links_per_page=20, media=5000),
+    },
+}
+
+
+def prepare_webbook(workdir, size, options):
+    epub = os.path.join(workdir, 'book.epub')
+    make_epub(epub, sutta_density=options['sutta_density'],
+              seed=options['seed'], **size['epub'])
+    fallback_root = os.path.join(workdir, 'fallback')
+    make_site(fallback_root, pages=0, seed=options['seed'])
+    return fallback_root, ['-d', os.path.join(workdir, 'out'), '-f', epub]
+
+
+def prepare_site(workdir, size, options):
+    site = os.path.join(workdir, 'site')
+    make_site(site, broken_ratio=options['broken_ratio'],
+              sutta_density=options['sutta_density'], seed=options['seed'],
+              **size['site'])
+    args = ['-f', '--no-link-cache', site]
+    if options['jobs'] > 1:
+        args[:0] = ['--jobs', str(options['jobs'])]
+    return site, args
+
+
+Benchmark = namedtuple('Benchmark', ['prepare', 'command', 'args'])
+
+benchmarks = {
+    'webbook': Benchmark(prepare_webbook, 'main', []),
+    'linkfix': Benchmark(prepare_site, 'linkfix_cmd', ['--action', 'keep']),
+    'suttaref': Benchmark(
+        prepare_site, 'sutta_cross_ref_cmd', ['--action', 'cont']
+    ),
+    'fix': Benchmark(
+        prepare_site, 'fix_cmd',
+        ['--link-action', 'keep', '--sutta-action', 'cont']
+    ),
+}
+
+
+def run_once(benchmark, size, options):
+    """Runs the benchmark in a new process, on freshly generated input.
+    Returns the time it took, the number of requests and connections
+    made to the fallback server, and the profile of the run."""
+    with tempfile.TemporaryDirectory(prefix='webpub-bench-') as workdir:
+        fallback_root, args = benchmark.prepare(workdir, size, options)
+        profile_json = os.path.join(workdir, 'profile.json')
+        with FallbackServer(fallback_root, options['latency']) as server:
+            command = [
+                sys.executable, '-c',
+                'import webpub.cli; webpub.cli.{}()'.format(benchmark.command),
+                '-u', server.url, '--profile-json', profile_json,
+            ] + benchmark.args + args
+            start = time.perf_counter()
+            process = subprocess.run(
+                command, cwd=workdir, stdin=subprocess.DEVNULL,
+                stdout=subprocess.DEVNULL, stderr=subprocess.PIPE,
+                env=dict(os.environ, PYTHONPATH=repo_dir),
+            )
+            elapsed = time.perf_counter() - start
+            requests = server.requests
+            connections = server.connections
+        if process.returncode != 0:
+            raise RuntimeError(process.stderr.decode(errors='replace'))
+        with open(profile_json, encoding='utf-8') as f:
+            profile = json.load(f)
+    return elapsed, requests, connections, profile
+
+
+def run_benchmark(benchmark, size, options, repeat):
+    times = []
+    stages = {}
+    for _i in range(repeat):
+        elapsed, requests, connections, profile = run_once(
+            benchmark, size, options
+        )
+        times.append(elapsed)
+        for name, handler in profile['handlers'].items():
+            stages.setdefault(name, []).append(handler['wall']['total'])
+    return {
+        'times': times,
+        'median': statistics.median(times),
+        'min': min(times),
+        'files': profile['files'],
+        'bytes': profile['bytes'],
+        'requests': requests,
+        'connections': connections,
+        'stages': {
+            name: statistics.median(totals)
+            for name, totals in stages.items()
+        },
+    }
+
+
+def git_revision():
+    def git(*args):
+        return subprocess.run(
+            ('git',) + args, cwd=repo_dir, stdout=subprocess.PIPE,
+            stderr=subprocess.DEVNULL, universal_newlines=True,
+        ).stdout.strip()
+    revision = git('rev-parse', '--short', 'HEAD') or 'unknown'
+    if git('status', '--porcelain', '--untracked-files=no'):
+        revision += '-dirty'
+    return revision
+
+
+@click.group()
+def cli():
+    """Benchmarks of webpub on synthetic inputs."""
+
+
+@cli.command()
+@click.option('--size', type=click.Choice(list(sizes)), default='small',
+              help="The size of the generated inputs.")
+@click.option('--repeat', '-r', type=click.IntRange(min=1), default=3,
+              help="How often to run each benchmark.")
+@click.option('--latency', type=float, default=0.005,
+              help="Seconds the fallback server waits before responding.")
+@click.option('--jobs', '-j', type=click.IntRange(min=1), default=1,
+              help="Passed as --jobs to webpub-linkfix and webpub-suttaref.")
+@click.option('--sutta-density', type=float, default=0.2,
+              help="The chance that a sentence contains a sutta reference.")
+@click.option('--broken-ratio', type=float, default=0.1,
+              help="The ratio of links in site trees that are broken.")
+@click.option('--seed', type=int, default=0)
+@click.option('--output', '-o', type=click.Path(dir_okay=False),
+              default=None,
+              help="Where to store the results. Defaults to"
+              " benchmarks/results/<commit>-<size>.json.")
+@click.argument('names', nargs=-1, type=click.Choice(list(benchmarks)))
+def run(size, repeat, latency, jobs, sutta_density, broken_ratio, seed,
+        output, names):
+    """Runs the benchmarks NAMES, or all of them."""
+    options = {
+        'latency': latency,
+        'jobs': jobs,
+        'sutta_density': sutta_density,
+        'broken_ratio': broken_ratio,
+        'seed': seed,
+    }
+    revision = git_revision()
+    results = {
+        'revision': revision,
+        'date': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'size': size,
+        'repeat': repeat,
+        'options': options,
+        'benchmarks': {},
+    }
+    for name in names or list(benchmarks):
+        click.echo("{}: ".format(name), nl=False)
+        try:
+            result = run_benchmark(benchmarks[name], sizes[size], options,
+                                   repeat)
+        except RuntimeError as e:
+            # Show the last line of the traceback, i.e. the exception.
+            click.echo("failed: " + ''.join(str(e).strip().splitlines()[-1:]))
+            results['benchmarks'][name] = {'error': str(e)}
+            continue
+        click.echo("{:.3f}s (min {:.3f}s, {} files)".format(
+            result['median'], result['min'], result['files']
+        ))
+        results['benchmarks'][name] = result
+
+    if output is None:
+        os.makedirs(results_dir, exist_ok=True)
+        output = os.path.join(
+            results_dir, '{}-{}.json'.format(revision, size)
+        )
+    with open(output, 'w', encoding='utf-8') as f:
+        json.dump(results, f, indent=1, sort_keys=True)
+    click.echo("Results written to {}".format(output))
+
+
+document_extensions = ('.html', '.htm', '.xhtml')
+
+
+def read_documents(path):
+    """Yields the names and contents of the (X)HTML documents in an EPUB,
+    or in a directory."""
+    if os.path.isfile(path):
+        with zf.ZipFile(path) as epub:
+            for name in epub.namelist():
+                if name.endswith(document_extensions):
+                    yield name, epub.read(name)
+        return
+    for dirpath, _dirnames, filenames in os.walk(path):
+        for filename in filenames:
+            if filename.endswith(document_extensions):
+                with open(os.path.join(dirpath, filename), 'rb') as f:
+                    yield filename, f.read()
+
+
+def time_parser(parse, documents, repeat):
+    times = []
+    for _i in range(repeat):
+        start = time.perf_counter()
+        for _name, raw in documents:
+            parse(raw)
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+
+@cli.command()
+@click.option('--size', type=click.Choice(list(sizes)), default='small',
+              help="The size of the generated inputs.")
+@click.option('--repeat', '-r', type=click.IntRange(min=1), default=3,
+              help="How often to parse each document.")
+@click.argument('paths', nargs=-1, type=click.Path(exists=True))
+def parsers(size, repeat, paths):
+    """Compares the parsers of --parser on the documents in PATHS, which
+    are EPUBs or directories. Without PATHS, on a generated EPUB and
+    site tree."""
+    import webpub.parse
+    with tempfile.TemporaryDirectory(prefix='webpub-bench-') as workdir:
+        if not paths:
+            epub = os.path.join(workdir, 'book.epub')
+            make_epub(epub, **sizes[size]['epub'])
+            site = os.path.join(workdir, 'site')
+            make_site(site, **sizes[size]['site'])
+            paths = [epub, site]
+        documents = [
+            document for path in paths for document in read_documents(path)
+        ]
+    size_mb = sum(len(raw) for _name, raw in documents) / 1e6
+    xhtml = well_formed = 0
+    for _name, raw in documents:
+        xhtml += webpub.parse.is_xhtml(raw)
+        try:
+            webpub.parse.parse_xml(raw)
+            well_formed += 1
+        except lxml.etree.XMLSyntaxError:
+            pass
+    click.echo("{} documents ({:.1f} MB), {} declare XHTML, {} are"
+               " well-formed XML".format(
+                   len(documents), size_mb, xhtml, well_formed))
+    row = "{:<8} {:>10} {:>12} {:>10}"
+    click.echo(row.format('parser', 'time', 'documents/s', 'MB/s'))
+    for parser in webpub.parse.parsers:
+        elapsed = time_parser(
+            lambda raw: webpub.parse.parse_document(raw, parser),
+            documents, repeat
+        )
+        click.echo(row.format(
+            parser, '{:.3f}s'.format(elapsed),
+            '{:.0f}'.format(len(documents) / elapsed),
+            '{:.1f}'.format(size_mb / elapsed),
+        ))
+
+
+def _ratio(old, new):
+    if not old:
+        return ''
+    return '{:+.1%}'.format(new / old - 1)
+
+
+@cli.command()
+@click.argument('old', type=click.File('r'))
+@click.argument('new', type=click.File('r'))
+def compare(old, new):
+    """Compares the results in OLD with those in NEW."""
+    old, new = json.load(old), json.load(new)
+    click.echo("{} -> {}".format(old['revision'], new['revision']))
+    row = "{:<40} {:>10} {:>10} {:>8}"
+    for name, new_result in sorted(new['benchmarks'].items()):
+        old_result = old['benchmarks'].get(name)
+        click.echo('')
+        if old_result is None or 'error' in old_result \
+                or 'error' in new_result:
+            click.echo(row.format(name, '', '', 'n/a'))
+            continue
+        click.echo(row.format(
+            name, '{:.3f}s'.format(old_result['median']),
+            '{:.3f}s'.format(new_result['median']),
+            _ratio(old_result['median'], new_result['median'])
+        ))
+        for stage in sorted(set(old_result['stages'])
+                            | set(new_result['stages'])):
+            old_time = old_result['stages'].get(stage)
+            new_time = new_result['stages'].get(stage)
+            click.echo(row.format(
+                ' ' + stage[:38],
+                '' if old_time is None else '{:.3f}s'.format(old_time),
+                '' if new_time is None else '{:.3f}s'.format(new_time),
+                _ratio(old_time, new_time) if new_time is not None else ''
+            ))
+
+
+if __name__ == '__main__':
+    cli()
@@ -0,0 +1,81 @@
+"""A local stand-in for the server given as --fallback-url."""
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import unquote, urlsplit
+import os
+import threading
+import time
+
+
+class _Handler(BaseHTTPRequestHandler):
+    # Keep connections open, as a real server would.
+    protocol_version = 'HTTP/1.1'
+
+    def setup(self):
+        super().setup()
+        with self.server.lock:
+            self.server.connections += 1
+
+    def do_HEAD(self):
+        server = self.server
+        time.sleep(server.latency)
+        path = unquote(urlsplit(self.path).path).lstrip('/')
+        filename = os.path.normpath(os.path.join(server.root, path))
+        with server.lock:
+            server.requests += 1
+        if filename.startswith(server.root) and os.path.isfile(filename):
+            self.send_response(200)
+        else:
+            # Unlike send_error(), this doesn't close the connection.
+            self.send_response(404)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    do_GET = do_HEAD
+
+    def log_message(self, format, *args):
+        pass
+
+
+class FallbackServer(object):
+    """Serves which files exist in `root`, waiting `latency` seconds
+    before each response. Used as a context manager, it serves on a free
+    port of localhost in a background thread, at `url`."""
+
+    def __init__(self, root, latency=0.0):
+        self.root = os.path.abspath(root)
+        self.latency = latency
+        self._server = None
+
+    @property
+    def url(self):
+        host, port = self._server.server_address[:2]
+        return 'http://{}:{}'.format(host, port)
+
+    @property
+    def requests(self):
+        return self._server.requests
+
+    @property
+    def connections(self):
+        return self._server.connections
+
+    def __enter__(self):
+        server = self._server = ThreadingHTTPServer(
+            ('127.0.0.1', 0), _Handler
+        )
+        server.daemon_threads = True
+        server.root = self.root
+        server.latency = self.latency
+        server.lock = threading.Lock()
+        server.requests = 0
+        server.connections = 0
+        self._thread = threading.Thread(
+            target=server.serve_forever, daemon=True
+        )
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self._server.shutdown()
+        self._server.server_close()
+        self._thread.join()
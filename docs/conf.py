@@ -159,6 +159,10 @@ man_pages = [
      [author], 1),
     ('man-suttaref', 'webpub-suttaref', 'Add cross-references to suttas',
      [author], 1),
+    ('man-fix', 'webpub-fix', 'Fix links and add cross-references to suttas'
+     ' in one pass', [author], 1),
+    ('man-index', 'webpub-index', 'Create an index of a site to check links'
+     ' against', [author], 1),
 ]
 
 man_show_urls = True
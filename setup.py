@@ -14,6 +14,8 @@ setup(
             'webpub = webpub.cli:main',
             'webpub-linkfix = webpub.cli:linkfix_cmd',
             'webpub-suttaref = webpub.cli:sutta_cross_ref_cmd',
+            'webpub-fix = webpub.cli:fix_cmd',
+            'webpub-index = webpub.cli:index_cmd',
         ],
     },
     install_requires=[
@@ -0,0 +1,117 @@
+import click
+import pytest
+
+from webpub.css import (
+    MalformedStylesheet, replace_urls, rewrite_urls, tokenize_urls
+)
+from webpub.ui import UserInterfaceContext
+
+
+@pytest.fixture
+def ui_context():
+    with click.Context(click.Command('webpub'),
+                       obj=UserInterfaceContext()) as ctx:
+        yield ctx
+
+
+def urls(style_bytes):
+    return [
+        (style_bytes[start:end], quote, url)
+        for start, end, quote, url in tokenize_urls(style_bytes)
+    ]
+
+
+@pytest.mark.parametrize('style_bytes, expected', [
+    (b'a { background: url(a.png) }',
+     [(b'a.png', b'', 'a.png')]),
+    (b'a { background: url( "b c.png" ) }',
+     [(b'"b c.png"', b'"', 'b c.png')]),
+    (b"a { background: URL('d.png') }",
+     [(b"'d.png'", b"'", 'd.png')]),
+    (b'a { background: url() }',
+     [(b'', b'', '')]),
+    (b'@import "i.css"; @import url(\'j.css\'); @IMPORT\'k.css\';',
+     [(b'"i.css"', b'"', 'i.css'), (b"'j.css'", b"'", 'j.css'),
+      (b"'k.css'", b"'", 'k.css')]),
+    # Not url() values
+    (b'/* url(a.png) */ a { content: "url(b.png)" }', []),
+    (b'/* "unterminated */ a { content: \'url(c.png\' }', []),
+    (b'a { background: image-url(a.png); x-url(b.png) }', []),
+    (b'a { content: "\\"url(a.png)\\"" }', []),
+    (b'a { background: url(caf\xc3\xa9.png) }',
+     [(b'caf\xc3\xa9.png', b'', 'caf\xe9.png')]),
+])
+def test_tokenize_urls(style_bytes, expected):
+    assert urls(style_bytes) == expected
+
+
+@pytest.mark.parametrize('style_bytes', [
+    # Escapes in urls
+    b'a { background: url(a\\.png) }',
+    b'a { background: url("a\\"b.png") }',
+    # Unterminated or unexpected
+    b'a { background: url(a.png }',
+    b'a { background: url(a(1).png) }',
+    b'a { content: "unterminated }',
+    b'/* unterminated',
+    # Other encodings
+    b'@charset "latin1"; a { background: url(caf\xe9.png) }',
+    b'a { background: url(caf\xe9.png) }',
+    b'\xff\xfea\x00',
+])
+def test_malformed_stylesheets(style_bytes):
+    with pytest.raises(MalformedStylesheet):
+        tokenize_urls(style_bytes)
+
+
+@pytest.mark.parametrize('style_bytes, new_url, expected', [
+    (b'a{b:url(a.png)} /* url(a.png) */ @import "a.png";',
+     'new/a.png',
+     b'a{b:url(new/a.png)} /* url(a.png) */ @import "new/a.png";'),
+    (b'a { b: url( a.png ) }', 'a.png', b'a { b: url( a.png ) }'),
+    (b'a{b:url(a.png)}', 'a b.png', b'a{b:url("a b.png")}'),
+    (b'a{b:url(a.png)}', 'a(1).png', b'a{b:url("a(1).png")}'),
+    (b'a{b:url(a.png)}', "a'b.png", b'a{b:url("a\'b.png")}'),
+    (b'a{b:url("a.png")}', 'x y(1)".png', b'a{b:url("x y(1)\\".png")}'),
+    (b"a{b:url('a.png')}", 'x y(1)".png', b"a{b:url('x y(1)\".png')}"),
+    (b'a{b:url(a.png)}', 'a\\b\nc', b'a{b:url("a\\\\b\\a c")}'),
+    (b'a{b:url(a.png)}', 'caf\xe9.png', b'a{b:url(caf\xc3\xa9.png)}'),
+])
+def test_rewrite_urls(style_bytes, new_url, expected):
+    assert rewrite_urls(style_bytes, lambda url: new_url) == expected
+
+
+def test_unchanged_stylesheet_is_left_as_is():
+    style_bytes = b'a  {  b : url( a.png )  }'
+    assert rewrite_urls(style_bytes, lambda url: url) is style_bytes
+
+
+def test_replace_urls(tmp_path, ui_context):
+    (tmp_path / 'img').mkdir()
+    (tmp_path / 'img' / 'a.png').touch()
+    stylesheet = tmp_path / 'style.css'
+    stylesheet.write_bytes(b'p  {  background: url(img/a.png)  } /* x */')
+    routes = {
+        str(stylesheet): '/out/css/style.css',
+        str(tmp_path / 'img' / 'a.png'): '/out/images/a.png',
+    }
+    assert replace_urls(routes, str(stylesheet)) == \
+        b'p  {  background: url(../images/a.png)  } /* x */'
+
+
+def test_replace_urls_of_malformed_stylesheet(tmp_path, ui_context):
+    (tmp_path / 'img').mkdir()
+    (tmp_path / 'img' / 'a.png').touch()
+    stylesheet = tmp_path / 'style.css'
+    # Parsed because of the escape, and written out again as a whole.
+    stylesheet.write_bytes(
+        b'p  {  background: url(img/a.png)  } q { background: url(\\62) }'
+    )
+    routes = {
+        str(stylesheet): '/out/css/style.css',
+        str(tmp_path / 'img' / 'a.png'): '/out/images/a.png',
+    }
+    assert replace_urls(routes, str(stylesheet)) == (
+        b'p {\n    background: url(../images/a.png);\n}\n'
+        b'q {\n    background: url(b);\n}'
+    )
@@ -0,0 +1,240 @@
+import pytest
+
+from webpub.parse import parse_document
+from webpub.splice import ElementEdits, SpliceError
+from webpub.stats import FileStats, GlobalStats
+from webpub.sutta_ref import crossref_tree, text_edits
+from webpub.util import tostring
+
+
+def drop_tag(element):
+    """Removes `element`, keeping its children and text in its place, as
+    linkfix removes links."""
+    parent = element.getparent()
+    children = list(element)
+    text = element.text or ''
+    if children:
+        children[-1].tail = (children[-1].tail or '') + (element.tail or '')
+    else:
+        text += element.tail or ''
+    previous = element.getprevious()
+    if previous is not None:
+        previous.tail = (previous.tail or '') + text
+    else:
+        parent.text = (parent.text or '') + text
+    index = parent.index(element)
+    parent[index:index + 1] = children
+
+
+def set_href(tree, href='new.html'):
+    for a in tree.iter('a'):
+        a.set('href', href)
+
+
+def set_attribute(tag, name, value, index=None):
+    def change(tree):
+        elements = list(tree.iter(tag))
+        if index is not None:
+            elements = elements[index:index + 1]
+        for element in elements:
+            element.set(name, value)
+    return change
+
+
+def remove_attribute(tag, name):
+    def change(tree):
+        for element in tree.iter(tag):
+            element.attrib.pop(name)
+    return change
+
+
+def drop(tag):
+    def change(tree):
+        for element in list(tree.iter(tag)):
+            drop_tag(element)
+    return change
+
+
+def splice_element_edits(raw, change, parser):
+    tree = parse_document(raw, parser)
+    edits = ElementEdits(raw, tree)
+    change(tree)
+    return edits.splice(), tostring(tree)
+
+
+def assert_same_document(spliced, serialized, parser):
+    """The spliced document is parsed into the same tree as the one that
+    was serialized."""
+    assert tostring(parse_document(spliced, parser)) == serialized
+
+
+xhtml = (
+    b'<?xml version="1.0" encoding="utf-8"?>\n'
+    b'<html xmlns="http://www.w3.org/1999/xhtml">\n'
+    b'<head><title>Title</title></head>\n'
+    b'<body><p><a href="old.html"/>x<span/>y</p></body>\n'
+    b'</html>\n'
+)
+
+
+@pytest.mark.parametrize('raw, change, expected', [
+    (b'<!DOCTYPE html>\n<p class=x>Hi <a href="old.html" id=a>link</a>\n',
+     set_href,
+     b'<!DOCTYPE html>\n<p class=x>Hi <a href="new.html" id=a>link</a>\n'),
+    (b"<p><a href='a&amp;b' title=\"t\">x</a><a href=old>y</a>",
+     set_href,
+     b'<p><a href="new.html" title="t">x</a><a href="new.html">y</a>'),
+    (b'<p><a href=old.html>x</a>',
+     lambda tree: set_href(tree, 'a "b" & <c>'),
+     b'<p><a href="a &quot;b&quot; &amp; <c>">x</a>'),
+    (b'<p><a href="x" hreflang=en>x</a>',
+     remove_attribute('a', 'hreflang'),
+     b'<p><a href="x">x</a>'),
+    (b'<p><a href="x">x</a>',
+     set_attribute('a', 'rel', 'next'),
+     b'<p><a href="x" rel="next">x</a>'),
+    (b'<p>a <span>b <i>c</i></span> d</p>',
+     drop('span'),
+     b'<p>a b <i>c</i> d</p>'),
+    (b'<ul><li>a<li><span>b</span></ul>',
+     drop('span'),
+     b'<ul><li>a<li>b</ul>'),
+    (b'<table><tr><td><a href=old>x</a></td></tr></table>',
+     set_href,
+     b'<table><tr><td><a href="new.html">x</a></td></tr></table>'),
+    (b'<table><tbody><tr><td>x</td></tr></tbody></table>',
+     set_attribute('tbody', 'class', 'x'),
+     b'<table><tbody class="x"><tr><td>x</td></tr></tbody></table>'),
+    (b'<p><b>bold <p>next <a href=old>x</a></b>',
+     set_href,
+     b'<p><b>bold <p>next <a href="new.html">x</a></b>'),
+    (b'<p><b>a<i>b</b>c</i>',
+     set_attribute('i', 'id', 'z'),
+     b'<p><b>a<i id="z">b</b>c</i>'),
+    (b'<html><body class=a><p>x</p><body class=b>',
+     set_attribute('body', 'class', 'c'),
+     b'<html><body class="c"><p>x</p><body class=b>'),
+    (b'<p><span/>x</p>',
+     drop('span'),
+     b'<p>x</p>'),
+    (b'<div><a href=old/>x</div>',
+     set_href,
+     b'<div><a href="new.html">x</div>'),
+    (b'<script>if (a<b) "<a href=old>"</script><p><a href=old>x</a>',
+     set_href,
+     b'<script>if (a<b) "<a href=old>"</script><p><a href="new.html">x</a>'),
+    (b'<!-- <a href=old> --><p><a href=old>x</a>',
+     set_href,
+     b'<!-- <a href=old> --><p><a href="new.html">x</a>'),
+    (b'<p><a href=old>x</a> caf\xc3\xa9',
+     set_href,
+     b'<p><a href="new.html">x</a> caf\xc3\xa9'),
+    (b'<svg><a href=old>x</a></svg>',
+     set_href,
+     b'<svg><a href="new.html">x</a></svg>'),
+])
+def test_element_edits(raw, change, expected):
+    spliced, serialized = splice_element_edits(raw, change, 'html5')
+    assert spliced == expected
+    assert_same_document(spliced, serialized, 'html5')
+
+
+@pytest.mark.parametrize('parser, change, changed', [
+    ('xml', set_href, (b'href="old.html"', b'href="new.html"')),
+    ('html5', set_href, (b'href="old.html"', b'href="new.html"')),
+    ('xml', drop('span'), (b'<span/>', b'')),
+])
+def test_element_edits_of_xhtml(parser, change, changed):
+    spliced, serialized = splice_element_edits(xhtml, change, parser)
+    assert spliced == xhtml.replace(*changed)
+    assert_same_document(spliced, serialized, parser)
+
+
+def test_unchanged_document_is_left_as_is():
+    raw = b'<p CLASS=x>Some   <b>text</B>'
+    spliced, _serialized = splice_element_edits(raw, lambda tree: None,
+                                                'html5')
+    assert spliced is raw
+
+
+@pytest.mark.parametrize('raw, change, message', [
+    # Implied by the parser, without a tag in the original.
+    (b'<table><tr><td>x</td></tr></table>',
+     set_attribute('tbody', 'class', 'x'),
+     "the <tbody> element on line 1 can't be found"),
+    (b'<table><tr><td>x</td></tr></table>',
+     drop('tbody'),
+     "the <tbody> element on line 1 can't be found"),
+    # Formatting elements that the parser reopened, of which only one
+    # copy was changed, or that can't be removed from one place only.
+    (b'<p><b id=b>bold <p>next</b>',
+     set_attribute('b', 'id', 'c', index=0),
+     "was reopened by the parser"),
+    (b'<p><b>a<i>b</b>c</i>',
+     set_attribute('i', 'id', 'z', index=0),
+     "was reopened by the parser"),
+    (b'<p><b>bold <p>next</b>',
+     drop('b'),
+     "changes how the original is parsed"),
+    # Removed tags that the elements around them depend on.
+    (b'<p>a<p>b</p>',
+     drop('p'),
+     "changes how the original is parsed"),
+    (b'<p><span>unclosed',
+     drop('span'),
+     "the end tag of the <span> element on line 1 can't be found"),
+    # Only UTF-8 documents are spliced into.
+    (b'<p><a href=old>x</a> \xe9',
+     set_href,
+     "document is not valid UTF-8"),
+    (b'<meta charset="iso-8859-1"><p><a href=old>x</a>',
+     set_href,
+     "document is encoded in iso-8859-1"),
+    (b'\xff\xfe<\x00p\x00>\x00<\x00a\x00>\x00',
+     set_href,
+     "document is encoded in UTF-16"),
+])
+def test_element_edits_fall_back(raw, change, message):
+    with pytest.raises(SpliceError, match=message):
+        splice_element_edits(raw, change, 'html5')
+
+
+def splice_text_edits(raw, parser='html5'):
+    tree = parse_document(raw, parser)
+    edits = text_edits(raw, tree)
+    crossref_tree(tree, FileStats(GlobalStats(), 'doc.html'), None, None,
+                  edits=edits)
+    return edits.splice(), tostring(tree)
+
+
+@pytest.mark.parametrize('raw, expected', [
+    (b'<p>See MN 10 and SN&nbsp;1.2.</p>',
+     b'<p>See <a href="/suttas/MN/MN10.html" class="sutta-ref">MN 10</a>'
+     b' and <a href="/suttas/SN/SN1_2.html" class="sutta-ref">SN&nbsp;1.2'
+     b'</a>.</p>'),
+    (b'<table><tr><td>MN 1</td></tr></table>',
+     b'<table><tr><td><a href="/suttas/MN/MN1.html" class="sutta-ref">'
+     b'MN 1</a></td></tr></table>'),
+    (b'<p>MN 1<!-- MN 2 --> MN 3</p>',
+     b'<p><a href="/suttas/MN/MN1.html" class="sutta-ref">MN 1</a>'
+     b'<!-- MN 2 --> MN 3</p>'),
+    (b'<p><a href=x>MN 1</a> MN 2</p>',
+     b'<p><a href=x>MN 1</a> MN 2</p>'),
+    (b'<title>MN 1</title><p>caf\xc3\xa9 MN&#32;1 &amp; &eacute;</p>',
+     b'<title>MN 1</title><p>caf\xc3\xa9 <a href="/suttas/MN/MN1.html"'
+     b' class="sutta-ref">MN&#32;1</a> &amp; &eacute;</p>'),
+])
+def test_text_edits(raw, expected):
+    spliced, serialized = splice_text_edits(raw)
+    assert spliced == expected
+    assert_same_document(spliced, serialized, 'html5')
+
+
+@pytest.mark.parametrize('raw, message', [
+    (b'<table>MN 1<tr><td>x</td></tr></table>',
+     "text in a table is moved out of it"),
+    (b'<meta charset=latin1><p>MN 1', "document is encoded in latin1"),
+])
+def test_text_edits_fall_back(raw, message):
+    with pytest.raises(SpliceError, match=message):
+        splice_text_edits(raw)
@@ -0,0 +1,101 @@
+import io
+
+import pytest
+
+from webpub.parse import parse_document
+from webpub.splice import SpliceError, tokenize, tokenize_chunks
+from webpub.stats import FileStats, GlobalStats
+from webpub.sutta_ref import (
+    crossref_stream, crossref_tree, sutta_ref_text_boundary, text_edits
+)
+
+documents = {
+    'markup': (
+        '﻿<!DOCTYPE html><html><head><title>MN 1</title>'
+        '<script>if (a<b) "MN 2" </scrip </script></head>'
+        '<body><p>See MN&nbsp;10 and <!-- SN 1.2 --> SN 1.2,'
+        ' <a href="x">AN 3.4</a> Dhp 5 é&amp; <h2>MN 3</h2> tail'
+        ' Iti 4<br>Ud 1.2<style>p { content: "MN 8" }</style>'
+        '<textarea>MN 9</textarea> Thag 2.3</p><pre>Khp 3</pre>'
+        '<p title="MN 4">MN&#32;5 &#x4d;N 6 &eacute;MN 7</p>'
+        '<!-- a -- comment --!> DN 22 <!----> Snp 1.8'
+        '<b>\ufeffMN 12</b>,\ufeffSN 3.4'
+        '</body></html>'
+    ).encode(),
+    'prose': (
+        '<html><body><p>'
+        + 'Some words, see MN 10 and SN 56.11; more text AN 4.41 '
+        'here  and Dhp 183. ' * 40
+        + '</p></body></html>'
+    ).encode(),
+    'script': (
+        '<html><body><p>MN 1</p><script>'
+        + 'var x = "MN 10"; y = a < b && c > d; ' * 40
+        + '</script><p>MN 2</p></body></html>'
+    ).encode(),
+    'unclosed': b'<p>MN 1 <b>SN 2.3 <i>AN 4.5',
+}
+
+chunk_sizes = [1, 2, 3, 5, 16, 17, 64, 1000, 1 << 20]
+
+
+def linked(raw, chunk_size=None):
+    """The document with its sutta references linked, as streamed if
+    `chunk_size` is given, or as spliced otherwise."""
+    stats = FileStats(GlobalStats(), 'doc.html')
+    if chunk_size is not None:
+        with crossref_stream(io.BytesIO(raw), stats, None, None,
+                             chunk_size=chunk_size) as out:
+            return out.read()
+    tree = parse_document(raw, 'html5')
+    edits = text_edits(raw, tree)
+    crossref_tree(tree, stats, None, None, edits=edits)
+    return edits.splice()
+
+
+@pytest.mark.parametrize('chunk_size', chunk_sizes)
+@pytest.mark.parametrize('name', sorted(documents))
+def test_streamed_as_spliced(name, chunk_size):
+    raw = documents[name]
+    expected = linked(raw)
+    assert expected != raw
+    assert linked(raw, chunk_size) == expected
+
+
+@pytest.mark.parametrize('chunk_size', chunk_sizes)
+@pytest.mark.parametrize('name', sorted(documents))
+def test_tokenize_chunks(name, chunk_size):
+    raw = documents[name]
+    pieces = list(tokenize_chunks(io.BytesIO(raw), chunk_size,
+                                  sutta_ref_text_boundary))
+    assert b''.join(piece for piece, _tokens in pieces) == raw
+    # The tokens of the pieces are those of the whole document, but for
+    # texts that were cut in pieces.
+    tokens = []
+    offset = 0
+    for piece, piece_tokens in pieces:
+        for token in piece_tokens:
+            assert token.end <= len(piece)
+            token = token._replace(start=token.start + offset,
+                                   end=token.end + offset)
+            if tokens and token.kind == 'text' \
+                    and tokens[-1].kind == 'text' \
+                    and tokens[-1].end == token.start:
+                token = token._replace(start=tokens.pop().start)
+            tokens.append(token)
+        offset += len(piece)
+    assert [token[:4] for token in tokens] == \
+        [token[:4] for token in tokenize(raw)]
+
+
+def test_long_text_is_cut():
+    raw = documents['prose']
+    pieces = list(tokenize_chunks(io.BytesIO(raw), 64,
+                                  sutta_ref_text_boundary))
+    assert max(len(piece) for piece, _tokens in pieces) < 256
+
+
+def test_streaming_needs_utf8():
+    raw = '<meta charset="latin1"><p>MN 1 é'.encode('latin1')
+    with pytest.raises(SpliceError):
+        linked(raw, 16)
@@ -0,0 +1,199 @@
+import io
+import os
+
+import pytest
+
+from webpub.cli import _listed_files
+from webpub.walk import FileWalker, parse_pattern
+
+
+def matches(line, path, is_dir=False):
+    pattern = parse_pattern(line)
+    if pattern.dir_only and not is_dir:
+        return False
+    return pattern.regex.fullmatch(path) is not None
+
+
+@pytest.mark.parametrize('line, path, expected', [
+    ('*.png', 'a.png', True),
+    ('*.png', 'img/a.png', True),
+    ('*.png', 'a.png.html', False),
+    ('a?c', 'abc', True),
+    ('a?c', 'a/c', False),
+    ('[ab].html', 'b.html', True),
+    ('[!ab].html', 'b.html', False),
+    ('[!ab].html', 'c.html', True),
+    ('[]].html', '].html', True),
+    ('\\*.html', '*.html', True),
+    ('\\*.html', 'a.html', False),
+    # `**`
+    ('**/img', 'img', True),
+    ('**/img', 'a/b/img', True),
+    ('img/**', 'img/a/b.png', True),
+    ('img/**', 'img', False),
+    ('a/**/b', 'a/b', True),
+    ('a/**/b', 'a/x/y/b', True),
+    ('a/**/b', 'xa/b', False),
+    # Anchored, by a slash at the start or in the middle
+    ('/a.html', 'a.html', True),
+    ('/a.html', 'x/a.html', False),
+    ('x/a.html', 'x/a.html', True),
+    ('x/a.html', 'y/x/a.html', False),
+    ('x/*.html', 'x/y/a.html', False),
+])
+def test_patterns(line, path, expected):
+    assert matches(line, path) == expected
+
+
+def test_directory_only_patterns():
+    assert matches('build/', 'build', is_dir=True)
+    assert not matches('build/', 'build', is_dir=False)
+    assert matches('build', 'build', is_dir=False)
+
+
+@pytest.mark.parametrize('line, negated', [
+    ('!keep.html', True),
+    ('\\!keep.html', False),
+])
+def test_negated_patterns(line, negated):
+    pattern = parse_pattern(line)
+    assert pattern.negated == negated
+    assert pattern.regex.fullmatch('!keep.html' if not negated
+                                   else 'keep.html')
+
+
+@pytest.mark.parametrize('line', ['', '   ', '# comment', '/', '!'])
+def test_blank_lines_and_comments(line):
+    assert parse_pattern(line) is None
+
+
+def test_trailing_spaces():
+    assert parse_pattern('a.html  \n').regex.fullmatch('a.html')
+    assert parse_pattern('a\\ ').regex.fullmatch('a ')
+    assert parse_pattern('\\#a').regex.fullmatch('#a')
+
+
+@pytest.fixture
+def tree(tmp_path):
+    files = [
+        'index.html', 'style.css', 'image.png',
+        'a/page.html', 'a/draft.html', 'a/keep.html',
+        'a/b/deep.html', 'a/b/notes.txt',
+        'build/out.html', 'a/build/out.css',
+        'media/x.html', 'media/keep/y.html',
+        'tmp', 'a/tmp/z.html',
+    ]
+    for name in files:
+        path = tmp_path / name
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_text('')
+    (tmp_path / '.webpubignore').write_text(
+        '# Comments and blank lines are skipped\n'
+        '\n'
+        '/build/\n'
+        'tmp/\n'
+        'draft.html\n'
+        'media/**\n'
+        '!media/keep/\n'
+        '!media/keep/**\n'
+    )
+    (tmp_path / 'a' / '.webpubignore').write_text(
+        '*.html\n'
+        '!keep.html\n'
+        '!b/*.html\n'
+    )
+    return tmp_path
+
+
+def walk(root, **kwargs):
+    walker = FileWalker(str(root), ignore_files=['.webpubignore'], **kwargs)
+    found = []
+    for walk_root, path in walker:
+        assert walk_root == str(root)
+        found.append(path.replace(os.sep, '/'))
+    return sorted(found)
+
+
+def test_walk(tree):
+    assert walk(tree) == [
+        '.webpubignore', 'a/.webpubignore', 'a/b/deep.html',
+        'a/b/notes.txt', 'a/build/out.css', 'a/keep.html', 'image.png',
+        'index.html', 'media/keep/y.html', 'style.css', 'tmp',
+    ]
+
+
+def test_walk_with_include_and_exclude(tree):
+    assert walk(tree, include=['*.html', '*.css'],
+                exclude=['a/b/', 'index.html']) == [
+        'a/build/out.css', 'a/keep.html', 'media/keep/y.html',
+        'style.css',
+    ]
+
+
+def test_walk_with_accept(tree):
+    assert walk(tree, accept=lambda path: path.endswith('.css')) == [
+        'a/build/out.css', 'style.css',
+    ]
+
+
+def test_excluded_directories_are_not_walked(tree, monkeypatch):
+    walked = []
+    scandir = os.scandir
+
+    def recording_scandir(path):
+        walked.append(os.path.relpath(path, str(tree)))
+        return scandir(path)
+
+    monkeypatch.setattr(os, 'scandir', recording_scandir)
+    walk(tree, exclude=['a/'])
+    assert sorted(walked) == ['.', 'media', 'media/keep']
+
+
+def test_walk_single_file(tree):
+    walker = FileWalker(str(tree / 'a' / 'page.html'))
+    assert list(walker) == [(str(tree / 'a'), 'page.html')]
+
+
+@pytest.mark.parametrize('path', [
+    'index.html', 'a/keep.html', 'a/b/deep.html', 'media/keep/y.html',
+    'a/build/out.css', 'missing.html',
+])
+def test_includes(tree, path):
+    walker = FileWalker(str(tree), ignore_files=['.webpubignore'])
+    assert walker.includes(path)
+
+
+@pytest.mark.parametrize('path', [
+    'a/page.html', 'a/draft.html', 'build/out.html', 'media/x.html',
+    'a/tmp/z.html', 'a/b/../page.html',
+])
+def test_includes_excluded(tree, path):
+    walker = FileWalker(str(tree), ignore_files=['.webpubignore'])
+    assert not walker.includes(os.path.normpath(path))
+
+
+def test_includes_like_walking(tree):
+    walker = FileWalker(str(tree), include=['*.html'], exclude=['a/b/'],
+                        ignore_files=['.webpubignore'])
+    found = {path for _root, path in walker}
+    for dirpath, _dirnames, filenames in os.walk(str(tree)):
+        for name in filenames:
+            path = os.path.relpath(os.path.join(dirpath, name), str(tree))
+            assert walker.includes(path) == (path in found)
+
+
+@pytest.mark.parametrize('null', [False, True])
+def test_files_from(tree, null):
+    walker = FileWalker(str(tree), ignore_files=['.webpubignore'])
+    names = [
+        str(tree / path) for path in
+        ['index.html', 'a/page.html', 'a/keep.html', 'media/x.html']
+    ]
+    file_list = io.BytesIO(
+        b'\0'.join(map(os.fsencode, names)) if null
+        else b''.join(os.fsencode(name) + b'\n' for name in names)
+    )
+    assert list(_listed_files(str(tree), file_list, null, walker)) == [
+        (str(tree), 'index.html'),
+        (str(tree), os.path.join('a', 'keep.html')),
+    ]
@@ -3,14 +3,22 @@ import re
 import itertools as it
 import functools as ft
 import os
-import zipfile as zf
 
 import click
 
 from webpub.ui import UserInterfaceContext, echo
+import webpub.fix
+import webpub.handlers
+import webpub.http
 import webpub.linkfix.check
+import webpub.linkfix.linkfix
+import webpub.linkfix.cache
+import webpub.linkfix.index
+import webpub.parse
 import webpub.sutta_ref
+import webpub.profile
 import webpub.stats
+import webpub.walk
 
 
 class IntOrTocType(click.ParamType):
@@ -64,6 +72,9 @@ def rich_help_option(*args, **kwargs):
 
 
 def make_order(ctx, param, values):
+    # Keep the values as given, to tell whether they changed since the
+    # previous incremental build.
+    ctx.meta.setdefault('webpub.order', {})[param.name] = values
     if len(values) == 0:
         return None
     filled_values = it.chain(
@@ -94,6 +105,31 @@ def dry_run_msg(ctx, param, value):
     return value
 
 
+def start_profile(ctx, param, value):
+    if not value or 'webpub.profile' in ctx.meta:
+        return
+    profile = ctx.meta['webpub.profile'] = webpub.profile.Profile()
+
+    def report():
+        report = profile.report()
+        click.echo(webpub.profile.format_report(report))
+        json_filename = ctx.meta.get('webpub.profile_json')
+        if json_filename is not None:
+            profile.save(json_filename, report)
+    ctx.call_on_close(report)
+
+
+def set_profile_json(ctx, param, value):
+    if value is None:
+        return
+    ctx.meta['webpub.profile_json'] = value
+    start_profile(ctx, param, True)
+
+
+def get_profile():
+    return click.get_current_context().meta.get('webpub.profile')
+
+
 def show_stats_on_close(f):
     @ft.wraps(f)
     def wrapper(*args, **kwargs):
@@ -103,6 +139,71 @@ def show_stats_on_close(f):
     return wrapper
 
 
+def open_http_client(f):
+    @ft.wraps(f)
+    def wrapper(*args, http_pool_size, http_timeout, http_retries,
+                http_backoff, http_rate_limit, http_get_fallback, **kwargs):
+        ctx = click.get_current_context()
+        http_client = ctx.meta['webpub.http_client'] = \
+            webpub.http.HttpClient(
+                pool_size=http_pool_size,
+                timeout=http_timeout,
+                retries=http_retries,
+                backoff=http_backoff,
+                rate=http_rate_limit,
+                get_fallback=http_get_fallback,
+            )
+        ctx.call_on_close(http_client.close)
+        return f(*args, **kwargs)
+    return wrapper
+
+
+def get_http_client():
+    return click.get_current_context().meta.get('webpub.http_client')
+
+
+def http_options(f):
+    f = open_http_client(f)
+    f = rich_help_option('--http-get-fallback/--no-http-get-fallback',
+                         default=True,
+                         rich_help="Whether to check a link with a GET"
+                         " request if the server doesn't allow HEAD"
+                         " requests (responds with ``405`` or ``501``)."
+                         " Only the headers of the response are read."
+                         " Enabled by default.")(f)
+    f = rich_help_option('--http-rate-limit', metavar='N',
+                         type=click.FloatRange(min=0, min_open=True),
+                         default=None,
+                         rich_help="Make at most N requests per second to"
+                         " each host (in each worker process). Unlimited"
+                         " by default.")(f)
+    f = rich_help_option('--http-backoff', metavar='SECONDS',
+                         type=click.FloatRange(min=0), default=0.5,
+                         rich_help="How long to wait before retrying a"
+                         " request the first time. The wait is doubled on"
+                         " each next retry, unless the server asks for"
+                         " longer with ``Retry-After`` (defaults to"
+                         " 0.5).")(f)
+    f = rich_help_option('--http-retries', metavar='N',
+                         type=click.IntRange(min=0), default=3,
+                         rich_help="How often to retry a request to"
+                         " :option:`--fallback-url` that failed, or that"
+                         " was answered with ``429`` or a ``5xx`` status"
+                         " (defaults to 3).")(f)
+    f = rich_help_option('--http-timeout', metavar='SECONDS',
+                         type=click.FloatRange(min=0, min_open=True),
+                         default=10,
+                         rich_help="How long to wait for the server to"
+                         " connect and to respond (defaults to 10).")(f)
+    f = rich_help_option('--http-pool-size', metavar='N',
+                         type=click.IntRange(min=1), default=10,
+                         rich_help="The number of connections to each host"
+                         " that are kept open, and reused throughout the"
+                         " run (defaults to 10). Should be at least"
+                         " :option:`--check-workers`, where given.")(f)
+    return f
+
+
 webpub_epilog = """The --spine-order and --toc-order are specified multiple times to
 determine the order. For example, '-o 2 -o toc -o 1' first puts the
 second document, then the generated Table of Contents, then the first
@@ -120,7 +221,20 @@ def common_options(f):
                          " directory. If the resource exists (i.e. does not"
                          " ``404`` as URL), this link won't be fixed. Useful"
                          " if you have a relative link to a file on a server"
-                         " to which the given files are uploaded.")(f)
+                         " to which the given files are uploaded. If PATH is"
+                         " an index file created by"
+                         " :manpage:`webpub-index(1)`, test against the files"
+                         " listed in the index.")(f)
+    f = rich_help_option('--parser', type=click.Choice(webpub.parse.parsers),
+                         default='auto',
+                         rich_help="How documents are parsed. With ``html5``,"
+                         " as browsers parse HTML. With ``xml``, documents"
+                         " are parsed as XML if they are well-formed, which"
+                         " is quicker and keeps them as they were written."
+                         " Others are parsed as HTML still. With ``auto``"
+                         " (the default), only documents that declare the"
+                         " XHTML namespace, such as those in EPUBs, are"
+                         " tried as XML.")(f)
     f = rich_help_option('--verbose', '-v', count=True, expose_value=False,
                          callback=set_verbosity,
                          rich_help="Enable verbose output. Use this multiple"
@@ -132,6 +246,26 @@ def common_options(f):
                          " happen.")(f)
     f = rich_help_option('--overwrite/--no-overwrite', '-f/ ', default=False,
                          help="Whether or not to overwrite existing files.")(f)
+    f = rich_help_option('--incremental', default=False, is_flag=True,
+                         rich_help="Only process files that changed since"
+                         " the previous run with this option, or of which"
+                         " the files they link to were added, moved or"
+                         " removed. What was processed is recorded in a"
+                         " manifest file in the output directory.")(f)
+    f = rich_help_option('--profile-json', metavar='FILE',
+                         type=click.Path(dir_okay=False, writable=True),
+                         expose_value=False, callback=set_profile_json,
+                         rich_help="Like :option:`--profile`, and also write"
+                         " the report, including the times of each file, to"
+                         " FILE as JSON, e.g. to compare runs.")(f)
+    f = rich_help_option('--profile', default=False, is_flag=True,
+                         expose_value=False, callback=start_profile,
+                         rich_help="Time each step of processing each file,"
+                         " and show where the time went when done: the total"
+                         " and the median, 95th percentile and maximum time"
+                         " of each step by type of file, the slowest files,"
+                         " and the throughput.")(f)
+    f = http_options(f)
     f = ensure_ui_context(f)
     f = show_stats_on_close(f)
     return f
@@ -163,12 +297,19 @@ def common_options(f):
                   " contents. Input is specified in the same way as with"
                   " :option:`--spine-order`. The default value, if"
                   " unspecified, is inherited from :option:`--spine-order`.")
+@rich_help_option('--jobs', '-j', metavar='N',
+                  type=click.IntRange(min=1), default=1,
+                  rich_help="Process N documents at the same time, using N"
+                  " worker processes, once the table of contents is done."
+                  " Stylesheets and images are copied at the same time"
+                  " too.")
 @common_options
 @click.argument('epub_filename', metavar='INFILE',
                 type=click.File('rb'))
 @click.pass_context
-def main(context, output_dir, template, spine_order, toc_order, fallback_url,
-         dry_run, overwrite, epub_filename):
+def main(context, output_dir, template, spine_order, toc_order, jobs,
+         fallback_url, parser, dry_run, overwrite, incremental,
+         epub_filename):
     """Process EPUB documents for web publishing.
 
     Given INFILE as input, this script:
@@ -185,31 +326,217 @@ def main(context, output_dir, template, spine_order, toc_order, fallback_url,
         spine_order, toc_order = it.tee(spine_order)
         context.params['spine_order'] = spine_order
         context.params['toc_order'] = toc_order
-    with zf.ZipFile(epub_filename) as epub_zip:
+    with webpub.epub.EpubZip(epub_filename) as epub_zip:
         webpub.epub.make_webbook(context, epub_zip)
 
 
-def collect_files(ctx, param, path):
-    if os.path.isfile(path):
-        yield os.path.dirname(path), os.path.basename(path)
-    elif os.path.isdir(path):
-        for dirpath, dirnames, filenames in os.walk(path):
-            dirpath = os.path.relpath(dirpath, path)
-            yield from (
-                (path, os.path.join(dirpath, fname)) for fname in filenames
+def set_root(ctx, param, path):
+    ctx.meta['webpub.root_is_dir'] = os.path.isdir(path)
+    ctx.meta['webpub.root'] = path if ctx.meta['webpub.root_is_dir'] \
+        else os.path.dirname(path)
+    return path
+
+
+def _read_names(file_list, null):
+    if not null:
+        for line in file_list:
+            yield line.rstrip(b'\r\n')
+        return
+    rest = b''
+    for chunk in iter(lambda: file_list.read(1 << 16), b''):
+        names = (rest + chunk).split(b'\0')
+        rest = names.pop()
+        yield from names
+    yield rest
+
+
+def _listed_files(root, file_list, null, walker):
+    abs_root = os.path.abspath(root)
+    for name in _read_names(file_list, null):
+        if not name:
+            continue
+        name = os.fsdecode(name)
+        relpath = os.path.relpath(os.path.abspath(name), abs_root)
+        if relpath == os.pardir or relpath.startswith(os.pardir + os.sep):
+            echo("Warning: {} is not in {}, skipping.".format(name, root))
+        elif not os.path.isfile(name):
+            echo("Warning: {} is not a file, skipping.".format(name))
+        elif walker.includes(relpath):
+            yield root, relpath
+
+
+def collect_files(mime_to_handlers):
+    """Replaces PATH by the files in it to process, as they are found.
+    Files without handlers in `mime_to_handlers` are left out."""
+    def decorator(f):
+        @ft.wraps(f)
+        def wrapper(*args, filenames, files_from, null, include, exclude,
+                    ignore_files, **kwargs):
+            ctx = click.get_current_context()
+            walker = webpub.walk.FileWalker(
+                filenames, include, exclude, ignore_files,
+                accept=webpub.handlers.has_handlers(mime_to_handlers)
             )
+            if files_from is not None:
+                if not ctx.meta['webpub.root_is_dir']:
+                    raise click.BadParameter(
+                        "must be a directory when using --files-from.",
+                        param_hint='PATH'
+                    )
+                walker = _listed_files(
+                    ctx.meta['webpub.root'], files_from, null, walker
+                )
+            return f(*args, filenames=walker, **kwargs)
+        return wrapper
+    return decorator
+
+
+def walk_options(mime_to_handlers):
+    def decorator(f):
+        f = collect_files(mime_to_handlers)(f)
+        f = rich_help_option('--null', '-0', default=False, is_flag=True,
+                             rich_help="The names in the file given to"
+                             " :option:`--files-from` are separated by NUL"
+                             " characters instead of newlines, as written"
+                             " by ``find -print0``.")(f)
+        f = rich_help_option('--files-from', metavar='FILE',
+                             type=click.File('rb'), default=None,
+                             rich_help="Only process the files named in FILE"
+                             " (or on standard input if FILE is ``-``), one"
+                             " per line, instead of all files in PATH. The"
+                             " names are relative to the current directory,"
+                             " and must be of files within PATH, which must"
+                             " be a directory.")(f)
+        f = rich_help_option('--ignore-file', 'ignore_files', metavar='NAME',
+                             multiple=True,
+                             rich_help="Read patterns to exclude from files"
+                             " named NAME (e.g. ``.gitignore``) in each"
+                             " directory, which apply to the files and"
+                             " directories below it. They are written like"
+                             " those of ``.gitignore`` files. Can be given"
+                             " multiple times.")(f)
+        f = rich_help_option('--exclude', metavar='GLOB', multiple=True,
+                             rich_help="Skip files and directories matching"
+                             " GLOB. A GLOB without a ``/`` matches names"
+                             " at any depth, others match paths relative"
+                             " to PATH. ``**`` matches any number of"
+                             " directories. Excluded directories are not"
+                             " searched at all. Can be given multiple"
+                             " times.")(f)
+        f = rich_help_option('--include', metavar='GLOB', multiple=True,
+                             rich_help="Only process files matching GLOB,"
+                             " written as for :option:`--exclude`. Can be"
+                             " given multiple times.")(f)
+        return f
+    return decorator
+
+
+def open_link_cache(f):
+    @ft.wraps(f)
+    def wrapper(*args, link_cache_file, no_link_cache, refresh_link_cache,
+                prune_link_cache, link_cache_ttl, link_cache_negative_ttl,
+                **kwargs):
+        ctx = click.get_current_context()
+        link_cache = webpub.linkfix.cache.LinkCheckCache(
+            None if no_link_cache else link_cache_file,
+            ttl=link_cache_ttl,
+            negative_ttl=link_cache_negative_ttl,
+            refresh=refresh_link_cache,
+        )
+        ctx.call_on_close(link_cache.close)
+        if prune_link_cache:
+            pruned = link_cache.prune()
+            echo("Pruned {} expired entries from the link check"
+                 " cache.".format(pruned), verbosity=1)
+        return f(*args, link_cache=link_cache, **kwargs)
+    return wrapper
+
+
+def link_cache_options(f):
+    f = open_link_cache(f)
+    f = rich_help_option('--link-cache-negative-ttl', metavar='SECONDS',
+                         type=click.IntRange(min=0), default=3600,
+                         rich_help="How long a broken link is remembered"
+                         " (defaults to one hour).")(f)
+    f = rich_help_option('--link-cache-ttl', metavar='SECONDS',
+                         type=click.IntRange(min=0), default=7 * 24 * 3600,
+                         rich_help="How long a working link is remembered"
+                         " (defaults to one week).")(f)
+    f = rich_help_option('--prune-link-cache', default=False, is_flag=True,
+                         rich_help="Remove expired entries from the link"
+                         " check cache before starting.")(f)
+    f = rich_help_option('--refresh-link-cache', default=False, is_flag=True,
+                         rich_help="Check every link again, ignoring (and"
+                         " replacing) results in the link check cache.")(f)
+    f = rich_help_option('--no-link-cache', default=False, is_flag=True,
+                         rich_help="Don't read or write the on-disk link"
+                         " check cache. Results are still remembered for"
+                         " the duration of the run.")(f)
+    f = rich_help_option('--link-cache', 'link_cache_file', metavar='FILE',
+                         type=click.Path(dir_okay=False, writable=True),
+                         default=webpub.linkfix.cache.default_cache_path(),
+                         show_default=True,
+                         rich_help="The file in which the results of checking"
+                         " links against :option:`--fallback-url` are"
+                         " stored, so that later runs don't need to check"
+                         " them again. Only the results of checking against"
+                         " a URL are stored, files on disk are always"
+                         " checked again.")(f)
+    return f
+
+
+def concurrent_check_options(f):
+    f = rich_help_option('--check-host-limit', metavar='N',
+                         type=click.IntRange(min=1), default=4,
+                         rich_help="The maximum number of concurrent"
+                         " requests to a single host when using"
+                         " :option:`--check-workers` (defaults to 4).")(f)
+    f = rich_help_option('--check-workers', metavar='N',
+                         type=click.IntRange(min=0), default=0,
+                         rich_help="Before processing any file, collect all"
+                         " links that need checking and check them using N"
+                         " concurrent workers. Afterwards, you are only asked"
+                         " what to do about links that are broken. With 0"
+                         " (the default), links are checked as each file is"
+                         " processed.")(f)
+    return f
 
 
 def linkfix_crossref_common_options(f):
+    f = rich_help_option('--output-mode',
+                         type=click.Choice(['serialize', 'splice']),
+                         default='serialize',
+                         rich_help="How changed files are written. With"
+                         " ``serialize``, the whole document is written out"
+                         " again from its parsed form. With ``splice``, only"
+                         " the changes are spliced into the original file,"
+                         " leaving the rest of it as it was. If the changes"
+                         " can't be located in a file, or it isn't encoded"
+                         " in UTF-8, that file is serialized instead.")(f)
+    f = rich_help_option('--jobs', '-j', metavar='N',
+                         type=click.IntRange(min=1), default=1,
+                         rich_help="Process N files at the same time, using"
+                         " N worker processes. Files for which you need to"
+                         " be asked what to do are processed after all"
+                         " other files.")(f)
+    f = concurrent_check_options(f)
+    f = link_cache_options(f)
     f = common_options(f)
     f = click.argument('filenames', metavar='PATH', nargs=1,
-                       required=True, callback=collect_files,
+                       required=True, callback=set_root,
                        type=click.Path(file_okay=True, dir_okay=True,
                                        readable=True, writable=True,
                                        exists=True))(f)
     return f
 
 
+def manifest_path(name, incremental):
+    if not incremental:
+        return None
+    root = click.get_current_context().meta['webpub.root']
+    return os.path.join(root, name)
+
+
 def format_action_choice_help(choices):
     prefix = "If unspecified, an option is chosen interactively" + \
              " upon each broken link encountered. Possible options: "
@@ -228,6 +555,7 @@ def set_action_choice(ctx, param, value):
 
 
 @click.command()
+@walk_options(webpub.linkfix.linkfix.linkfix_mime_handlers)
 @linkfix_crossref_common_options
 @click.option('--action',
               type=click.Choice(
@@ -238,16 +566,25 @@ def set_action_choice(ctx, param, value):
               format_action_choice_help(
                   webpub.linkfix.check.link_choices
               ))
-def linkfix_cmd(fallback_url, dry_run, overwrite, filenames):
+def linkfix_cmd(fallback_url, parser, dry_run, overwrite, incremental,
+                filenames, link_cache, check_workers, check_host_limit, jobs,
+                output_mode):
     """Attempts to fix relative links among the given files.
     Only root-relative (e.g. /www/a/b/c.html) and optionally
     document-relative (e.g. ../b/c.html) are considered.
     """
     import webpub.linkfix
-    webpub.linkfix.fixlinks(filenames, fallback_url, dry_run, overwrite)
+    webpub.linkfix.fixlinks(
+        filenames, fallback_url, dry_run, overwrite, link_cache,
+        check_workers, check_host_limit, jobs,
+        manifest_path('.webpub-linkfix-manifest.json', incremental),
+        output_mode, get_profile(), parser,
+        http_client=get_http_client()
+    )
 
 
 @click.command()
+@walk_options(webpub.sutta_ref.crossref_mime_handlers)
 @linkfix_crossref_common_options
 @click.option('--action',
               type=click.Choice(
@@ -258,11 +595,141 @@ def linkfix_cmd(fallback_url, dry_run, overwrite, filenames):
               " broken. " + format_action_choice_help(
                   webpub.sutta_ref.sutta_ref_choices
               ))
-def sutta_cross_ref_cmd(fallback_url, dry_run, overwrite, filenames):
+@rich_help_option('--stream-above', metavar='MB',
+                  type=click.FloatRange(min=0), default=None,
+                  rich_help="Cross-reference files of at least this many"
+                  " megabytes as they are read, a chunk at a time, instead"
+                  " of parsing them as a whole. Memory use then doesn't"
+                  " grow with the size of the file. The links are spliced"
+                  " into the original file, as with ``--output-mode"
+                  " splice``. Files that aren't encoded in UTF-8 are"
+                  " parsed as a whole still. By default, no file is"
+                  " streamed.")
+def sutta_cross_ref_cmd(fallback_url, parser, dry_run, overwrite,
+                        incremental, filenames, link_cache, check_workers,
+                        check_host_limit, jobs, output_mode, stream_above):
     """Creates cross-references to suttas. Leaves existing references
     intact. Only affects HTML files.
     """
-    webpub.sutta_ref.cross_ref(filenames, fallback_url, dry_run, overwrite)
+    if stream_above is not None:
+        stream_above = int(stream_above * (1 << 20))
+    webpub.sutta_ref.cross_ref(
+        filenames, fallback_url, dry_run, overwrite, link_cache,
+        check_workers, check_host_limit, jobs,
+        manifest_path('.webpub-suttaref-manifest.json', incremental),
+        output_mode, get_profile(), parser, stream_above,
+        get_http_client()
+    )
+
+
+def set_passes(ctx, param, value):
+    selected = [name.strip() for name in value.split(',') if name.strip()]
+    for name in selected:
+        if name not in webpub.fix.passes:
+            raise click.BadParameter(
+                "unknown pass '{}', must be one of: {}.".format(
+                    name, ', '.join(webpub.fix.passes)
+                )
+            )
+    if not selected:
+        raise click.BadParameter("no passes given.")
+    return selected
+
+
+def set_pass_action_choice(name):
+    def callback(ctx, param, value):
+        if value is None:
+            return
+        ui_ctx = ctx.ensure_object(UserInterfaceContext)
+        ui_ctx.choices[name] = (value, True)
+    return callback
+
+
+@click.command()
+@walk_options(webpub.fix.fix_mime_handlers)
+@linkfix_crossref_common_options
+@rich_help_option('--with', 'selected', metavar='PASSES',
+                  default=','.join(webpub.fix.passes), callback=set_passes,
+                  rich_help="The passes to run over each file, separated by"
+                  " commas: ``linkfix`` fixes links as"
+                  " :manpage:`webpub-linkfix(1)` does, and ``suttaref``"
+                  " links sutta references as"
+                  " :manpage:`webpub-suttaref(1)` does. Defaults to both,"
+                  " in which case each document is read, parsed and"
+                  " written only once, with the links fixed first.")
+@click.option('--link-action',
+              type=click.Choice(
+                  list(webpub.linkfix.check.link_choices)),
+              callback=set_pass_action_choice('linkfix'),
+              expose_value=False,
+              help="The action to take when a broken link was found. " +
+              format_action_choice_help(
+                  webpub.linkfix.check.link_choices
+              ))
+@click.option('--sutta-action',
+              type=click.Choice(
+                  list(webpub.sutta_ref.sutta_ref_choices)),
+              callback=set_pass_action_choice('suttaref'),
+              expose_value=False,
+              help="The action to take when the link to a sutta is"
+              " broken. " + format_action_choice_help(
+                  webpub.sutta_ref.sutta_ref_choices
+              ))
+def fix_cmd(fallback_url, parser, dry_run, overwrite, incremental,
+            filenames, link_cache, check_workers, check_host_limit, jobs,
+            output_mode, selected):
+    """Fixes relative links among the given files and creates
+    cross-references to suttas in a single run, as webpub-linkfix and
+    webpub-suttaref would one after the other.
+    """
+    webpub.fix.fix_documents(
+        filenames, fallback_url, dry_run, overwrite, selected, link_cache,
+        check_workers, check_host_limit, jobs,
+        manifest_path('.webpub-fix-manifest.json', incremental),
+        output_mode, get_profile(), parser,
+        http_client=get_http_client()
+    )
+
+
+@click.command()
+@rich_help_option('--format', 'source_format',
+                  type=click.Choice(list(webpub.linkfix.index.index_sources)),
+                  default=None,
+                  rich_help="How to read SOURCE. ``tree`` snapshots a"
+                  " directory, ``sitemap`` reads the URLs in a sitemap XML"
+                  " file and ``list`` reads a file with one path or URL per"
+                  " line. Guessed from SOURCE if unspecified.")
+@rich_help_option('--casefold', default=False, is_flag=True,
+                  rich_help="Look up links case-insensitively.")
+@rich_help_option('--directory-index', metavar='NAME', default=None,
+                  rich_help="Only consider links to a directory working if"
+                  " the directory contains a file named NAME (e.g."
+                  " ``index.html``).")
+@rich_help_option('--base', metavar='URL', default=None,
+                  rich_help="The URL or path that is shown for links found"
+                  " in the index. Defaults to the absolute path of SOURCE"
+                  " for a ``tree``.")
+@rich_help_option('--verbose', '-v', count=True, expose_value=False,
+                  callback=set_verbosity,
+                  rich_help="Enable verbose output.")
+@click.argument('source', metavar='SOURCE',
+                type=click.Path(exists=True, file_okay=True, dir_okay=True,
+                                readable=True))
+@click.argument('index_filename', metavar='OUTFILE',
+                type=click.Path(dir_okay=False, writable=True))
+@ensure_ui_context
+def index_cmd(source_format, casefold, directory_index, base, source,
+              index_filename):
+    """Creates an index of the files on a site, to check links against
+    without touching the filesystem or the network. Pass OUTFILE as
+    --fallback-url to the other commands to use it. If OUTFILE ends
+    with .gz, it is compressed.
+    """
+    index = webpub.linkfix.index.make_index(
+        source, source_format, casefold, directory_index, base
+    )
+    index.save(index_filename)
+    echo("Indexed {} paths into {}".format(len(index), index_filename))
 
 
 if __name__ == '__main__':
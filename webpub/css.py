@@ -1,4 +1,7 @@
+import codecs
+import hashlib
 import os.path
+import re
 import functools as ft
 
 import css_parser
@@ -9,9 +12,118 @@ css_parser.ser.prefs.keepUsedNamespaceRulesOnly = True
 css_parser.ser.prefs.indentClosingBrace = False
 css_parser.ser.prefs.omitLastSemicolon = False
 
+# Comments and strings are matched as a whole, so that a url() within
+# them isn't taken for one. What's left of unterminated ones, or of
+# url() values that aren't understood, is matched as `bad`.
+css_url_token = re.compile(
+    rb"""/\*.*?\*/"""
+    rb"""|@import\s*(?P<import>"(?:[^"\\\n]|\\.)*"|'(?:[^'\\\n]|\\.)*')"""
+    rb"""|"(?:[^"\\\n]|\\.)*"|'(?:[^'\\\n]|\\.)*'"""
+    rb"""|(?<![\w\-\\])url\(\s*(?P<url>"(?:[^"\\\n]|\\.)*\""""
+    rb"""|'(?:[^'\\\n]|\\.)*'|[^"'()\s\\]*)\s*\)"""
+    rb"""|(?P<bad>(?<![\w\-\\])url\(|/\*|["'])""",
+    re.IGNORECASE | re.DOTALL
+)
+css_charset = re.compile(rb'@charset "([^"]*)";')
+css_unquoted_url_chars = re.compile(r'[^"\'()\s\\\x00-\x1f\x7f]*')
 
-def replace_urls(routes, filepath):
-    stylesheet = css_parser.parseFile(filepath)
+# Url tokens of stylesheets by the hash of their contents.
+_stylesheet_urls = {}
+
+
+class MalformedStylesheet(Exception):
+    """Raised if the url() values of a stylesheet can't be found
+    without parsing it."""
+
+
+def _check_encoding(style_bytes):
+    if style_bytes.startswith((codecs.BOM_UTF16_LE, codecs.BOM_UTF16_BE)):
+        raise MalformedStylesheet("stylesheet is encoded in UTF-16")
+    charset = css_charset.match(style_bytes.lstrip(codecs.BOM_UTF8))
+    if charset is not None and \
+            charset.group(1).decode('ascii', 'replace').lower() \
+            not in ('utf-8', 'utf8'):
+        raise MalformedStylesheet("stylesheet is encoded in {}".format(
+            charset.group(1).decode('ascii', 'replace')
+        ))
+
+
+def tokenize_urls(style_bytes):
+    """Returns the urls in the stylesheet, as `(start, end, quote, url)`
+    tuples of the span of the url value, including quotes, the quote
+    character (if any), and the url."""
+    _check_encoding(style_bytes)
+    urls = []
+    for m in css_url_token.finditer(style_bytes):
+        if m.group('bad') is not None:
+            raise MalformedStylesheet("unexpected {!r} at byte {}".format(
+                m.group('bad').decode('ascii'), m.start()
+            ))
+        group = 'import' if m.group('import') is not None else 'url'
+        if m.group(group) is None:
+            # A comment or string.
+            continue
+        start, end = m.span(group)
+        value = m.group(group)
+        quote = value[:1] if value[:1] in (b'"', b"'") else b''
+        if quote:
+            value = value[1:-1]
+        if b'\\' in value:
+            raise MalformedStylesheet(
+                "escaped url at byte {}".format(start)
+            )
+        try:
+            url = value.decode('utf-8')
+        except UnicodeDecodeError:
+            raise MalformedStylesheet(
+                "url at byte {} is not valid UTF-8".format(start)
+            )
+        urls.append((start, end, quote, url))
+    return urls
+
+
+def stylesheet_urls(style_bytes):
+    """Like `tokenize_urls`, but remembers the result by the hash of the
+    stylesheet, as the same stylesheet is often used in many places."""
+    digest = hashlib.sha1(style_bytes).digest()
+    urls = _stylesheet_urls.get(digest)
+    if urls is None:
+        urls = _stylesheet_urls[digest] = tokenize_urls(style_bytes)
+    return urls
+
+
+def _quote_url(url, quote):
+    if not quote:
+        if css_unquoted_url_chars.fullmatch(url):
+            return url.encode('utf-8')
+        quote = b'"'
+    q = quote.decode('ascii')
+    escaped = url.replace('\\', '\\\\').replace(q, '\\' + q) \
+        .replace('\n', '\\a ')
+    return quote + escaped.encode('utf-8') + quote
+
+
+def rewrite_urls(style_bytes, replace):
+    """Replaces the url() values and imports in the stylesheet by the
+    result of calling `replace` on them, leaving the rest of it as it
+    is. Raises `MalformedStylesheet` if they can't be found without
+    parsing the stylesheet."""
+    pieces = []
+    last = 0
+    for start, end, quote, url in stylesheet_urls(style_bytes):
+        new_url = replace(url)
+        if new_url == url:
+            continue
+        pieces.append(style_bytes[last:start])
+        pieces.append(_quote_url(new_url, quote))
+        last = end
+    if not pieces:
+        return style_bytes
+    pieces.append(style_bytes[last:])
+    return b''.join(pieces)
+
+
+def _replace_urls_parsed(stylesheet, routes, filepath):
     css_parser.replaceUrls(
         stylesheet,
         ft.partial(routed_url, filepath, routes)
@@ -19,11 +131,24 @@ def replace_urls(routes, filepath):
     return stylesheet.cssText
 
 
+def replace_urls(routes, filepath):
+    with open(filepath, 'rb') as f:
+        style_bytes = f.read()
+    try:
+        return rewrite_urls(
+            style_bytes, ft.partial(routed_url, filepath, routes)
+        )
+    except MalformedStylesheet:
+        stylesheet = css_parser.parseFile(filepath)
+        return _replace_urls_parsed(stylesheet, routes, filepath)
+
+
 def replace_urls_epub(epub_zip, routes, root_dir, filepath):
-    style_string = epub_zip.read(os.path.join(root_dir, filepath))
-    stylesheet = css_parser.parseString(style_string)
-    css_parser.replaceUrls(
-        stylesheet,
-        ft.partial(routed_url, filepath, routes)
-    )
-    return stylesheet.cssText
+    style_bytes = epub_zip.read(os.path.join(root_dir, filepath))
+    try:
+        return rewrite_urls(
+            style_bytes, ft.partial(routed_url, filepath, routes)
+        )
+    except MalformedStylesheet:
+        stylesheet = css_parser.parseString(style_bytes)
+        return _replace_urls_parsed(stylesheet, routes, filepath)
@@ -1 +1 @@
-from .epub import make_webbook # NOQA
+from .epub import make_webbook, EpubZip # NOQA
@@ -1,57 +1,45 @@
+import hashlib
 import os
+import zipfile as zf
 
 from lxml import etree
 
 from webpub.epub.transform_document import transform_document
 from webpub.epub.transform_toc import transform_toc
-from webpub.epub.template import render_template
+from webpub.epub.template import render_template, jinja2_env
+from webpub.epub.package import Package
 from webpub.css import replace_urls_epub
-from webpub.handlers import handle_routes, MimetypeRoute
+from webpub.handlers import handle_stages, MimetypeRoute, Stage
+from webpub.http import shared_client
 from webpub.util import (
-    reorder, ensure, copy_out, write_out, guard_dry_run, guard_overwrite
+    ensure, copy_out, write_out, guard_dry_run, guard_overwrite
 )
+from webpub.manifest import Manifest
+from webpub.sink import OutputSink
 from webpub.stats import global_stats
+from webpub.ui import echo
 
 
 ocf_namespace = {
     'ocf': 'urn:oasis:names:tc:opendocument:xmlns:container',
 }
 
-opf_namespaces = {
-    'opf': 'http://www.idpf.org/2007/opf',
-    'dc': 'http://purl.org/dc/elements/1.1/',
-}
 
+def _ensure_html_extension(path):
+    return './' + os.path.basename(os.path.splitext(path)[0] + '.html')
 
-def add_metadata(context, metadata):
-    meta_title = metadata.xpath(
-        './dc:title/text()',
-        namespaces=opf_namespaces
-    )
-    meta_author = metadata.xpath(
-        './dc:creator[@opf:role="aut"]/text()',
-        namespaces=opf_namespaces
-    )
-    context.setdefault('meta_title', meta_title[0] if meta_title else '')
-    context.setdefault('meta_author', meta_author[0] if meta_author else '')
 
+def _contents_html(path):
+    return './Contents.html'
 
-def get_toc_item(spine, manifest):
-    toc_ref = ensure(
-        spine.xpath('./@toc', namespaces=opf_namespaces),
-        "Spine section in EPUB package does not have a 'toc' attribute"
-    )
-    toc_item = ensure(
-        manifest.xpath('./opf:item[@id=$ref]', ref=toc_ref,
-                       namespaces=opf_namespaces),
-        "Couldn't find item in manifest for toc reference {}"
-        " in spine section.".format(toc_ref)
-    )
-    return toc_item
 
+# FIXME: dummy handler is necessary because guard handlers rely on
+# previous input.
+def no_input():
+    return None
 
-def _ensure_html_extension(path):
-    return './' + os.path.basename(os.path.splitext(path)[0] + '.html')
+
+no_input.verbosity = 2
 
 
 # Dict from mimetype media ranges to handlers and destination directory.
@@ -60,72 +48,129 @@ default_mime_to_dst_and_handlers = {
                   (transform_document, render_template,
                    guard_dry_run, guard_overwrite, write_out)),
     'application/xhtml+xml': 'text/html',
-    'application/x-dtbncx+xml': (lambda _: './Contents.html',
+    'application/x-dtbncx+xml': (_contents_html,
                                  (transform_toc, render_template,
                                   guard_dry_run, guard_overwrite, write_out)),
     'text/css': ('./css/', (replace_urls_epub, guard_dry_run, guard_overwrite,
                             write_out)),
-    # FIXME: dummy handler is necessary because guard handlers rely on
-    # previous input.
-    'image/*': ('./img/', (lambda: None, guard_dry_run, guard_overwrite,
+    'image/*': ('./img/', (no_input, guard_dry_run, guard_overwrite,
                            copy_out,)),
-    '*/*': ('./etc/', (lambda: None, guard_dry_run, guard_overwrite,
+    '*/*': ('./etc/', (no_input, guard_dry_run, guard_overwrite,
                        copy_out,))
 }
 
+# The table of contents collects the section titles, which the
+# documents need. Other files are copied in the meantime.
+webbook_stages = (
+    Stage('toc', transform_toc, None, ()),
+    Stage('documents', transform_document, 'processes', ('toc',)),
+    Stage('resources', None, 'threads', ()),
+)
+
+
+class EpubZip(object):
+    """The zip file of an EPUB, which is opened again by its file name in
+    worker processes, whether they were forked or were handed a pickled
+    copy, as they can't share the file with the parent process."""
+
+    def __init__(self, file):
+        self.filename = getattr(file, 'name', file)
+        self._zip = zf.ZipFile(file)
+        self._pid = os.getpid()
+
+    def _zipfile(self):
+        if self._pid != os.getpid():
+            self._zip = zf.ZipFile(self.filename)
+            self._pid = os.getpid()
+        return self._zip
+
+    def __getattr__(self, name):
+        return getattr(self._zipfile(), name)
+
+    def __getstate__(self):
+        return {'filename': self.filename, '_zip': None, '_pid': None}
+
+    def __setstate__(self, state):
+        # Without it, unpickling would look the method up through
+        # `__getattr__`, before there is a zip file to look it up on.
+        self.__dict__.update(state)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self._zip.close()
+
 
 class EpubMimetypeRoute(MimetypeRoute):
+    __slots__ = ()
+
     def get_mime_to_handlers(self):
         return default_mime_to_dst_and_handlers
 
 
-def epub_routes(manifest, spine, metadata, context):
-    spine_refs = spine.xpath(
-        './opf:itemref/@idref',
-        namespaces=opf_namespaces
-    )
-    toc_item = get_toc_item(spine, manifest)
-    toc_ref = toc_item.attrib['id']
-    toc_src = toc_item.attrib['href']
-    context.setdefault('src_to_title', {})[toc_src] = 'Contents'
+def epub_routes(package, context):
+    toc_item = package.toc_item
+    context.setdefault('src_to_title', {})[toc_item.src] = 'Contents'
     context.setdefault('routes', {})
-    context.setdefault('spine', [])
-    context.setdefault('toc_src', toc_src)
-
-    add_metadata(context, metadata)
+    context.setdefault('toc_src', toc_item.href)
+    context.setdefault('meta_title', package.title)
+    context.setdefault('meta_author', package.author)
 
-    for ref in [toc_ref] + spine_refs:
-        manifest_item = manifest.xpath(
-            './opf:item[@id=$ref]',
-            ref=ref, namespaces=opf_namespaces
-        )
-        if not manifest_item:
-            print(
-                "Warning: couldn't find item in manifest"
-                "for reference {} in spine section.".format(ref)
-            )
-            continue
-        manifest_item = manifest_item[0]
-        route = EpubMimetypeRoute(
-            manifest_item.attrib['href'],
-            context['output_dir'],
-            manifest_item.attrib['media-type']
+    for item in package.documents():
+        yield EpubMimetypeRoute(
+            item.href, context['output_dir'], item.media_type
         )
-        yield route
-        context['spine'].append(route.src)
-        manifest.remove(manifest_item)
 
-    context['spine'] = reorder(context['spine'], context['spine_order'])
+    package.set_reading_order(context['spine_order'])
 
-    remaining_items = manifest.xpath('./opf:item', namespaces=opf_namespaces)
-    for manifest_item in remaining_items:
+    for item in package.resources():
         yield EpubMimetypeRoute(
-            manifest_item.attrib['href'],
-            context['output_dir'],
-            manifest_item.attrib['media-type']
+            item.href, context['output_dir'], item.media_type
         )
 
 
+def zip_fingerprint(epub_zip, root_dir):
+    """Fingerprints files in the EPUB by their checksum and size, as
+    recorded in the zip file, instead of by reading them."""
+    def fingerprint(src, previous=None):
+        info = epub_zip.getinfo(os.path.join(root_dir, src))
+        return {
+            'digest': '{:08x}:{}'.format(info.CRC, info.file_size),
+            'stat': None,
+        }
+    return fingerprint
+
+
+def webbook_manifest(cli_context, epub_zip, root_dir, package_xml, toc_src):
+    template_source, _filename, _uptodate = jinja2_env.loader.get_source(
+        jinja2_env, cli_context.params['template']
+    )
+    options = {
+        'command': 'webpub',
+        'template': cli_context.params['template'],
+        'template_digest':
+            hashlib.sha1(template_source.encode()).hexdigest(),
+        'fallback_url': cli_context.params['fallback_url'],
+        'parser': cli_context.params['parser'],
+        'order': cli_context.meta.get('webpub.order'),
+        # The package determines the spine, and thereby the previous and
+        # next links of each document.
+        'package_digest': hashlib.sha1(package_xml).hexdigest(),
+        # The table of contents determines the section titles.
+        'toc_digest': zip_fingerprint(epub_zip, root_dir)(toc_src)['digest'],
+    }
+    manifest_path = os.path.join(
+        cli_context.params['output_dir'], '.webpub-manifest.json'
+    )
+    return Manifest(
+        manifest_path, options,
+        fingerprint=zip_fingerprint(epub_zip, root_dir),
+        # Processing the table of contents collects the section titles.
+        always=(toc_src,),
+    )
+
+
 def make_webbook(cli_context, epub_zip):
     root_path = None
     with epub_zip.open('META-INF/container.xml') as container_xml:
@@ -140,24 +185,9 @@ def make_webbook(cli_context, epub_zip):
     )
     root_dir = os.path.dirname(root_path)
 
-    with epub_zip.open(root_path) as package_xml:
-        package_tree = etree.parse(package_xml)
-        metadata = package_tree.xpath(
-            '/opf:package/opf:metadata',
-            namespaces=opf_namespaces
-        )
-        manifest = package_tree.xpath(
-            '/opf:package/opf:manifest',
-            namespaces=opf_namespaces
-        )
-        spine = package_tree.xpath(
-            '/opf:package/opf:spine',
-            namespaces=opf_namespaces
-        )
-
-    metadata = ensure(metadata, "No metadata section found in EPUB package.")
-    manifest = ensure(manifest, "No manifest section found in EPUB package.")
-    spine = ensure(spine, "No spine section found in EPUB package.")
+    with epub_zip.open(root_path) as package_file:
+        package_xml = package_file.read()
+    package = Package.parse(package_xml)
 
     global_stats.exclude('changed')
 
@@ -171,6 +201,28 @@ def make_webbook(cli_context, epub_zip):
         'fallback_url': cli_context.params['fallback_url'],
         'dry_run': cli_context.params['dry_run'],
         'overwrite': cli_context.params['overwrite'],
+        'package': package,
+        'profile': cli_context.meta.get('webpub.profile'),
+        'parser': cli_context.params['parser'],
     }
-    routes = epub_routes(manifest, spine, metadata, context)
-    handle_routes(routes, context)
+    incremental = cli_context.params['incremental']
+    if incremental:
+        context['manifest'] = webbook_manifest(
+            cli_context, epub_zip, root_dir, package_xml,
+            package.toc_item.src
+        )
+    jobs = cli_context.params['jobs']
+    if jobs > 1 and not os.path.isfile(epub_zip.filename or ''):
+        echo("Processing one file at a time, as the EPUB can't be opened"
+             " again by worker processes.")
+        jobs = 1
+    routes = epub_routes(package, context)
+    try:
+        with OutputSink() as output_sink, shared_client(
+                cli_context.meta.get('webpub.http_client')) as client:
+            context['output_sink'] = output_sink
+            context['session'] = client
+            handle_stages(routes, context, webbook_stages, jobs)
+    finally:
+        if incremental and not context['dry_run']:
+            context['manifest'].save(context['routes'])
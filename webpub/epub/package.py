@@ -0,0 +1,137 @@
+from collections import namedtuple
+import os
+
+from lxml import etree
+
+from webpub.util import ensure, reorder
+
+opf_namespaces = {
+    'opf': 'http://www.idpf.org/2007/opf',
+    'dc': 'http://purl.org/dc/elements/1.1/',
+}
+
+PackageItem = namedtuple(
+    'PackageItem', ['id', 'href', 'src', 'media_type']
+)
+
+
+def _first(element, path):
+    result = element.xpath(path, namespaces=opf_namespaces)
+    return result[0] if result else ''
+
+
+class Package(object):
+    """The package document of an EPUB, parsed once. Items of the
+    manifest are looked up by their id or by their path, and documents
+    in the reading order by their neighbours."""
+
+    def __init__(self, items, spine_refs, toc_ref, title='', author=''):
+        self.items = items
+        self.by_id = {item.id: item for item in items}
+        self.by_src = {item.src: item for item in items}
+        self.spine_refs = spine_refs
+        self.toc_ref = toc_ref
+        self.title = title
+        self.author = author
+        self.reading_order = []
+        self._documents = None
+        self._neighbours = {}
+
+    @classmethod
+    def parse(cls, package_xml):
+        root = etree.fromstring(package_xml)
+        metadata = ensure(
+            root.xpath('/opf:package/opf:metadata',
+                       namespaces=opf_namespaces),
+            "No metadata section found in EPUB package."
+        )
+        manifest = ensure(
+            root.xpath('/opf:package/opf:manifest',
+                       namespaces=opf_namespaces),
+            "No manifest section found in EPUB package."
+        )
+        spine = ensure(
+            root.xpath('/opf:package/opf:spine', namespaces=opf_namespaces),
+            "No spine section found in EPUB package."
+        )
+        toc_ref = ensure(
+            spine.xpath('./@toc'),
+            "Spine section in EPUB package does not have a 'toc' attribute"
+        )
+        items = [
+            PackageItem(
+                item.get('id'), item.get('href'),
+                os.path.normpath(item.get('href')), item.get('media-type')
+            )
+            for item in manifest.iterfind('{%s}item' % opf_namespaces['opf'])
+        ]
+        spine_refs = [
+            itemref.get('idref')
+            for itemref in spine.iterfind(
+                '{%s}itemref' % opf_namespaces['opf']
+            )
+        ]
+        return cls(
+            items, spine_refs, toc_ref,
+            title=_first(metadata, './dc:title/text()'),
+            author=_first(metadata, './dc:creator[@opf:role="aut"]/text()'),
+        )
+
+    @property
+    def toc_item(self):
+        item = self.by_id.get(self.toc_ref)
+        if item is None:
+            raise Exception(
+                "Couldn't find item in manifest for toc reference {}"
+                " in spine section.".format(self.toc_ref)
+            )
+        return item
+
+    def documents(self):
+        """The table of contents and the items of the spine, in the order
+        of the spine. References to items that aren't in the manifest
+        are left out, with a warning."""
+        if self._documents is None:
+            self._documents = []
+            seen = set()
+            for ref in [self.toc_ref] + self.spine_refs:
+                item = self.by_id.get(ref)
+                if item is None or ref in seen:
+                    print(
+                        "Warning: couldn't find item in manifest"
+                        "for reference {} in spine section.".format(ref)
+                    )
+                    continue
+                seen.add(ref)
+                self._documents.append(item)
+        return self._documents
+
+    def resources(self):
+        """The items that aren't documents, in the order of the
+        manifest."""
+        documents = {item.id for item in self.documents()}
+        return [item for item in self.items if item.id not in documents]
+
+    def stylesheets(self):
+        return [
+            item.src for item in self.items if item.media_type == 'text/css'
+        ]
+
+    def set_reading_order(self, order):
+        """Puts the documents in the reading `order`, as used by
+        `reorder`, and determines the neighbours of each."""
+        self.reading_order = reorder(
+            [item.src for item in self.documents()], order
+        )
+        self._neighbours = {}
+        for i, src in enumerate(self.reading_order):
+            self._neighbours[src] = (
+                self.reading_order[i - 1] if i > 0 else None,
+                self.reading_order[i + 1]
+                if i < len(self.reading_order) - 1 else None,
+            )
+
+    def neighbours(self, src):
+        """The previous and next document of `src` in the reading
+        order."""
+        return self._neighbours[src]
@@ -3,7 +3,7 @@ import os
 from jinja2 import Environment, ChoiceLoader, PackageLoader, FileSystemLoader
 from lxml import html
 
-from webpub.route import routed_url
+from webpub.route import routed_url, route_index
 
 
 jinja2_env = Environment(
@@ -14,12 +14,10 @@ jinja2_env = Environment(
 )
 
 
-def render_template(template, input, filepath, spine,
+def render_template(template, input, filepath, package,
                     routes, toc_src,
                     section_title, meta_title, meta_author):
-    spine_index = spine.index(filepath)
-    prev_src = spine[spine_index - 1] if spine_index > 0 else None
-    next_src = spine[spine_index + 1] if spine_index < len(spine) - 1 else None
+    prev_src, next_src = package.neighbours(filepath)
     context = {
         'prev_url': prev_src,
         'next_url': next_src,
@@ -34,7 +32,9 @@ def render_template(template, input, filepath, spine,
     for src_k in ('prev_url', 'next_url', 'toc_url'):
         src = context[src_k]
         if src:
-            src = routed_url(filepath, routes, os.path.relpath(src, filedir))
+            src = routed_url(
+                filepath, routes, route_index.relpath(src, filedir)
+            )
         context[src_k] = src
 
     for tag in ('head', 'body'):
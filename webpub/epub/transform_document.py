@@ -1,40 +1,50 @@
 import os
 
-import requests
-import html5_parser as html5
-from inxs import (
-    lxml_utils, Rule, MatchesXPath, Transformation
-)
+from lxml import etree
+from inxs import lxml_utils, Transformation
 
-from webpub.sutta_ref import (
-    link_sutta_references, sutta_ref_xpath, add_re_namespace
-)
-from webpub.route import route_url
-from webpub.util import has_link
+from webpub.http import shared_client
+from webpub.parse import parse_document
+from webpub.sutta_ref import crossref_tree
+from webpub.route import route_urls
+from webpub.util import per_thread
+
+title_elements = etree.XPath('descendant-or-self::*[local-name()="title"]')
 
 
 def remove_from_tree(element):
     lxml_utils.remove_elements(element)
 
 
-def transform_document(routes, root_dir, epub_zip, filepath, currentpath,
-                       stats, fallback_url):
-    context = locals().copy()
-    context.pop('epub_zip', None)
-
-    transformation = Transformation(
-        add_re_namespace,
-        Rule("title", remove_from_tree),
-        Rule(has_link, route_url),
-        Rule(MatchesXPath(sutta_ref_xpath), link_sutta_references),
-        context=context,
-    )
+def remove_titles(root):
+    for element in title_elements(root):
+        remove_from_tree(element)
+
+
+def link_sutta_references(root, stats, session, fallback_url):
+    crossref_tree(root, stats, session, fallback_url)
 
-    with epub_zip.open(os.path.join(root_dir, filepath)) as doc_xml:
-        doc_tree = html5.parse(doc_xml.read(), fallback_encoding='utf-8')
 
-    with requests.Session() as s:
-        return transformation(doc_tree, session=s)
+# Built once for each thread, the values for each document are passed
+# when calling it.
+document_transformation = per_thread(lambda: Transformation(
+    remove_titles,
+    route_urls,
+    link_sutta_references,
+))
+
+
+def transform_document(routes, root_dir, epub_zip, filepath, currentpath,
+                       stats, fallback_url, session=None, parser='auto'):
+    with epub_zip.open(os.path.join(root_dir, filepath)) as doc_xml:
+        doc_tree = parse_document(doc_xml.read(), parser)
+
+    with shared_client(session) as client:
+        return document_transformation()(
+            doc_tree, copy=False, routes=routes, filepath=filepath,
+            currentpath=currentpath, stats=stats, session=client,
+            fallback_url=fallback_url
+        )
 
 
 transform_document.verbose_name = "Apply transformations"
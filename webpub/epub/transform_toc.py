@@ -2,16 +2,20 @@ from collections import namedtuple
 import os.path
 
 from lxml import etree
-from inxs import Rule, Any, MatchesAttributes, Transformation
+from inxs import Transformation
 import inxs.lib
 
-from webpub.route import route_url, routed_url
-from webpub.util import reorder
+from webpub.route import route_urls, routed_url
+from webpub.util import reorder, per_thread
 
 ncx_namespace = {
     'ncx': "http://www.daisy.org/z3986/2005/ncx/",
 }
 
+nav_points = etree.XPath(
+    'descendant-or-self::*[local-name()="navPoint"]'
+)
+
 
 def set_titles(element, src_to_title):
     src = element.xpath('./ncx:content/@src', namespaces=ncx_namespace)[0]
@@ -20,14 +24,20 @@ def set_titles(element, src_to_title):
     src_to_title[src] = title
 
 
-def make_toc_skeleton(context, filepath, routes, section_title, elmaker):
+def set_all_titles(root, src_to_title):
+    for element in nav_points(root):
+        set_titles(element, src_to_title)
+
+
+def make_toc_skeleton(context, filepath, routes, package, section_title,
+                      elmaker):
     context.html = elmaker.html(
         elmaker.head(*[
             elmaker.link(
                 href=routed_url(filepath, routes, item),
                 rel="stylesheet", type="text/css"
             )
-            for item in routes.keys() if item.endswith('.css')
+            for item in package.stylesheets()
         ]),
         elmaker.body(
             elmaker.div(
@@ -104,39 +114,37 @@ def indent(contents_div, level=0):
             elem.tail = i
 
 
-def transform_toc(routes, toc_order, src_to_title, root_dir, epub_zip,
-                  section_title, filepath):
-    context = locals().copy()
-    context.pop('epub_zip', None)
-    context.pop('toc_order', None)
-
-    transformation = Transformation(
-        inxs.lib.init_elementmaker(
-            name='elmaker',
-        ),
-        make_toc_skeleton,
-        Rule('navPoint', set_titles),
-        Rule(
-            Any(MatchesAttributes({'href': None}),
-                MatchesAttributes({'src': None}),),
-            route_url,
-        ),
-        make_toc,
-        list_contents,
-        indent,
-        result_object='context.html',
-        context=context
-    )
+# Built once for each thread, the values for each document are passed
+# when calling it.
+toc_transformation = per_thread(lambda: Transformation(
+    inxs.lib.init_elementmaker(
+        name='elmaker',
+    ),
+    make_toc_skeleton,
+    set_all_titles,
+    route_urls,
+    make_toc,
+    list_contents,
+    indent,
+    result_object='context.html',
+))
+
 
+def transform_toc(routes, toc_order, src_to_title, root_dir, epub_zip,
+                  package, section_title, filepath):
     with epub_zip.open(os.path.join(root_dir, filepath)) as doc_xml:
         parser = etree.XMLParser(remove_blank_text=True)
         doc_tree = etree.parse(doc_xml, parser)
     root = doc_tree.getroot()
 
-    return transformation(
+    return toc_transformation()(
         root,
+        routes=routes,
         src_to_title=src_to_title,
         toc_order=toc_order,
+        package=package,
+        section_title=section_title,
+        filepath=filepath,
     )
 
 
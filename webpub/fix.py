@@ -0,0 +1,203 @@
+"""Fixes links and links sutta references in one run, instead of running
+webpub-linkfix and webpub-suttaref one after the other. Each document is
+read, parsed, serialized and written only once, and both passes check
+their links with the same session and link check cache."""
+import contextlib
+import itertools as it
+import os
+
+from webpub.handlers import (
+    handle_routes, stream_routes, is_up_to_date, ConstDestMimetypeRoute,
+    AbortHandling
+)
+from webpub.http import shared_client
+from webpub.manifest import Manifest
+from webpub.parse import parse_document
+from webpub.linkfix.cache import LinkCheckCache
+from webpub.linkfix.linkfix import (
+    LinkFixRoute, linkfix_document, linkfix_mime_handlers, fix_links,
+    collect_link_checks, path_url_raw_prefilter
+)
+from webpub.linkfix.check import is_cacheable_fallback
+from webpub.linkfix.prefetch import prefetch_link_checks
+from webpub.splice import CombinedEdits, ElementEdits, splice_or_tostring
+from webpub.sutta_ref import (
+    CrossRefRoute, crossref_document, crossref_tree, text_edits,
+    collect_sutta_ref_urls, sutta_ref_raw_prefilter
+)
+from webpub.ui import get_ui_context
+from webpub.util import (
+    write_out, guard_unchanged, guard_dry_run, guard_overwrite,
+    raw_matches
+)
+
+# The passes, in the order in which they are run over a document. Links
+# are fixed first, so that the links to suttas that are added aren't
+# checked twice.
+passes = ('linkfix', 'suttaref')
+
+
+def prefilter_fix(currentpath):
+    with open(currentpath, mode='rb') as doc:
+        raw = doc.read()
+    if not raw_matches(raw, path_url_raw_prefilter) \
+            and not raw_matches(raw, sutta_ref_raw_prefilter):
+        raise AbortHandling(
+            "File {} has no links to check or sutta references".format(
+                os.path.relpath(currentpath)
+            ), verbosity=1
+        )
+    return raw
+
+
+prefilter_fix.verbose_name = "Look for links and sutta references"
+prefilter_fix.verbosity = 2
+
+
+def fix_document(input, routes, filepath, currentpath, stats,
+                 fallback_url, session=None, link_cache=None,
+                 output_mode='serialize', parser='auto'):
+    doc_tree = parse_document(input, parser)
+    has_links = raw_matches(input, path_url_raw_prefilter)
+    has_sutta_refs = raw_matches(input, sutta_ref_raw_prefilter)
+    element_edits = sutta_ref_edits = None
+    if output_mode == 'splice':
+        # Both are made before either pass changes the tree.
+        if has_links:
+            element_edits = ElementEdits(input, doc_tree)
+        if has_sutta_refs:
+            sutta_ref_edits = text_edits(input, doc_tree)
+
+    ui_ctx = get_ui_context()
+    with shared_client(session) as session:
+        if has_links:
+            with ui_ctx.choosing('linkfix'):
+                doc_tree = fix_links(
+                    doc_tree, session, routes, filepath, currentpath,
+                    stats, fallback_url, link_cache
+                )
+        if has_sutta_refs:
+            with ui_ctx.choosing('suttaref'):
+                crossref_tree(
+                    doc_tree, stats, session, fallback_url, link_cache,
+                    sutta_ref_edits
+                )
+    if output_mode == 'splice':
+        return CombinedEdits(input, doc_tree, [
+            edits for edits in (element_edits, sutta_ref_edits)
+            if edits is not None
+        ])
+    return doc_tree
+
+
+fix_document.verbose_name = "Fix links and link sutta references"
+
+
+fix_mime_handlers = {
+    'text/html': (prefilter_fix, fix_document, guard_unchanged,
+                  guard_dry_run, guard_overwrite, splice_or_tostring,
+                  write_out),
+    'text/css': linkfix_mime_handlers['text/css'],
+    'application/xhtml+xml': 'text/html',
+    '*/*': (),
+}
+
+
+class FixRoute(ConstDestMimetypeRoute):
+    __slots__ = ()
+
+    def get_mime_to_handlers(self):
+        return fix_mime_handlers
+
+
+# The routes for each selection of passes. A single pass is run as by
+# its own command.
+pass_routes = {
+    ('linkfix',): LinkFixRoute,
+    ('suttaref',): CrossRefRoute,
+    passes: FixRoute,
+}
+
+
+def fix_routes(filenames, route_class):
+    for root_dir, src in filenames:
+        yield route_class(src, root_dir)
+
+
+def _link_checks(routes, selected, context):
+    """The `(url_path, fallback_url)` pairs that the selected passes
+    check in the documents that are handled."""
+    fallback_url = context['fallback_url']
+    parser = context['parser']
+    checks = []
+    for route in routes:
+        handlers = route.handlers
+        if not ({linkfix_document, crossref_document, fix_document}
+                & set(handlers)) or is_up_to_date(route, context):
+            continue
+        if 'linkfix' in selected:
+            checks.append(
+                collect_link_checks(route.src, fallback_url, parser)
+            )
+        if 'suttaref' in selected:
+            checks.append(
+                (url, fallback_url)
+                for url in collect_sutta_ref_urls(route.src, parser)
+            )
+    return it.chain.from_iterable(checks)
+
+
+def fix_documents(filenames, fallback_url, dry_run, overwrite,
+                  selected=passes, link_cache=None, check_workers=0,
+                  check_per_host=4, jobs=1, manifest_path=None,
+                  output_mode='serialize', profile=None, parser='auto',
+                  http_client=None):
+    """Runs the `selected` passes over the files."""
+    selected = tuple(name for name in passes if name in selected)
+    context = {
+        'dry_run': dry_run,
+        'overwrite': overwrite,
+        'output_mode': output_mode,
+        'output_dir': '.',
+        'fallback_url': fallback_url,
+        'link_cache': link_cache,
+        'jobs': jobs,
+        'profile': profile,
+        'parser': parser,
+    }
+    if manifest_path is not None:
+        context['manifest'] = Manifest(manifest_path, {
+            'command': 'fix',
+            'passes': list(selected),
+            'fallback_url': fallback_url,
+            'parser': parser,
+        })
+    routes = fix_routes(filenames, pass_routes[selected])
+    ui_ctx = get_ui_context()
+    with contextlib.ExitStack() as stack:
+        context['session'] = client = stack.enter_context(
+            shared_client(http_client)
+        )
+        if check_workers >= 1 and is_cacheable_fallback(fallback_url):
+            # First check all links concurrently, so that the passes
+            # only need to look up the results.
+            routes = list(routes)
+            if link_cache is None:
+                context['link_cache'] = LinkCheckCache()
+            prefetch_link_checks(
+                _link_checks(routes, selected, context),
+                context['link_cache'], check_workers, check_per_host,
+                client
+            )
+        if len(selected) == 1:
+            # Otherwise, the document handler chooses for each pass.
+            stack.enter_context(ui_ctx.choosing(selected[0]))
+        try:
+            if manifest_path is None:
+                stream_routes(routes, context)
+            else:
+                # The manifest compares the whole route table.
+                handle_routes(routes, context)
+        finally:
+            if manifest_path is not None and not dry_run:
+                context['manifest'].save(context['routes'])
@@ -1,29 +1,95 @@
-from collections import OrderedDict, ChainMap
+from collections import OrderedDict, deque, namedtuple
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+import contextlib
 import dependency_injection
+import io
+import itertools as it
 import mimetypes
 import mimeparse
 import os
+import pickle
+import time
 
 import click
 
-from webpub.ui import echo
-from webpub.stats import global_stats
+from webpub.ui import echo, get_ui_context, DeferredPrompt
+from webpub.stats import global_stats, GlobalStats
+from webpub.manifest import RecordingRoutes
+from webpub.profile import Profile, input_size
+
+
+_guessed_mimetypes = {}
+
+
+def guess_mimetype(src):
+    """Like `mimetypes.guess_type`, but cached by the extensions of the
+    file name, which is all that it depends on."""
+    basename = src.rpartition(os.sep)[2]
+    dot = basename.find('.')
+    extensions = basename[dot:] if dot > 0 else ''
+    mimetype = _guessed_mimetypes.get(extensions)
+    if mimetype is None:
+        mimetype = _guessed_mimetypes[extensions] = \
+            mimetypes.guess_type('file' + extensions)[0] or '*/*'
+    return mimetype
+
+
+class MimeDispatch(object):
+    """Dispatch table from media ranges to handlers. Aliases are
+    resolved once, and the best match for each mimetype is looked up
+    only the first time."""
+
+    def __init__(self, mime_to_handlers):
+        self.media_ranges = list(mime_to_handlers.keys())
+        self.table = {}
+        for media_range, str_or_tup in mime_to_handlers.items():
+            while isinstance(str_or_tup, str):
+                str_or_tup = mime_to_handlers[str_or_tup]
+            self.table[media_range] = str_or_tup
+        self._matches = {}
+
+    def __getitem__(self, mimetype):
+        match = self._matches.get(mimetype)
+        if match is None:
+            match = self._matches[mimetype] = self.table[
+                mimeparse.best_match(self.media_ranges, mimetype)
+            ]
+        return match
+
+
+_dispatches = {}
+
+
+def mime_dispatch(mime_to_handlers):
+    """Returns the dispatch table for a dict from media ranges to
+    handlers, compiling it the first time."""
+    table, dispatch = _dispatches.get(id(mime_to_handlers), (None, None))
+    if table is not mime_to_handlers:
+        dispatch = MimeDispatch(mime_to_handlers)
+        _dispatches[id(mime_to_handlers)] = (mime_to_handlers, dispatch)
+    return dispatch
 
 
 class Route(object):
+    __slots__ = ('src', 'output_dir', '_mimetype', '_routed_dst')
+
     def __init__(self, src, output_dir=None, mimetype=None):
         self.src = os.path.normpath(src)
         self.output_dir = output_dir
         self._mimetype = mimetype
+        self._routed_dst = None
 
     def get_dst(self):
         raise NotImplementedError()
 
     @property
     def dst(self):
-        if self.output_dir is None:
-            return self.get_dst()
-        return os.path.normpath(os.path.join(self.output_dir, self.get_dst()))
+        if self._routed_dst is None:
+            dst = self.get_dst()
+            if self.output_dir is not None:
+                dst = os.path.normpath(os.path.join(self.output_dir, dst))
+            self._routed_dst = dst
+        return self._routed_dst
 
     @property
     def handlers(self):
@@ -31,22 +97,27 @@ class Route(object):
 
     @property
     def mimetype(self):
-        return self._mimetype or mimetypes.guess_type(self.src)[0] or '*/*'
+        if self._mimetype is None:
+            self._mimetype = guess_mimetype(self.src)
+        return self._mimetype
 
 
 class MimetypeRoute(Route):
+    __slots__ = ('_handlers',)
+
+    def __init__(self, src, output_dir=None, mimetype=None):
+        super().__init__(src, output_dir, mimetype)
+        self._handlers = None
+
     def get_mime_to_handlers(self):
         raise NotImplementedError()
 
     def get_handlers(self):
-        mimetype_handlers = self.get_mime_to_handlers()
-        mime_match = mimeparse.best_match(
-            mimetype_handlers.keys(), self.mimetype
-        )
-        str_or_tup = mimetype_handlers[mime_match]
-        while isinstance(str_or_tup, str):
-            str_or_tup = mimetype_handlers[str_or_tup]
-        return str_or_tup
+        if self._handlers is None:
+            self._handlers = mime_dispatch(
+                self.get_mime_to_handlers()
+            )[self.mimetype]
+        return self._handlers
 
     def get_dst(self):
         dst, _handlers = self.get_handlers()
@@ -62,11 +133,16 @@ class MimetypeRoute(Route):
 
 
 class ConstDestMimetypeRoute(MimetypeRoute):
+    __slots__ = ('_dst',)
+
     def __init__(self, src, root_dir, output_dir=None, mimetype=None):
-        if output_dir is None:
+        in_place = output_dir is None
+        if in_place:
             output_dir = root_dir
         super().__init__(os.path.join(root_dir, src), output_dir, mimetype)
         self._dst = src
+        if in_place:
+            self._routed_dst = self.src
 
     def get_dst(self):
         return self._dst
@@ -76,6 +152,17 @@ class ConstDestMimetypeRoute(MimetypeRoute):
         return self.get_handlers()
 
 
+def has_handlers(mime_to_handlers):
+    """Returns a predicate of whether a `ConstDestMimetypeRoute` with
+    this dict from media ranges to handlers would have any handlers for
+    a file, judging by its name, without making a route for it."""
+    dispatch = mime_dispatch(mime_to_handlers)
+
+    def handled(src):
+        return bool(dispatch[guess_mimetype(src)])
+    return handled
+
+
 class AbortHandling(Exception):
     """Aborts handlers."""
 
@@ -89,26 +176,290 @@ class SkipHandler(Exception):
     """Skips the current handler and continues to the next one."""
 
 
-def _apply_handlers(handlers, context):
-    echo(click.style(os.path.relpath(context['filepath']), fg='yellow'))
-    for handler in handlers:
-        kwargs = dependency_injection.resolve_dependencies(
-            handler, context
-        ).as_kwargs
+class Pipeline(object):
+    """A tuple of handlers, compiled for applying them to many files. The
+    parameters, name and verbosity of each handler are looked up once,
+    instead of for every file."""
+
+    def __init__(self, handlers):
+        self.handlers = handlers
+        self.steps = tuple(
+            (
+                handler,
+                dependency_injection.get_signature(handler).parameters,
+                getattr(handler, "verbose_name", handler.__name__),
+                getattr(handler, "verbosity", 1),
+            )
+            for handler in handlers
+        )
 
-        handler_verbosity = getattr(handler, "verbosity", 1)
-        handler_name = getattr(handler, "verbose_name", handler.__name__)
-        echo("\n - {}".format(handler_name), verbosity=handler_verbosity)
+    def __call__(self, context):
+        verbosity = get_ui_context().verbosity
+        filepath = context['filepath']
+        echo(click.style(os.path.relpath(filepath), fg='yellow'))
+        profile = context.get('profile')
+        if profile is not None:
+            profile.record_file(
+                filepath, guess_mimetype(filepath), input_size(context)
+            )
+        for handler, parameters, handler_name, handler_verbosity \
+                in self.steps:
+            # Parameters that aren't in the context keep their default.
+            kwargs = {
+                name: context[name] for name in parameters if name in context
+            }
+            if verbosity >= handler_verbosity:
+                click.echo("\n - {}".format(handler_name))
+
+            if profile is not None:
+                wall, cpu = time.perf_counter(), time.process_time()
+            try:
+                context['input'] = handler(**kwargs)
+            except SkipHandler:
+                continue
+            except AbortHandling as e:
+                echo(str(e), verbosity=e.verbosity)
+                break
+            finally:
+                if profile is not None:
+                    profile.record(
+                        filepath, handler_name,
+                        time.perf_counter() - wall,
+                        time.process_time() - cpu
+                    )
+
+        input = context.pop('input', None)
+        if hasattr(input, 'close'):
+            # A file that a handler passed on, if a later one aborted.
+            input.close()
+
+
+_pipelines = {}
+
+
+def compile_handlers(handlers):
+    """Returns the pipeline for a tuple of handlers, compiling it the
+    first time."""
+    pipeline = _pipelines.get(handlers)
+    if pipeline is None:
+        pipeline = _pipelines[handlers] = Pipeline(handlers)
+    return pipeline
 
+
+def _apply_handlers(handlers, context):
+    compile_handlers(handlers)(context)
+
+
+def _handle_file(handlers, src, context, stats=global_stats,
+                 record_routes=False):
+    """Applies the handlers to `src`. If `record_routes` is set, returns
+    the routes that were looked up while doing so, and the files that
+    were checked."""
+    routes = context['routes']
+    recording = contextlib.nullcontext()
+    if record_routes:
+        routes = recording = RecordingRoutes(routes)
+    with recording, stats.scope(src) as file_stats:
+        local_context = {
+            'filepath': src,
+            'currentpath': src,
+            'section_title': context['src_to_title'].get(src, ''),
+            'stats': file_stats,
+            'routes': routes,
+        }
+        # A copy is quicker to look things up in than a ChainMap.
+        full_context = dict(context)
+        full_context.update(local_context)
+        _apply_handlers(handlers, full_context)
+    if record_routes:
+        return routes.accessed
+    return None
+
+
+def _is_up_to_date(src, context):
+    manifest = context.get('manifest')
+    if manifest is None or not manifest.is_up_to_date(src, context['routes']):
+        return False
+    echo(click.style(os.path.relpath(src), fg='yellow') + " is up to date",
+         verbosity=2)
+    global_stats.add('skipped', src)
+    return True
+
+
+def is_up_to_date(route, context):
+    """Whether the manifest knows `route` to be up to date, judging only
+    by its own route. Used before the route table is complete."""
+    manifest = context.get('manifest')
+    if manifest is None:
+        return False
+    return manifest.is_up_to_date(route.src, {route.src: route.dst})
+
+
+def _record_in_manifest(src, deps, context):
+    manifest = context.get('manifest')
+    if manifest is None:
+        return
+    statistics = global_stats.statistics
+    if src in statistics.get('failed', ()):
+        return
+    if src not in statistics.get('saved', ()):
+        # Files that weren't written are only up to date if they didn't
+        # need to be changed.
+        if 'changed' in global_stats.excluded \
+                or src in statistics.get('changed', ()):
+            return
+    manifest.record(src, deps)
+
+
+_worker_context = None
+_worker_pickled_context = None
+
+
+def _init_worker(context, ui_ctx, excluded_stats):
+    global _worker_context
+    # Prompts can't be answered in a worker, files that need one are
+    # handled again by the parent process afterwards.
+    ui_ctx.defer_prompts = True
+    click_ctx = click.Context(click.Command('webpub-worker'), obj=ui_ctx)
+    click_ctx.scope(cleanup=False).__enter__()
+    _worker_context = (context, excluded_stats)
+
+
+def _handle_files_in_worker(tasks, pickled_context=None):
+    global _worker_context, _worker_pickled_context
+    context, excluded_stats = _worker_context
+    if pickled_context is not None \
+            and pickled_context != _worker_pickled_context:
+        context = pickle.loads(pickled_context)
+        _worker_context = (context, excluded_stats)
+        _worker_pickled_context = pickled_context
+    results = []
+    for handlers, src, dst in tasks:
+        file_stats = GlobalStats(include=[], exclude=excluded_stats)
+        output = io.StringIO()
+        if context.get('profile') is not None:
+            context['profile'] = Profile()
         try:
-            context['input'] = handler(**kwargs)
-        except SkipHandler:
+            with contextlib.redirect_stdout(output), \
+                    _own_route(context['routes'], src, dst):
+                deps = _handle_file(
+                    handlers, src, context, file_stats,
+                    record_routes=context['record_routes']
+                )
+        except DeferredPrompt:
+            results.append((src, None, None, None, None))
             continue
-        except AbortHandling as e:
-            echo(str(e), verbosity=e.verbosity)
-            break
-
-    context.pop('input', None)
+        profiled = context['profile'].files \
+            if context.get('profile') is not None else None
+        results.append((
+            src, file_stats.statistics, output.getvalue(), deps, profiled
+        ))
+    return results
+
+
+def _chunks(iterable, size):
+    iterator = iter(iterable)
+    chunk = list(it.islice(iterator, size))
+    while chunk:
+        yield chunk
+        chunk = list(it.islice(iterator, size))
+
+
+def _worker_context_of(context):
+    worker_context = dict(context)
+    worker_context.pop('global_stats', None)
+    worker_context.pop('manifest', None)
+    # Workers write their output themselves, before they return.
+    worker_context.pop('output_sink', None)
+    # The HTTP client in 'session' is passed on, workers open
+    # connections of their own with it.
+    if worker_context.get('profile') is not None:
+        # Workers profile each file on their own, the parent merges them.
+        worker_context['profile'] = Profile()
+    worker_context['record_routes'] = context.get('manifest') is not None
+    return worker_context
+
+
+def _worker_pool(jobs, context=None):
+    return ProcessPoolExecutor(
+        max_workers=jobs, initializer=_init_worker,
+        initargs=(context, get_ui_context(), global_stats.excluded)
+    )
+
+
+def _start_worker_pool(jobs):
+    """Starts a pool of `jobs` worker processes right away, before any
+    threads are started that the forked workers would copy the state
+    of. The context is passed to the workers with the tasks."""
+    executor = _worker_pool(jobs)
+    executor.submit(int).result()
+    return executor
+
+
+def _handle_files_in_parallel(tasks, context, jobs, chunksize,
+                              executor=None):
+    """Handles the `(handlers, src, dst)` tasks in worker processes, of
+    `executor` if given. Tasks are taken from the iterable as the
+    workers need them, and the results are merged in order."""
+    worker_context = _worker_context_of(context)
+    deferred = []
+    in_flight = deque()
+
+    def merge_next():
+        chunk, future = in_flight.popleft()
+        for task, (src, statistics, output, deps, profiled) in zip(
+                chunk, future.result()):
+            if statistics is None:
+                deferred.append(task)
+                continue
+            click.echo(output, nl=False)
+            global_stats.merge(statistics)
+            if profiled is not None:
+                context['profile'].merge(profiled)
+            _record_in_manifest(src, deps, context)
+
+    if executor is None:
+        pool = _worker_pool(jobs, worker_context)
+        pickled_context = None
+    else:
+        pool = contextlib.nullcontext(executor)
+        # The workers were started before the context was complete.
+        pickled_context = pickle.dumps(worker_context)
+    with pool as executor:
+        for chunk in _chunks(tasks, chunksize):
+            if len(in_flight) >= jobs * 4:
+                merge_next()
+            in_flight.append((chunk, executor.submit(
+                _handle_files_in_worker, chunk, pickled_context
+            )))
+        while in_flight:
+            merge_next()
+
+    for handlers, src, dst in deferred:
+        with _own_route(context['routes'], src, dst):
+            _handle_and_record(handlers, src, context)
+
+
+@contextlib.contextmanager
+def _own_route(routes, src, dst):
+    """Adds the route of `src` for as long as it's handled, if it isn't
+    in the route table already."""
+    if src in routes:
+        yield
+        return
+    routes[src] = dst
+    try:
+        yield
+    finally:
+        del routes[src]
+
+
+def _handle_and_record(handlers, src, context):
+    record_routes = context.get('manifest') is not None
+    deps = _handle_file(
+        handlers, src, context, record_routes=record_routes
+    )
+    _record_in_manifest(src, deps, context)
 
 
 def handle_routes(routes, context):
@@ -122,16 +473,127 @@ def handle_routes(routes, context):
         context['routes'][src] = route.dst
         handlers_with_input.setdefault(handlers, []).append(src)
 
-    for handlers, srcs in handlers_with_input.items():
+    tasks = [
+        (handlers, src, context['routes'][src])
+        for handlers, srcs in handlers_with_input.items() if handlers
+        for src in srcs if not _is_up_to_date(src, context)
+    ]
+
+    jobs = context.get('jobs', 1)
+    if jobs > 1:
+        _handle_files_in_parallel(
+            tasks, context, jobs,
+            chunksize=max(1, min(64, len(tasks) // (jobs * 4)))
+        )
+        return
+
+    for handlers, src, _dst in tasks:
+        _handle_and_record(handlers, src, context)
+
+
+# A stage handles the files with `handler` among their handlers, or all
+# remaining files if it's `None`, once the stages named in `after` are
+# done. Its files are handled one at a time, or on worker processes or
+# threads if `pool` is 'processes' or 'threads'.
+Stage = namedtuple('Stage', ['name', 'handler', 'pool', 'after'])
+
+
+def _push_click_context(click_ctx):
+    # Threads don't share the context of the thread that started them.
+    click.globals.push_context(click_ctx)
+
+
+def handle_stages(routes, context, stages, jobs=1):
+    """Like `handle_routes`, but handles the files in `stages`, which
+    are run in the order given, and in which each stage comes after
+    those in its `after`. Stages on threads run in the background, while
+    the next stages run, until a stage that comes after them starts.
+    Those that come after no other stage start right away."""
+    context.setdefault('global_stats', global_stats)
+    context.setdefault('routes', {})
+    context.setdefault('src_to_title', {})
+    stage_tasks = OrderedDict((stage.name, []) for stage in stages)
+    for route in routes:
+        src = route.src
+        handlers = route.handlers
+        context['routes'][src] = route.dst
         if not handlers:
             continue
-        for src in srcs:
-            with global_stats.scope(src) as file_stats:
-                local_context = {
-                    'filepath': src,
-                    'currentpath': src,
-                    'section_title': context['src_to_title'].get(src, ''),
-                    'stats': file_stats,
-                }
-                full_context = ChainMap(local_context, context)
-                _apply_handlers(handlers, full_context)
+        stage = next(
+            stage for stage in stages
+            if stage.handler is None or stage.handler in handlers
+        )
+        stage_tasks[stage.name].append((handlers, src, route.dst))
+
+    if jobs > 1 and any(stage.pool == 'processes' and stage_tasks[stage.name]
+                        for stage in stages):
+        processes = _start_worker_pool(jobs)
+    else:
+        processes = contextlib.nullcontext()
+    background = {}
+    with processes, ThreadPoolExecutor(
+            max_workers=jobs, initializer=_push_click_context,
+            initargs=(click.get_current_context(),)
+    ) as threads:
+        def run(stage):
+            tasks = [
+                task for task in stage_tasks[stage.name]
+                if not _is_up_to_date(task[1], context)
+            ]
+            if jobs > 1 and stage.pool == 'threads':
+                background[stage.name] = [
+                    threads.submit(
+                        _handle_and_record, handlers, src, context
+                    )
+                    for handlers, src, _dst in tasks
+                ]
+            elif jobs > 1 and stage.pool == 'processes' and tasks:
+                _handle_files_in_parallel(
+                    tasks, context, jobs,
+                    chunksize=max(1, min(64, len(tasks) // (jobs * 4))),
+                    executor=processes
+                )
+            else:
+                for handlers, src, _dst in tasks:
+                    _handle_and_record(handlers, src, context)
+
+        started = set()
+        if jobs > 1:
+            for stage in stages:
+                if stage.pool == 'threads' and not stage.after:
+                    run(stage)
+                    started.add(stage.name)
+        for stage in stages:
+            if stage.name in started:
+                continue
+            for name in stage.after:
+                for future in background.pop(name, ()):
+                    future.result()
+            run(stage)
+        for futures in background.values():
+            for future in futures:
+                future.result()
+
+
+def stream_routes(routes, context):
+    """Like `handle_routes`, but handles each route as soon as it's
+    yielded, instead of building the route table first. Only the route
+    of the file itself is in the route table while it's handled, so
+    this is only for routes of files that are changed in place, and not
+    for incremental builds."""
+    context.setdefault('global_stats', global_stats)
+    context.setdefault('routes', {})
+    context.setdefault('src_to_title', {})
+    tasks = (
+        (route.handlers, route.src, route.dst)
+        for route in routes if route.handlers
+    )
+
+    jobs = context.get('jobs', 1)
+    if jobs > 1:
+        _handle_files_in_parallel(tasks, context, jobs, chunksize=8)
+        return
+
+    for handlers, src, dst in tasks:
+        with _own_route(context['routes'], src, dst):
+            _handle_and_record(handlers, src, context)
@@ -0,0 +1,224 @@
+"""The HTTP client that links are checked against a fallback URL with.
+
+A single client is shared by all documents of a run, so that connections
+to the fallback server are kept alive from one document to the next,
+instead of being opened again for each of them. Requests time out, are
+retried with backoff when they fail or the server is overloaded, and can
+be limited to a number of requests per second to each host.
+
+"""
+import contextlib
+import os
+import threading
+import time
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.connectionpool import port_by_scheme
+from urllib3.util.retry import Retry
+from urllib3.util.url import parse_url
+
+# Responses after which a request is tried again: too many requests, and
+# errors of (or in front of) the server that may well be temporary.
+retry_statuses = (429, 500, 502, 503, 504)
+
+# Responses to a HEAD request after which the link is checked with a GET
+# request instead, from servers that don't allow HEAD requests.
+head_not_allowed_statuses = (405, 501)
+
+
+def _host_of(url):
+    url = parse_url(url)
+    scheme = url.scheme or 'http'
+    return scheme, url.host, url.port or port_by_scheme.get(scheme)
+
+
+class RateLimiter(object):
+    """Spaces the requests to each host at least `1 / rate` seconds
+    apart. Hosts are `(scheme, host, port)` tuples, as urllib3 pools
+    connections by."""
+
+    def __init__(self, rate):
+        self.interval = 1 / rate
+        self._next = {}
+        self._lock = threading.Lock()
+
+    def wait(self, host):
+        with self._lock:
+            now = time.monotonic()
+            at = max(now, self._next.get(host, now))
+            self._next[host] = at + self.interval
+        if at > now:
+            time.sleep(at - now)
+
+
+class RateLimitedRetry(Retry):
+    """Waits for `rate_limiter` before each retry as well. Retries are
+    made by urllib3 itself, without passing through the adapter."""
+
+    rate_limiter = None
+    _host = None
+
+    def new(self, **kwargs):
+        retry = super().new(**kwargs)
+        retry.rate_limiter = self.rate_limiter
+        retry._host = self._host
+        return retry
+
+    def increment(self, *args, **kwargs):
+        retry = super().increment(*args, **kwargs)
+        pool = kwargs.get('_pool')
+        if pool is not None:
+            retry._host = (pool.scheme, pool.host, pool.port)
+        return retry
+
+    def sleep(self, response=None):
+        super().sleep(response)
+        if self.rate_limiter is not None and self._host is not None:
+            self.rate_limiter.wait(self._host)
+
+
+class RateLimitedAdapter(HTTPAdapter):
+    """Waits for `rate_limiter` before each request, redirects
+    included."""
+
+    def __init__(self, rate_limiter=None, **kwargs):
+        self.rate_limiter = rate_limiter
+        super().__init__(**kwargs)
+
+    def send(self, request, *args, **kwargs):
+        if self.rate_limiter is not None:
+            self.rate_limiter.wait(_host_of(request.url))
+        return super().send(request, *args, **kwargs)
+
+
+class HttpClient(object):
+    """Checks URLs with HEAD requests, over a pool of at most `pool_size`
+    connections to each host, which are shared by all threads.
+
+    Each request times out after `timeout` seconds. Failed requests, and
+    those answered with one of `retry_statuses`, are retried up to
+    `retries` times, waiting `backoff` seconds before the first retry
+    and twice as long before each next one (or as long as the server
+    asks to). If `rate` is given, at most that many requests per second
+    are made to each host, by each process, counting retries and
+    redirects.
+
+    The client can be passed to worker processes, which open connections
+    of their own.
+
+    """
+
+    def __init__(self, pool_size=10, timeout=10, retries=3, backoff=0.5,
+                 rate=None, get_fallback=True):
+        self.pool_size = pool_size
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.rate = rate
+        self.get_fallback = get_fallback
+        self._rate_limiter = RateLimiter(rate) if rate else None
+        self._adapter = None
+        self._pid = None
+        self._local = threading.local()
+        self._sessions = []
+        self._lock = threading.Lock()
+
+    def __getstate__(self):
+        return {
+            'pool_size': self.pool_size,
+            'timeout': self.timeout,
+            'retries': self.retries,
+            'backoff': self.backoff,
+            'rate': self.rate,
+            'get_fallback': self.get_fallback,
+        }
+
+    def __setstate__(self, state):
+        self.__init__(**state)
+
+    @property
+    def adapter(self):
+        with self._lock:
+            if self._adapter is not None and self._pid != os.getpid():
+                # The connections were inherited from the parent process,
+                # and can't be used in this (worker) process.
+                self._adapter = None
+                self._local = threading.local()
+                self._sessions = []
+            if self._adapter is None:
+                retry = RateLimitedRetry(
+                    total=self.retries,
+                    backoff_factor=self.backoff,
+                    status_forcelist=retry_statuses,
+                    allowed_methods=frozenset(('HEAD', 'GET')),
+                    respect_retry_after_header=True,
+                    raise_on_status=False,
+                )
+                retry.rate_limiter = self._rate_limiter
+                self._adapter = RateLimitedAdapter(
+                    rate_limiter=self._rate_limiter,
+                    pool_connections=self.pool_size,
+                    pool_maxsize=self.pool_size,
+                    max_retries=retry,
+                )
+                self._pid = os.getpid()
+            return self._adapter
+
+    @property
+    def session(self):
+        """The session of the current thread. Sessions can't be shared
+        between threads, but their connection pool is."""
+        adapter = self.adapter
+        session = getattr(self._local, 'session', None)
+        if session is None:
+            session = self._local.session = requests.Session()
+            session.mount('http://', adapter)
+            session.mount('https://', adapter)
+            with self._lock:
+                self._sessions.append(session)
+        return session
+
+    def _request(self, method, url, **kwargs):
+        kwargs.setdefault('timeout', self.timeout)
+        kwargs.setdefault('allow_redirects', True)
+        return self.session.request(method, url, **kwargs)
+
+    def head(self, url, **kwargs):
+        """Requests the headers of `url`, following redirects. If the
+        server doesn't allow HEAD requests, and `get_fallback` is set,
+        makes a GET request instead, of which only the headers are
+        read."""
+        response = self._request('HEAD', url, **kwargs)
+        if self.get_fallback \
+                and response.status_code in head_not_allowed_statuses:
+            response = self._request('GET', url, stream=True, **kwargs)
+            response.close()
+        return response
+
+    def close(self):
+        with self._lock:
+            sessions, self._sessions = self._sessions, []
+            adapter, self._adapter = self._adapter, None
+            self._local = threading.local()
+        for session in sessions:
+            session.close()
+        if adapter is not None:
+            adapter.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_t, exc_v, traceback):
+        self.close()
+
+
+@contextlib.contextmanager
+def shared_client(client=None):
+    """Yields `client`, or a new client that is closed afterwards if it's
+    `None`."""
+    if client is not None:
+        yield client
+        return
+    with HttpClient() as client:
+        yield client
@@ -0,0 +1,144 @@
+import multiprocessing.util
+import os
+import sqlite3
+import time
+from urllib.parse import urldefrag
+
+
+def default_cache_path():
+    cache_home = os.environ.get('XDG_CACHE_HOME') or \
+        os.path.expanduser('~/.cache')
+    return os.path.join(cache_home, 'webpub', 'linkcheck.sqlite')
+
+
+class LinkCheckCache(object):
+    """Remembers the results of checking links against a fallback.
+
+    Results are always kept in memory for the duration of the run. If a
+    filename is given, they're also stored in an SQLite database so
+    they can be reused by later runs. Working and broken links expire
+    after `ttl` and `negative_ttl` seconds respectively.
+
+    """
+
+    commit_every = 100
+
+    def __init__(self, filename=None, ttl=7 * 24 * 3600, negative_ttl=3600,
+                 refresh=False):
+        self.filename = filename
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.refresh = refresh
+        self._entries = {}
+        self._db = None
+        self._db_pid = None
+        self._pending = []
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_db'] = None
+        state['_pending'] = []
+        return state
+
+    @property
+    def db(self):
+        if self._db is not None and self._db_pid != os.getpid():
+            # The connection was inherited from the parent process, and
+            # can't be used in this (worker) process.
+            self._db = None
+        if self._db is None and self.filename is not None:
+            dirname = os.path.dirname(self.filename)
+            if dirname:
+                os.makedirs(dirname, exist_ok=True)
+            self._db = sqlite3.connect(self.filename, timeout=30)
+            # Let other processes read while one of them is writing.
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS link_checks ("
+                " fallback TEXT NOT NULL,"
+                " path TEXT NOT NULL,"
+                " working INTEGER NOT NULL,"
+                " link TEXT NOT NULL,"
+                " msg TEXT NOT NULL,"
+                " checked REAL NOT NULL,"
+                " PRIMARY KEY (fallback, path))"
+            )
+            self._db_pid = os.getpid()
+            # Worker processes don't get to close their copy of the
+            # cache, so make sure pending results are written on exit.
+            multiprocessing.util.Finalize(self, self.close, exitpriority=10)
+        return self._db
+
+    @staticmethod
+    def _key(fallback_url, url_path):
+        return (fallback_url, urldefrag(url_path).url)
+
+    def _is_expired(self, working, checked, now):
+        ttl = self.ttl if working else self.negative_ttl
+        return now - checked > ttl
+
+    def get(self, fallback_url, url_path):
+        """Returns a `(working, link, msg)` tuple, or `None` if the link
+        wasn't checked yet or its result has expired."""
+        key = self._key(fallback_url, url_path)
+        entry = self._entries.get(key)
+        if entry is None and not self.refresh and self.db is not None:
+            entry = self.db.execute(
+                "SELECT working, link, msg, checked FROM link_checks"
+                " WHERE fallback = ? AND path = ?", key
+            ).fetchone()
+            if entry is not None:
+                self._entries[key] = entry
+
+        if entry is None:
+            return None
+        working, link, msg, checked = entry
+        if self._is_expired(working, checked, time.time()):
+            return None
+        return (bool(working), link, msg)
+
+    def set(self, fallback_url, url_path, working, link, msg):
+        key = self._key(fallback_url, url_path)
+        entry = (int(working), link, msg, time.time())
+        self._entries[key] = entry
+        if self.filename is not None:
+            # Writes are batched, and written in a short transaction, so
+            # that concurrent processes don't wait on each other.
+            self._pending.append(key + entry)
+            if len(self._pending) >= self.commit_every:
+                self.commit()
+
+    def prune(self):
+        """Removes expired entries, returns the number of entries
+        removed."""
+        now = time.time()
+        self._entries = {
+            key: entry for key, entry in self._entries.items()
+            if not self._is_expired(entry[0], entry[3], now)
+        }
+        if self.db is None:
+            return 0
+        with self.db:
+            cursor = self.db.execute(
+                "DELETE FROM link_checks"
+                " WHERE (working AND checked < ?)"
+                " OR (NOT working AND checked < ?)",
+                (now - self.ttl, now - self.negative_ttl)
+            )
+        return cursor.rowcount
+
+    def commit(self):
+        if self._pending and self.db is not None:
+            with self.db:
+                self.db.executemany(
+                    "INSERT OR REPLACE INTO link_checks"
+                    " (fallback, path, working, link, msg, checked)"
+                    " VALUES (?, ?, ?, ?, ?, ?)", self._pending
+                )
+        self._pending = []
+
+    def close(self):
+        self.commit()
+        if self._db is not None:
+            self._db.close()
+            self._db = None
@@ -1,5 +1,5 @@
 import os
-from urllib.parse import urlparse, urlunparse, urljoin, urldefrag
+from urllib.parse import urlunparse, urljoin, urldefrag
 
 import requests
 import click
@@ -7,6 +7,9 @@ import inxs.lxml_utils
 
 import webpub.ui
 import webpub.util
+from webpub.http import retry_statuses
+from webpub.linkfix.index import is_index_file, load_index
+from webpub.manifest import record_file_dep
 
 
 def _ignore(*args, **kwargs):
@@ -45,38 +48,96 @@ link_choices = {
 def _check_link_against_path_fallback(url_path, session, fallback_url):
     url_path = urldefrag(url_path).url
     new_path = os.path.normpath(fallback_url + '/' + url_path)
-    webpub.ui.echo(
-        "Checking path: {}".format(new_path), verbosity=2
-    )
-    if os.path.exists(new_path):
+    exists = os.path.exists(new_path)
+    # Files that link to it are processed again when this changes.
+    record_file_dep(new_path, exists)
+    if exists:
         return (True, new_path, "File exists")
     return (False, new_path, "File does not exist")
 
 
+_check_link_against_path_fallback.verbose_name = "path"
+# Files on disk change between runs, and checking them is as cheap as a
+# lookup in the link check cache, so they aren't remembered.
+_check_link_against_path_fallback.cacheable = False
+
+
 def _check_link_against_url_fallback(url_path, session, fallback_url):
     check_url = urljoin(fallback_url, url_path)
-    webpub.ui.echo(
-        "Checking URL: {}".format(check_url), verbosity=2
-    )
-    response = session.head(check_url, allow_redirects=True)
+    response = session.head(check_url)
     msg = "Status code: " + str(response.status_code)
+    if response.status_code in retry_statuses:
+        # The server still wasn't available after retrying, which says
+        # nothing about the link, so it's left unchecked like when the
+        # server couldn't be reached.
+        raise requests.HTTPError(msg, response=response)
     if response.status_code == requests.codes.ok:
         return (True, check_url, msg)
     return (False, check_url, msg)
 
 
-def check_link_against_fallback(url_path, session, fallback_url=None):
-    link = fallback_url
-    link_checker = _check_link_against_url_fallback
-    msg = "N/A"
+_check_link_against_url_fallback.verbose_name = "URL"
+
+
+def _check_link_against_index_fallback(url_path, session, fallback_url):
+    return load_index(fallback_url).check(url_path)
+
+
+_check_link_against_index_fallback.verbose_name = "index"
+# Lookups in the index are as cheap as lookups in the link check cache.
+_check_link_against_index_fallback.cacheable = False
+
 
+def get_link_checker(fallback_url):
+    """Returns the function that checks links against `fallback_url`.
+    The returned function doesn't produce any output, so it may be
+    called from other threads."""
     if fallback_url is None:
         raise ValueError("Tried checking without fallback url")
 
+    if is_index_file(fallback_url):
+        return _check_link_against_index_fallback
     if webpub.util.is_path(fallback_url):
-        link_checker = _check_link_against_path_fallback
+        return _check_link_against_path_fallback
+    return _check_link_against_url_fallback
+
+
+def is_cacheable_fallback(fallback_url):
+    """Whether the results of checking links against `fallback_url` are
+    remembered in the link check cache, and so worth checking ahead."""
+    return fallback_url is not None \
+        and getattr(get_link_checker(fallback_url), 'cacheable', True)
+
+
+def check_link_against_fallback(url_path, session, fallback_url=None,
+                                link_cache=None):
+    link_checker = get_link_checker(fallback_url)
+    if not is_cacheable_fallback(fallback_url):
+        link_cache = None
+
+    result = None
+    if link_cache is not None:
+        result = link_cache.get(fallback_url, url_path)
+
+    if result is None:
+        try:
+            result = link_checker(url_path, session, fallback_url)
+        except requests.RequestException as e:
+            # Not remembered, so that the link is checked again later.
+            result = (False, urljoin(fallback_url, url_path),
+                      "Request failed: {}".format(e))
+        else:
+            if link_cache is not None:
+                link_cache.set(fallback_url, url_path, *result)
+        webpub.ui.echo("Checking {}: {}".format(
+            link_checker.verbose_name, result[1]
+        ), verbosity=2)
+    else:
+        webpub.ui.echo(
+            "Using cached result for: {}".format(url_path), verbosity=2
+        )
 
-    working, link, msg = link_checker(url_path, session, fallback_url)
+    working, link, msg = result
 
     result_status = working and "OK   " or "ERROR"
     webpub.ui.echo("{status} {link} ({msg})".format(
@@ -87,7 +148,8 @@ def check_link_against_fallback(url_path, session, fallback_url=None):
     return (working, link)
 
 
-def check_and_fix_link(element, session, currentpath, stats, fallback_url=None):
+def check_and_fix_link(element, session, currentpath, stats, fallback_url=None,
+                       link_cache=None):
     old_url = None
     try:
         attrib, old_url = webpub.util.matched_url(element)
@@ -98,18 +160,18 @@ def check_and_fix_link(element, session, currentpath, stats, fallback_url=None):
         os.path.relpath(currentpath), element.sourceline
     )
     while element is not None:
-        old_url = element.attrib[attrib]
-        old_url = urlparse(old_url)
+        classified = webpub.util.classify_url(element.attrib[attrib])
+        old_url = classified.url
 
-        if not webpub.util.is_path(old_url):
+        if not classified.is_path:
             return element
 
-        if webpub.util.is_relative(old_url):
+        if classified.is_relative:
             fallback_url = os.path.dirname(currentpath)
 
         try:
             working, _link = check_link_against_fallback(
-                old_url.path, session, fallback_url
+                old_url.path, session, fallback_url, link_cache
             )
         except ValueError:
             return element
@@ -0,0 +1,200 @@
+import functools as ft
+import gzip
+import os
+import posixpath
+from urllib.parse import urldefrag, urlparse, unquote
+
+from lxml import etree
+
+index_magic = '# webpub-index 1'
+
+sitemap_namespace = {
+    'sm': 'http://www.sitemaps.org/schemas/sitemap/0.9',
+}
+
+
+def _open_index(filename, mode):
+    if filename.endswith('.gz'):
+        return gzip.open(filename, mode + 't', encoding='utf-8')
+    return open(filename, mode, encoding='utf-8')
+
+
+def _normalize(path):
+    path = posixpath.normpath('/' + unquote(path).lstrip('/'))
+    # normpath keeps a leading double slash
+    return '/' + path.lstrip('/')
+
+
+class FallbackIndex(object):
+    """A snapshot of the files that exist on a fallback site, which links
+    are checked against instead of the filesystem or a server.
+
+    The paths are root-relative and stored sorted, one per line, after a
+    header line with the options the index was built with. Directories
+    are stored with a trailing slash. If `directory_index` is set, a
+    link to a directory only works if the directory contains a file
+    with that name, like a web server would serve it.
+
+    """
+
+    def __init__(self, paths=(), casefold=False, directory_index=None,
+                 base=''):
+        self.casefold = casefold
+        self.directory_index = directory_index
+        self.base = base
+        self.paths = set()
+        for path in paths:
+            self.add(path)
+
+    def _key(self, path):
+        if self.casefold:
+            return path.casefold()
+        return path
+
+    def add(self, path):
+        is_dir = path.endswith('/')
+        path = _normalize(path)
+        if is_dir and path != '/':
+            path += '/'
+        self.paths.add(self._key(path))
+        # Record parent directories as well.
+        dirname = posixpath.dirname(path.rstrip('/'))
+        while dirname != '/':
+            key = self._key(dirname + '/')
+            if key in self.paths:
+                break
+            self.paths.add(key)
+            dirname = posixpath.dirname(dirname)
+
+    def __len__(self):
+        return len(self.paths)
+
+    def __contains__(self, url_path):
+        url_path = urldefrag(url_path).url
+        path = self._key(_normalize(url_path))
+        if not url_path.endswith('/') and path in self.paths:
+            return True
+        dir_path = path.rstrip('/') + '/'
+        if dir_path == '/' or dir_path in self.paths:
+            if self.directory_index is None:
+                return True
+            return self._key(dir_path + self.directory_index) in self.paths
+        return False
+
+    def check(self, url_path):
+        link = self.base.rstrip('/') + _normalize(urldefrag(url_path).url)
+        if url_path in self:
+            return (True, link, "Found in index")
+        return (False, link, "Not found in index")
+
+    def save(self, filename):
+        header = [index_magic, 'casefold={:d}'.format(self.casefold)]
+        if self.directory_index is not None:
+            header.append('directory_index=' + self.directory_index)
+        if self.base:
+            header.append('base=' + self.base)
+        with _open_index(filename, 'w') as f:
+            f.write(' '.join(header) + '\n')
+            for path in sorted(self.paths):
+                f.write(path + '\n')
+
+    @classmethod
+    def load(cls, filename):
+        with _open_index(filename, 'r') as f:
+            header = f.readline()
+            if not header.startswith(index_magic):
+                raise ValueError(
+                    "{} is not a webpub index file".format(filename)
+                )
+            options = dict(
+                option.split('=', 1)
+                for option in header[len(index_magic):].split()
+            )
+            index = cls(
+                casefold=options.get('casefold') == '1',
+                directory_index=options.get('directory_index'),
+                base=options.get('base', ''),
+            )
+            # Paths are stored normalized already.
+            index.paths = {line.rstrip('\n') for line in f}
+            index.paths.discard('')
+        return index
+
+
+def is_index_file(path):
+    if path is None:
+        return False
+    return _is_index_file(path)
+
+
+@ft.lru_cache(maxsize=None)
+def _is_index_file(path):
+    try:
+        with open(path, 'rb') as f:
+            start = f.read(len(index_magic) + 2)
+    except OSError:
+        return False
+    if start[:2] == b'\x1f\x8b':
+        try:
+            with gzip.open(path, 'rb') as f:
+                start = f.read(len(index_magic))
+        except OSError:
+            return False
+    return start.startswith(index_magic.encode())
+
+
+@ft.lru_cache(maxsize=None)
+def load_index(filename):
+    return FallbackIndex.load(filename)
+
+
+def paths_from_tree(root):
+    for dirpath, dirnames, filenames in os.walk(root):
+        reldir = os.path.relpath(dirpath, root)
+        if reldir == '.':
+            reldir = ''
+        reldir = reldir.replace(os.sep, '/')
+        for dirname in dirnames:
+            yield posixpath.join(reldir, dirname) + '/'
+        for filename in filenames:
+            yield posixpath.join(reldir, filename)
+
+
+def paths_from_sitemap(filename):
+    tree = etree.parse(filename)
+    for loc in tree.iterfind('.//sm:url/sm:loc', namespaces=sitemap_namespace):
+        if loc.text:
+            yield urlparse(loc.text.strip()).path
+
+
+def paths_from_list(filename):
+    with open(filename, encoding='utf-8') as f:
+        for line in f:
+            line = line.strip()
+            if line and not line.startswith('#'):
+                yield urlparse(line).path
+
+
+def guess_source_format(source):
+    if os.path.isdir(source):
+        return 'tree'
+    if source.endswith('.xml'):
+        return 'sitemap'
+    return 'list'
+
+
+index_sources = {
+    'tree': paths_from_tree,
+    'sitemap': paths_from_sitemap,
+    'list': paths_from_list,
+}
+
+
+def make_index(source, source_format=None, casefold=False,
+               directory_index=None, base=None):
+    if source_format is None:
+        source_format = guess_source_format(source)
+    if base is None:
+        base = os.path.abspath(source) if source_format == 'tree' else ''
+    paths = index_sources[source_format](source)
+    return FallbackIndex(paths, casefold, directory_index, base)
@@ -1,39 +1,123 @@
-import requests
-import html5_parser as html5
-from inxs import Rule, Transformation
+import itertools as it
+import os
+import re
+
+import lxml.etree
+from inxs import Transformation
 
 from webpub.css import replace_urls
-from webpub.handlers import handle_routes, ConstDestMimetypeRoute
+from webpub.handlers import (
+    handle_routes, stream_routes, is_up_to_date, ConstDestMimetypeRoute,
+    AbortHandling
+)
+from webpub.http import shared_client
+from webpub.manifest import Manifest
+from webpub.parse import parse_document
+from webpub.splice import ElementEdits, splice_or_tostring
 from webpub.util import (
-    tostring, write_out, guard_unchanged, guard_dry_run, guard_overwrite,
-    has_link, has_path_url
+    write_out, guard_unchanged, guard_dry_run, guard_overwrite,
+    link_elements, has_path_url, element_url,
+    read_if_matches, per_thread
 )
-from webpub.linkfix.check import check_and_fix_link
+from webpub.linkfix.cache import LinkCheckCache
+from webpub.linkfix.check import check_and_fix_link, is_cacheable_fallback
+from webpub.linkfix.prefetch import prefetch_link_checks
 from webpub.ui import echo
 
 
-def linkfix_document(routes, filepath, currentpath, stats, fallback_url):
-    context = locals().copy()
-    context.pop('stats', None)
+# An href or src attribute of which the value may be a path, i.e. it
+# isn't empty and doesn't start with a fragment, a query, a scheme or
+# "//". Entities are left alone, so they always match.
+path_url_raw_prefilter = re.compile(
+    rb"""\s(?:href|src)\s*=\s*["']?\s*"""
+    rb"""(?!["'#?>\s]|//|[a-z][a-z0-9+.\-]*:)""",
+    re.IGNORECASE
+)
+
+
+def prefilter_linkfix(currentpath):
+    raw = read_if_matches(currentpath, path_url_raw_prefilter)
+    if raw is None:
+        raise AbortHandling(
+            "File {} has no links to check".format(
+                os.path.relpath(currentpath)
+            ), verbosity=1
+        )
+    return raw
+
+
+prefilter_linkfix.verbose_name = "Look for links"
+prefilter_linkfix.verbosity = 2
+
+
+def check_and_fix_links(root, session, currentpath, stats, fallback_url,
+                        link_cache):
+    for element in link_elements(root):
+        if has_path_url(element, None):
+            check_and_fix_link(
+                element, session, currentpath, stats, fallback_url,
+                link_cache
+            )
 
-    transformation = Transformation(
-        Rule([has_link, has_path_url], check_and_fix_link),
-        context=context,
+
+# Built once for each thread, the values for each document are passed
+# when calling it.
+linkfix_transformation = per_thread(
+    lambda: Transformation(check_and_fix_links)
+)
+
+
+def fix_links(doc_tree, session, routes, filepath, currentpath, stats,
+              fallback_url, link_cache=None):
+    """Fixes the links in the parsed document `doc_tree`, in place."""
+    # Transform the tree itself, which edits may have taken a snapshot
+    # of.
+    return linkfix_transformation()(
+        doc_tree, copy=False, session=session, currentpath=currentpath,
+        stats=stats, fallback_url=fallback_url, link_cache=link_cache
     )
 
-    with open(currentpath, mode='rb') as doc:
-        doc_tree = html5.parse(doc.read(), fallback_encoding='utf-8')
 
-    with requests.Session() as s:
-        return transformation(doc_tree, session=s, stats=stats)
+def linkfix_document(input, routes, filepath, currentpath, stats,
+                     fallback_url, session=None, link_cache=None,
+                     output_mode='serialize', parser='auto'):
+    doc_tree = parse_document(input, parser)
+    edits = None
+    if output_mode == 'splice':
+        edits = ElementEdits(input, doc_tree)
+
+    with shared_client(session) as session:
+        doc_tree = fix_links(doc_tree, session, routes, filepath,
+                             currentpath, stats, fallback_url, link_cache)
+    return edits or doc_tree
 
 
 linkfix_document.verbose_name = "Fix links"
 
 
+def collect_link_checks(currentpath, fallback_url, parser='auto'):
+    """Yields the `(url_path, fallback_url)` pairs that
+    `check_and_fix_link` checks against `fallback_url` when fixing the
+    links in the given document. Relative links are checked against the
+    files on disk, which isn't worth doing ahead."""
+    raw = read_if_matches(currentpath, path_url_raw_prefilter)
+    if raw is None:
+        return
+    doc_tree = parse_document(raw, parser)
+
+    for element in doc_tree.iter(lxml.etree.Element):
+        try:
+            attrib, url = element_url(element)
+        except ValueError:
+            continue
+        if url.is_path and not url.is_relative:
+            yield url.url.path, fallback_url
+
+
 linkfix_mime_handlers = {
-    'text/html': (linkfix_document, guard_unchanged, guard_dry_run,
-                  guard_overwrite, tostring, write_out),
+    'text/html': (prefilter_linkfix, linkfix_document, guard_unchanged,
+                  guard_dry_run, guard_overwrite, splice_or_tostring,
+                  write_out),
     'text/css': (replace_urls, guard_unchanged, guard_dry_run, guard_overwrite,
                  write_out),
     'application/xhtml+xml': 'text/html',
@@ -42,6 +126,8 @@ linkfix_mime_handlers = {
 
 
 class LinkFixRoute(ConstDestMimetypeRoute):
+    __slots__ = ()
+
     def get_mime_to_handlers(self):
         return linkfix_mime_handlers
 
@@ -51,12 +137,51 @@ def linkfix_routes(filenames):
         yield LinkFixRoute(fname, root_dir)
 
 
-def fixlinks(filenames, fallback_url, dry_run, overwrite):
+def fixlinks(filenames, fallback_url, dry_run, overwrite, link_cache=None,
+             check_workers=0, check_per_host=4, jobs=1,
+             manifest_path=None, output_mode='serialize',
+             profile=None, parser='auto', http_client=None):
     context = {
         'dry_run': dry_run,
         'overwrite': overwrite,
+        'output_mode': output_mode,
         'output_dir': '.',
         'fallback_url': fallback_url,
+        'link_cache': link_cache,
+        'jobs': jobs,
+        'profile': profile,
+        'parser': parser,
     }
+    if manifest_path is not None:
+        context['manifest'] = Manifest(manifest_path, {
+            'command': 'linkfix',
+            'fallback_url': fallback_url,
+            'parser': parser,
+        })
     routes = linkfix_routes(filenames)
-    handle_routes(routes, context)
+    with shared_client(http_client) as client:
+        context['session'] = client
+        if check_workers >= 1 and is_cacheable_fallback(fallback_url):
+            # First check all links concurrently, so that fixing the
+            # links afterwards only needs to look up the results.
+            routes = list(routes)
+            if link_cache is None:
+                context['link_cache'] = LinkCheckCache()
+            checks = it.chain.from_iterable(
+                collect_link_checks(route.src, fallback_url, parser)
+                for route in routes if linkfix_document in route.handlers
+                and not is_up_to_date(route, context)
+            )
+            prefetch_link_checks(
+                checks, context['link_cache'], check_workers,
+                check_per_host, client
+            )
+        try:
+            if manifest_path is None:
+                stream_routes(routes, context)
+            else:
+                # The manifest compares the whole route table.
+                handle_routes(routes, context)
+        finally:
+            if manifest_path is not None and not dry_run:
+                context['manifest'].save(context['routes'])
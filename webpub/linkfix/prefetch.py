@@ -0,0 +1,90 @@
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from urllib.parse import urljoin, urlparse
+import threading
+
+import requests
+import click
+
+import webpub.ui
+from webpub.http import shared_client
+from webpub.linkfix.check import (
+    get_link_checker, is_cacheable_fallback
+)
+
+
+class _HostLimiter(object):
+    """Hands out a semaphore per host, bounding the number of concurrent
+    requests to any single host."""
+
+    def __init__(self, per_host):
+        self.per_host = per_host
+        self._semaphores = {}
+        self._lock = threading.Lock()
+
+    def __call__(self, url_path, fallback_url):
+        host = urlparse(urljoin(fallback_url, url_path)).netloc
+        with self._lock:
+            semaphore = self._semaphores.get(host)
+            if semaphore is None:
+                semaphore = threading.BoundedSemaphore(self.per_host)
+                self._semaphores[host] = semaphore
+        return semaphore
+
+
+def prefetch_link_checks(checks, link_cache, workers=8, per_host=4,
+                         client=None):
+    """Checks the given `(url_path, fallback_url)` pairs concurrently, and
+    stores the results in `link_cache`. Links of which the result is
+    already cached are not checked again. The requests are made with
+    `client`, so that its connections are reused afterwards.
+
+    Returns the number of broken links that were found.
+
+    """
+    pending = set()
+    for url_path, fallback_url in checks:
+        if not is_cacheable_fallback(fallback_url):
+            continue
+        if link_cache.get(fallback_url, url_path) is None:
+            pending.add((url_path, fallback_url))
+
+    webpub.ui.echo("Checking {} links using {} workers".format(
+        len(pending), workers
+    ), verbosity=1)
+
+    host_limiter = _HostLimiter(per_host)
+
+    def check(url_path, fallback_url):
+        link_checker = get_link_checker(fallback_url)
+        with host_limiter(url_path, fallback_url):
+            return link_checker(url_path, client, fallback_url)
+
+    broken = 0
+    with shared_client(client) as client, \
+            ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = {
+            executor.submit(check, *pair): pair for pair in pending
+        }
+        for future in as_completed(futures):
+            url_path, fallback_url = futures[future]
+            try:
+                working, link, msg = future.result()
+            except requests.RequestException as e:
+                # Leave it to the second pass to check this link
+                # again, and to report the error.
+                webpub.ui.echo("Couldn't check {}: {}".format(
+                    url_path, e
+                ), verbosity=1)
+                continue
+            link_cache.set(fallback_url, url_path, working, link, msg)
+            if not working:
+                broken += 1
+            webpub.ui.echo("{status} {link} ({msg})".format(
+                status=click.style(working and "OK   " or "ERROR",
+                                   fg=working and 'green' or 'red'),
+                link=link,
+                msg=msg,
+            ), verbosity=2)
+
+    webpub.ui.echo("Found {} broken links".format(broken), verbosity=1)
+    return broken
@@ -0,0 +1,176 @@
+from collections.abc import Mapping
+import contextvars
+import hashlib
+import json
+import os
+
+import webpub
+
+manifest_version = 1
+
+
+def file_fingerprint(src, previous=None):
+    """Fingerprints the file at `src` by the hash of its contents. The
+    file is only read if its size or modification time changed since
+    the `previous` fingerprint."""
+    st = os.stat(src)
+    stat = [st.st_size, st.st_mtime_ns]
+    if previous is not None and previous.get('stat') == stat:
+        return {'digest': previous['digest'], 'stat': stat}
+
+    digest = hashlib.sha1()
+    with open(src, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            digest.update(chunk)
+    return {'digest': digest.hexdigest(), 'stat': stat}
+
+
+def options_digest(options):
+    options = dict(options, webpub_version=webpub.__version__)
+    return hashlib.sha1(
+        json.dumps(options, sort_keys=True, default=str).encode()
+    ).hexdigest()
+
+
+# The dependencies of the file that is being processed, in this thread.
+_recorded_deps = contextvars.ContextVar('webpub.recorded_deps', default=None)
+
+
+def record_file_dep(path, exists):
+    """Records that the file that is being processed depends on whether
+    the file at `path` exists, e.g. because it links to it. The
+    dependency is recorded as `'exists:<path>'` or `'missing:<path>'`."""
+    deps = _recorded_deps.get()
+    if deps is not None:
+        deps.add(
+            ('exists:' if exists else 'missing:') + os.path.abspath(path)
+        )
+
+
+def _file_dep_changed(dep):
+    kind, _, path = dep.partition(':')
+    return os.path.exists(path) != (kind == 'exists')
+
+
+class RecordingRoutes(Mapping):
+    """Read-only view of the route table that records which routes were
+    looked up. Iterating over the routes is recorded as `'*'`, i.e. a
+    dependency on the whole route table. Used as a context manager, it
+    also records the files checked with `record_file_dep`."""
+
+    def __init__(self, routes):
+        self._routes = routes
+        self.accessed = set()
+        self._token = None
+
+    def __enter__(self):
+        self._token = _recorded_deps.set(self.accessed)
+        return self
+
+    def __exit__(self, exc_t, exc_v, traceback):
+        _recorded_deps.reset(self._token)
+
+    def __getitem__(self, src):
+        self.accessed.add(src)
+        return self._routes[src]
+
+    def __contains__(self, src):
+        self.accessed.add(src)
+        return src in self._routes
+
+    def __iter__(self):
+        self.accessed.add('*')
+        return iter(self._routes)
+
+    def __len__(self):
+        return len(self._routes)
+
+
+class Manifest(object):
+    """Records the inputs of a previous run, so that files of which the
+    inputs didn't change since can be skipped.
+
+    A file is up to date if its fingerprint, its own route and the
+    routes it looked up while being processed are the same as in the
+    previous run, with the same options, the files it links to still
+    exist (or still don't), and its output still exists.
+    Files in `always` are never up to date, e.g. because processing them
+    has side effects that other files rely on.
+
+    """
+
+    def __init__(self, filename, options, fingerprint=file_fingerprint,
+                 always=()):
+        self.filename = filename
+        self.options = options_digest(options)
+        self.fingerprint = fingerprint
+        self.always = set(always)
+        self.files = {}
+        self.routes = {}
+        self.previous_files = {}
+        self.previous_routes = {}
+        self._route_table_changed = None
+        self.load()
+
+    def load(self):
+        try:
+            with open(self.filename, encoding='utf-8') as f:
+                previous = json.load(f)
+        except (OSError, ValueError):
+            return
+        if previous.get('version') != manifest_version \
+                or previous.get('options') != self.options:
+            return
+        self.previous_files = previous.get('files', {})
+        self.previous_routes = previous.get('routes', {})
+
+    def _deps_changed(self, routes, deps):
+        for dep in deps:
+            if dep.startswith(('exists:', 'missing:')):
+                if _file_dep_changed(dep):
+                    return True
+            elif dep == '*':
+                if self._route_table_changed is None:
+                    self._route_table_changed = \
+                        dict(routes) != self.previous_routes
+                if self._route_table_changed:
+                    return True
+            elif routes.get(dep) != self.previous_routes.get(dep):
+                return True
+        return False
+
+    def is_up_to_date(self, src, routes):
+        previous = self.previous_files.get(src)
+        if previous is None or src in self.always:
+            return False
+        dst = routes.get(src)
+        if dst != self.previous_routes.get(src) or not os.path.exists(dst):
+            return False
+        fingerprint = self.fingerprint(src, previous)
+        if fingerprint['digest'] != previous['digest']:
+            return False
+        if self._deps_changed(routes, previous['deps']):
+            return False
+        self.files[src] = dict(previous, **fingerprint)
+        return True
+
+    def record(self, src, deps):
+        """Records `src` as up to date. Its fingerprint is taken after
+        processing, as files may be changed in place."""
+        self.files[src] = dict(
+            self.fingerprint(src), deps=sorted(deps)
+        )
+
+    def save(self, routes):
+        dirname = os.path.dirname(self.filename)
+        if dirname:
+            os.makedirs(dirname, exist_ok=True)
+        tmp_filename = self.filename + '.tmp'
+        with open(tmp_filename, 'w', encoding='utf-8') as f:
+            json.dump({
+                'version': manifest_version,
+                'options': self.options,
+                'routes': dict(routes),
+                'files': self.files,
+            }, f)
+        os.replace(tmp_filename, self.filename)
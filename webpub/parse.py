@@ -0,0 +1,85 @@
+"""Parses the (X)HTML documents that are processed.
+
+Documents are parsed with html5-parser, as browsers would parse them.
+Well-formed XHTML, such as the content documents of EPUBs, can also be
+parsed as XML, which is much quicker and leaves the tree as it was
+written, without the fixups of the HTML parser. Either way, the
+elements of the tree are in no namespace.
+
+"""
+import re
+import threading
+
+import html5_parser as html5
+from lxml import etree
+
+xhtml_namespace = 'http://www.w3.org/1999/xhtml'
+
+# The root element of a document that declares itself XHTML.
+xhtml_root_regex = re.compile(
+    rb"""<html\b[^>]*?\sxmlns\s*=\s*["']"""
+    + re.escape(xhtml_namespace.encode()) + rb"""["']"""
+)
+
+# Entities other than the ones predefined by XML, which the XML parser
+# leaves unresolved (if the document has a DOCTYPE) instead of failing.
+html_entity_regex = re.compile(
+    rb'&(?!(?:amp|lt|gt|quot|apos|#[0-9]+|#x[0-9a-fA-F]+);)'
+)
+
+_local = threading.local()
+
+
+def _xml_parser():
+    # Parsers are reused, but can't be shared between threads.
+    parser = getattr(_local, 'xml_parser', None)
+    if parser is None:
+        parser = _local.xml_parser = etree.XMLParser(
+            resolve_entities=False, no_network=True, huge_tree=True
+        )
+    return parser
+
+
+def parse_html5(raw):
+    return html5.parse(raw, fallback_encoding='utf-8')
+
+
+def parse_xml(raw):
+    """Parses the XHTML document `raw` as XML. Raises
+    `lxml.etree.XMLSyntaxError` if it isn't well-formed."""
+    root = etree.fromstring(raw, _xml_parser())
+    prefix = '{%s}' % xhtml_namespace
+    for element in root.iter(prefix + '*'):
+        element.tag = element.tag[len(prefix):]
+    etree.cleanup_namespaces(root)
+    return root
+
+
+def is_xhtml(raw):
+    """Whether the document `raw` declares itself XHTML."""
+    return xhtml_root_regex.search(raw) is not None
+
+
+# The ways in which documents can be parsed: `html5` always uses the
+# HTML parser, `xml` tries the XML parser first for any document, and
+# `auto` only for documents that declare themselves XHTML.
+parsers = ('auto', 'xml', 'html5')
+
+
+def parse_document(raw, parser='auto'):
+    """Parses the (X)HTML document `raw` with the given `parser`,
+    falling back to the HTML parser for documents that aren't
+    well-formed XML. Returns the root element."""
+    if parser == 'xml' or (parser == 'auto' and is_xhtml(raw)):
+        if html_entity_regex.search(raw) is None:
+            try:
+                root = parse_xml(raw)
+            except etree.XMLSyntaxError:
+                root = None
+            # Documents are expected to have the head and body that the
+            # HTML parser always adds.
+            if root is not None and root.tag == 'html' \
+                    and root.find('head') is not None \
+                    and root.find('body') is not None:
+                return root
+    return parse_html5(raw)
@@ -0,0 +1,176 @@
+from collections import defaultdict
+import json
+import math
+import os
+import time
+
+import click
+
+profile_version = 1
+
+
+def input_size(context):
+    """The size in bytes of the file that is being handled."""
+    filepath = context['filepath']
+    try:
+        if 'epub_zip' in context:
+            return context['epub_zip'].getinfo(
+                os.path.join(context['root_dir'], filepath)
+            ).file_size
+        return os.path.getsize(filepath)
+    except (OSError, KeyError):
+        return 0
+
+
+def _percentile(sorted_values, percent):
+    if not sorted_values:
+        return 0.0
+    rank = max(1, math.ceil(percent / 100 * len(sorted_values)))
+    return sorted_values[rank - 1]
+
+
+def _summarize(values):
+    values = sorted(values)
+    return {
+        'total': sum(values),
+        'p50': _percentile(values, 50),
+        'p95': _percentile(values, 95),
+        'max': values[-1] if values else 0.0,
+    }
+
+
+class Profile(object):
+    """Records the wall and CPU time that each handler took for each
+    file, to report where the time of a run went."""
+
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.files = {}
+
+    def record_file(self, src, mimetype, size):
+        self.files[src] = {
+            'mimetype': mimetype,
+            'bytes': size,
+            'handlers': [],
+        }
+
+    def record(self, src, handler_name, wall, cpu):
+        self.files[src]['handlers'].append([handler_name, wall, cpu])
+
+    def merge(self, files):
+        """Adds records made elsewhere, e.g. in a worker process."""
+        self.files.update(files)
+
+    def report(self, slowest=10):
+        elapsed = time.perf_counter() - self.start
+        handlers = defaultdict(lambda: ([], []))
+        mimetypes = defaultdict(lambda: {
+            'files': 0, 'bytes': 0, 'wall': [], 'cpu': [],
+            'handlers': defaultdict(lambda: ([], [])),
+        })
+        files = []
+        for src, record in self.files.items():
+            wall = sum(w for _name, w, _cpu in record['handlers'])
+            cpu = sum(c for _name, _wall, c in record['handlers'])
+            by_mimetype = mimetypes[record['mimetype']]
+            by_mimetype['files'] += 1
+            by_mimetype['bytes'] += record['bytes']
+            by_mimetype['wall'].append(wall)
+            by_mimetype['cpu'].append(cpu)
+            for name, handler_wall, handler_cpu in record['handlers']:
+                for times in (handlers[name],
+                              by_mimetype['handlers'][name]):
+                    times[0].append(handler_wall)
+                    times[1].append(handler_cpu)
+            files.append(dict(record, file=src, wall=wall, cpu=cpu))
+
+        def summarize_handlers(handlers):
+            return {
+                name: {
+                    'calls': len(walls),
+                    'wall': _summarize(walls),
+                    'cpu': _summarize(cpus),
+                }
+                for name, (walls, cpus) in handlers.items()
+            }
+
+        total_bytes = sum(record['bytes'] for record in self.files.values())
+        files.sort(key=lambda f: f['wall'], reverse=True)
+        return {
+            'version': profile_version,
+            'elapsed': elapsed,
+            'files': len(self.files),
+            'bytes': total_bytes,
+            'files_per_second': len(self.files) / elapsed if elapsed else 0,
+            'megabytes_per_second':
+                total_bytes / 1e6 / elapsed if elapsed else 0,
+            'handlers': summarize_handlers(handlers),
+            'mimetypes': {
+                mimetype: {
+                    'files': m['files'],
+                    'bytes': m['bytes'],
+                    'wall': _summarize(m['wall']),
+                    'cpu': _summarize(m['cpu']),
+                    'handlers': summarize_handlers(m['handlers']),
+                }
+                for mimetype, m in mimetypes.items()
+            },
+            'slowest': [
+                {k: f[k] for k in ('file', 'mimetype', 'bytes', 'wall', 'cpu')}
+                for f in files[:slowest]
+            ],
+            'per_file': {
+                f['file']: {
+                    'mimetype': f['mimetype'],
+                    'bytes': f['bytes'],
+                    'handlers': f['handlers'],
+                }
+                for f in files
+            },
+        }
+
+    def save(self, filename, report=None):
+        with open(filename, 'w', encoding='utf-8') as f:
+            json.dump(report or self.report(), f, indent=1, sort_keys=True)
+
+
+def _format_times(name, calls, wall, cpu):
+    return "{:<36} {:>6} {:>9.3f} {:>8.4f} {:>8.4f} {:>8.4f} {:>9.3f}".format(
+        name[:36], calls, wall['total'], wall['p50'], wall['p95'],
+        wall['max'], cpu['total']
+    )
+
+
+def format_report(report):
+    lines = [
+        "Profile: {files} files, {mb:.1f} MB in {elapsed:.2f}s"
+        " ({fps:.1f} files/s, {mbps:.2f} MB/s)".format(
+            files=report['files'], mb=report['bytes'] / 1e6,
+            elapsed=report['elapsed'], fps=report['files_per_second'],
+            mbps=report['megabytes_per_second'],
+        ),
+    ]
+    header = "{:<36} {:>6} {:>9} {:>8} {:>8} {:>8} {:>9}".format(
+        '', 'calls', 'wall', 'p50', 'p95', 'max', 'cpu'
+    )
+    for mimetype, m in sorted(report['mimetypes'].items()):
+        lines.append('')
+        lines.append(click.style(
+            "{} ({} files, {:.1f} MB)".format(
+                mimetype, m['files'], m['bytes'] / 1e6
+            ), bold=True
+        ))
+        lines.append(header)
+        for name, h in m['handlers'].items():
+            lines.append(_format_times(
+                ' ' + name, h['calls'], h['wall'], h['cpu']
+            ))
+        lines.append(_format_times('total', m['files'], m['wall'], m['cpu']))
+    if report['slowest']:
+        lines.append('')
+        lines.append(click.style("Slowest files:", bold=True))
+        for f in report['slowest']:
+            lines.append("{:>9.3f}s {:>9.3f}s cpu  {}".format(
+                f['wall'], f['cpu'], os.path.relpath(f['file'])
+            ))
+    return '\n'.join(lines)
@@ -1,5 +1,5 @@
 import os.path
-from urllib.parse import urlparse, urlunparse
+from urllib.parse import urlunparse
 
 import webpub.util
 
@@ -13,15 +13,57 @@ def is_fallback_working(url, routed_cur_path):
     return False
 
 
+class RouteIndex(object):
+    """Memoizes the path computations of routing urls, per directory.
+    These only depend on their arguments, not on the route table, so
+    the same index can be used for any routes."""
+
+    def __init__(self):
+        self._urls = {}
+        self._relpaths = {}
+
+    def source(self, filedir, url_str):
+        """Returns the parsed url, the normalized path that it refers to
+        from `filedir` if it's a relative path (or `None`), and its
+        normalized path."""
+        urls = self._urls.get(filedir)
+        if urls is None:
+            urls = self._urls[filedir] = {}
+        entry = urls.get(url_str)
+        if entry is None:
+            classified = webpub.util.classify_url(url_str)
+            url = classified.url
+            src = None
+            if classified.is_relative:
+                src = os.path.normpath(os.path.join(filedir, url.path))
+            entry = urls[url_str] = (url, src, os.path.normpath(url.path))
+        return entry
+
+    def relpath(self, path, start):
+        """Returns `path` relative to the directory `start`."""
+        relpaths = self._relpaths.get(start)
+        if relpaths is None:
+            relpaths = self._relpaths[start] = {}
+        rel = relpaths.get(path)
+        if rel is None:
+            rel = relpaths[path] = os.path.relpath(path, start)
+        return rel
+
+
+route_index = RouteIndex()
+
+
 def get_route(routes, filedir, path):
     path = os.path.normpath(os.path.join(filedir, path))
     return routes.get(path)
 
 
 def routed_url(filepath, routes, old_url_str, sourceline=None):
-    url = urlparse(old_url_str)
-    if webpub.util.is_relative(url):
-        routed = get_route(routes, os.path.dirname(filepath), url.path)
+    url, src, url_path = route_index.source(
+        os.path.dirname(filepath), old_url_str
+    )
+    if src is not None:
+        routed = routes.get(src)
         routed_cur_path = routes[filepath]
         if routed is None:
             if not is_fallback_working(url, routed_cur_path):
@@ -31,9 +73,11 @@ def routed_url(filepath, routes, old_url_str, sourceline=None):
                     old_url_str,
                 ))
             return old_url_str
-        rel_routed = os.path.relpath(routed, os.path.dirname(routed_cur_path))
+        rel_routed = route_index.relpath(
+            routed, os.path.dirname(routed_cur_path)
+        )
 
-        if os.path.normpath(url.path) == rel_routed:
+        if url_path == rel_routed:
             return old_url_str
 
         url_list = list(url)
@@ -54,10 +98,14 @@ def route_url(routes, filepath, element, fallback_url=None):
     except ValueError:
         return element
 
-    if webpub.util.is_absolute(old_url):
-        return element
-
+    # Urls that aren't relative paths are returned as they are.
     element.attrib[attrib] = routed_url(
         filepath, routes, old_url, element.sourceline
     )
     return element
+
+
+def route_urls(root, routes, filepath):
+    """Routes the urls of all elements below `root` that have one."""
+    for element in webpub.util.link_elements(root):
+        route_url(routes, filepath, element)
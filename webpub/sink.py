@@ -0,0 +1,159 @@
+from concurrent.futures import ThreadPoolExecutor
+import os
+import shutil
+import struct
+import threading
+import zipfile as zf
+
+copy_buffer_size = 1 << 20
+zip_local_header = struct.Struct('<4s22xHH')
+
+
+class OutputError(Exception):
+    """Raised when the output sink is closed, if files couldn't be
+    written."""
+
+    def __init__(self, errors):
+        super().__init__("Couldn't write {} file(s):\n{}".format(
+            len(errors),
+            '\n'.join("{}: {}".format(path, e) for path, e in errors)
+        ))
+        self.errors = errors
+
+
+class OutputSink(object):
+    """Writes files behind the handlers, on a pool of threads, so that
+    the next file can be processed in the meantime. At most `pending`
+    files wait to be written at a time.
+
+    Each output directory is created only once. Errors are collected,
+    and raised as an `OutputError` when the sink is closed, after all
+    files were written.
+
+    """
+
+    def __init__(self, workers=4, pending=64):
+        self.workers = workers
+        self.pending = pending
+        self._executor = None
+        self._slots = threading.BoundedSemaphore(pending)
+        self._lock = threading.Lock()
+        self._dirs = set()
+        self._futures = []
+        self.errors = []
+
+    def _makedirs(self, path):
+        dirname = os.path.dirname(path) or '.'
+        if dirname in self._dirs:
+            return
+        os.makedirs(dirname, exist_ok=True)
+        with self._lock:
+            self._dirs.add(dirname)
+
+    def _submit(self, path, fn, *args):
+        self._slots.acquire()
+        with self._lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(
+                    max_workers=self.workers,
+                    thread_name_prefix='webpub-output'
+                )
+            self._futures = [f for f in self._futures if not f.done()]
+            future = self._executor.submit(self._run, path, fn, *args)
+            self._futures.append(future)
+
+    def _run(self, path, fn, *args):
+        try:
+            self._makedirs(path)
+            fn(path, *args)
+        except Exception as e:
+            with self._lock:
+                self.errors.append((path, e))
+        finally:
+            self._slots.release()
+
+    def write(self, path, data):
+        """Writes `data` to the file at `path`."""
+        self._submit(path, _write, data)
+
+    def copy_member(self, zip_file, name, path):
+        """Copies the member `name` of `zip_file` to the file at
+        `path`."""
+        self._submit(path, _copy_member, zip_file, name)
+
+    def flush(self):
+        """Waits until all files are written. Raises an `OutputError` if
+        any of them couldn't be."""
+        with self._lock:
+            futures, self._futures = self._futures, []
+        for future in futures:
+            future.result()
+        with self._lock:
+            errors, self.errors = self.errors, []
+        if errors:
+            raise OutputError(errors)
+
+    def close(self):
+        try:
+            self.flush()
+        finally:
+            if self._executor is not None:
+                self._executor.shutdown()
+                self._executor = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_t, exc_v, traceback):
+        if exc_t is None:
+            self.close()
+            return
+        # Don't hide the exception that stopped the run.
+        try:
+            self.close()
+        except OutputError:
+            pass
+
+
+def _write(path, data):
+    with open(path, 'wb') as f:
+        f.write(data)
+
+
+def _copy_stored_member(zip_filename, info, path):
+    """Copies a member that isn't compressed straight from the zip file
+    with `os.copy_file_range`, i.e. within the kernel."""
+    with open(zip_filename, 'rb') as src:
+        src.seek(info.header_offset)
+        signature, name_length, extra_length = zip_local_header.unpack(
+            src.read(zip_local_header.size)
+        )
+        if signature != b'PK\x03\x04':
+            raise OSError("bad local file header for " + info.filename)
+        offset = info.header_offset + zip_local_header.size \
+            + name_length + extra_length
+        with open(path, 'wb') as dst:
+            remaining = info.file_size
+            while remaining:
+                copied = os.copy_file_range(
+                    src.fileno(), dst.fileno(), remaining, offset
+                )
+                if copied == 0:
+                    raise OSError("unexpected end of " + zip_filename)
+                offset += copied
+                remaining -= copied
+
+
+def _copy_member(path, zip_file, name):
+    info = zip_file.getinfo(name)
+    if hasattr(os, 'copy_file_range') \
+            and info.compress_type == zf.ZIP_STORED \
+            and not info.flag_bits & 0x1 \
+            and os.path.isfile(zip_file.filename or ''):
+        try:
+            return _copy_stored_member(zip_file.filename, info, path)
+        except OSError:
+            # E.g. the filesystem doesn't support it, copy it below.
+            pass
+    with zip_file.open(info) as src, open(path, 'wb') as dst:
+        shutil.copyfileobj(src, dst, copy_buffer_size)
@@ -0,0 +1,900 @@
+"""Writes changes to a document by splicing them into its original bytes,
+instead of serializing the whole (parsed) document again.
+
+The parsed document doesn't know where its elements and text came from
+in the original bytes. So the original bytes are tokenized again, and
+the tokens are lined up with the elements of the parsed document. If
+they can't be lined up with certainty, `SpliceError` is raised, and the
+document is serialized as a whole instead.
+
+"""
+import bisect
+from collections import namedtuple
+import functools as ft
+import html
+import os
+import re
+
+from lxml import etree
+
+from webpub.util import tostring
+from webpub.ui import echo
+
+void_elements = {
+    'area', 'base', 'basefont', 'bgsound', 'br', 'col', 'embed', 'frame',
+    'hr', 'image', 'img', 'input', 'keygen', 'link', 'meta', 'param',
+    'source', 'track', 'wbr',
+}
+
+# Elements of which the contents are text, up to the end tag.
+rawtext_elements = {
+    'script', 'style', 'xmp', 'iframe', 'noembed', 'noframes', 'noscript',
+}
+rcdata_elements = {'title', 'textarea'}
+
+# Elements that may occur in the parsed document without a tag in the
+# original, either implied or reconstructed by the parser.
+implied_elements = {
+    'html', 'head', 'body', 'tbody', 'colgroup', 'tr', 'p',
+    'a', 'b', 'big', 'code', 'em', 'font', 'i', 'nobr', 's', 'small',
+    'strike', 'strong', 'tt', 'u',
+}
+
+# Elements of which the text is moved out of them by the parser, unless
+# it's whitespace.
+table_elements = {'table', 'tbody', 'thead', 'tfoot', 'tr'}
+
+# Elements that may only be in the head. Anything else starts the body.
+head_elements = {
+    'html', 'head', 'base', 'basefont', 'bgsound', 'link', 'meta',
+    'noframes', 'script', 'style', 'template', 'title', 'noscript',
+}
+
+utf8_encodings = {'utf-8', 'utf8', 'unicode-1-1-utf-8', 'us-ascii', 'ascii'}
+
+tag_open_regex = re.compile(rb'<(/?)([A-Za-z][^\s/>]*)')
+attribute_regex = re.compile(
+    rb'[\s/]*([^\s/>][^\s/>=]*)'
+    rb'(?:\s*=\s*(?:"([^"]*)"|\'([^\']*)\'|([^\s>]*)))?'
+)
+tag_close_regex = re.compile(rb'[\s/]*>')
+comment_regex = re.compile(rb'<!--(?:>|->|.*?(?:-->|--!>))', re.DOTALL)
+meta_charset_regex = re.compile(
+    rb'<meta[^>]+charset\s*=\s*["\']?\s*([\w.:-]+)', re.IGNORECASE
+)
+text_piece_regex = re.compile(
+    rb'&(?:#[0-9]+;?|#[xX][0-9a-fA-F]+;?|[A-Za-z][A-Za-z0-9]*;?)'
+    rb'|\r\n?'
+    rb'|[^&\r]+'
+    rb'|&'
+)
+
+# The `name` of a text token is that of the element with raw text or
+# RCDATA contents that it is in, if any. The `attributes` of a tag are
+# `Attribute`s, of which `value_start` and `value_end` include the
+# quotes, if any.
+Token = namedtuple(
+    'Token', 'kind start end name name_end attributes self_closing'
+)
+Attribute = namedtuple('Attribute', 'name start end value_start value_end')
+
+
+class SpliceError(Exception):
+    """The changes couldn't be located in the original bytes."""
+
+
+def check_encoding(raw):
+    """Raises `SpliceError` if `raw` isn't a UTF-8 document, the only
+    encoding the changes are spliced into."""
+    if raw.startswith((b'\xff\xfe', b'\xfe\xff')):
+        raise SpliceError("document is encoded in UTF-16")
+    charset = meta_charset_regex.search(raw, 0, 1024)
+    if charset is not None \
+            and charset.group(1).decode('ascii').lower() not in utf8_encodings:
+        raise SpliceError("document is encoded in {}".format(
+            charset.group(1).decode('ascii')
+        ))
+    if not raw.isascii():
+        try:
+            raw.decode('utf-8')
+        except UnicodeDecodeError:
+            raise SpliceError("document is not valid UTF-8")
+
+
+def _tokenize_tag(raw, m, end_tag):
+    name = m.group(2).decode('ascii', 'replace').lower()
+    pos = m.end()
+    attributes = []
+    while True:
+        a = attribute_regex.match(raw, pos)
+        if a is None or a.end() == pos:
+            break
+        for group in (2, 3, 4):
+            if a.start(group) != -1:
+                value_start, value_end = a.span(group)
+                if group != 4:
+                    value_start, value_end = value_start - 1, value_end + 1
+                break
+        else:
+            value_start = value_end = None
+        attributes.append(Attribute(
+            a.group(1).decode('utf-8', 'replace').lower(),
+            a.start(1), a.end(), value_start, value_end,
+        ))
+        pos = a.end()
+    close = tag_close_regex.match(raw, pos)
+    if close is None:
+        raise SpliceError("unterminated tag at byte {}".format(m.start()))
+    self_closing = close.group().rstrip(b'>').endswith(b'/')
+    kind = 'end' if end_tag else 'start'
+    return Token(
+        kind, m.start(), close.end(), name, m.end(), attributes, self_closing
+    )
+
+
+@ft.lru_cache(maxsize=None)
+def _end_tag_regex(name):
+    return re.compile(rb'</' + name.encode() + rb'[\s/>]', re.IGNORECASE)
+
+
+def _has_raw_text(name):
+    return name in rawtext_elements or name in rcdata_elements \
+        or name == 'plaintext'
+
+
+def _raw_text_end(raw, name, pos):
+    if name == 'plaintext':
+        return len(raw)
+    end_tag = _end_tag_regex(name).search(raw, pos)
+    return len(raw) if end_tag is None else end_tag.start()
+
+
+def tokenize(raw, rawtext=None, continued=False):
+    """Yields the tokens of an HTML document: start and end tags, text,
+    comments and other markup (doctypes, processing instructions, and
+    the like). If `raw` is the rest of a document, `continued` is set,
+    and `rawtext` is the name of the element with raw text contents
+    that it starts in, if any."""
+    pos = 0
+    if not continued and raw.startswith(b'\xef\xbb\xbf'):
+        pos = 3
+    length = len(raw)
+    if rawtext is not None:
+        end = _raw_text_end(raw, rawtext, pos)
+        if pos < end:
+            yield Token('text', pos, end, rawtext, None, (), False)
+        pos = end
+    text_start = pos
+    while pos < length:
+        lt = raw.find(b'<', pos)
+        if lt == -1:
+            break
+        m = tag_open_regex.match(raw, lt)
+        if m is not None:
+            token = _tokenize_tag(raw, m, m.group(1))
+        elif raw.startswith(b'<!--', lt):
+            comment = comment_regex.match(raw, lt)
+            end = comment.end() if comment is not None else length
+            token = Token('comment', lt, end, None, None, (), False)
+        elif raw.startswith((b'<!', b'<?', b'</'), lt):
+            end = raw.find(b'>', lt)
+            end = length if end == -1 else end + 1
+            token = Token('other', lt, end, None, None, (), False)
+        else:
+            pos = lt + 1
+            continue
+
+        if text_start < lt:
+            yield Token('text', text_start, lt, None, None, (), False)
+        yield token
+        pos = text_start = token.end
+
+        if token.kind == 'start' and _has_raw_text(token.name):
+            end = _raw_text_end(raw, token.name, pos)
+            if pos < end:
+                yield Token('text', pos, end, token.name, None, (), False)
+            pos = text_start = end
+
+    if text_start < length:
+        yield Token('text', text_start, length, None, None, (), False)
+
+
+# The bytes at the end of what was read of a document that are searched
+# again with the next chunk, as they may be the start of a tag.
+_chunk_overlap = 16
+
+
+def _cut_text(raw, rawtext, continued, text_boundary, pos=0):
+    """Cuts the text that `raw` starts with after the last match of
+    `text_boundary` (from `pos` on). Returns the piece of `raw` up to
+    there with its token, or `None` if there's no match."""
+    start = 0
+    if not continued and raw.startswith(b'\xef\xbb\xbf'):
+        start = 3
+    cut = None
+    for m in text_boundary.finditer(raw, max(start, pos),
+                                    len(raw) - _chunk_overlap):
+        cut = m.end()
+    if cut is None or cut <= start:
+        return None
+    return bytes(raw[:cut]), [
+        Token('text', start, cut, rawtext, None, (), False)
+    ]
+
+
+def tokenize_chunks(f, chunk_size=1 << 20, text_boundary=None):
+    """Tokenizes the document read from the binary file `f`, a chunk at
+    a time. Yields pieces of the document with the tokens in each, of
+    which the offsets are into the piece. The pieces follow each other
+    without gaps.
+
+    Only the token that is unfinished at the end of a chunk is kept for
+    the next one, and it's only tokenized again once a chunk comes that
+    may finish it. Texts are cut after the last match of
+    `text_boundary`, if given, so that a long text isn't kept as a
+    whole either. It should only match where nothing that is searched
+    for in the text can span it.
+
+    """
+    raw = bytearray()
+    # The element with raw text contents that `raw` starts in, whether
+    # anything was yielded yet, and what the unfinished token at the
+    # start of `raw` is, if any.
+    rawtext = None
+    continued = False
+    pending = None
+    scanned = 0
+    while True:
+        chunk = f.read(chunk_size)
+        eof = not chunk
+        raw += chunk
+        if not eof and pending is not None:
+            if pending == 'markup':
+                terminator = b'>'
+            elif rawtext is not None:
+                terminator = b'</'
+            else:
+                terminator = b'<'
+            if rawtext == 'plaintext' or raw.find(
+                    terminator, max(0, scanned - _chunk_overlap)) == -1:
+                if pending == 'text' and text_boundary is not None:
+                    piece = _cut_text(
+                        raw, rawtext, continued, text_boundary,
+                        scanned - 2 * _chunk_overlap
+                    )
+                    if piece is not None:
+                        yield piece
+                        del raw[:len(piece[0])]
+                        continued = True
+                scanned = len(raw)
+                continue
+
+        tokens = []
+        complete = True
+        try:
+            for token in tokenize(raw, rawtext, continued):
+                tokens.append(token)
+        except SpliceError:
+            if eof:
+                raise
+            # A tag that ends in a later chunk.
+            complete = False
+        if eof:
+            if raw:
+                yield bytes(raw), tokens
+            return
+
+        pending = 'markup' if not complete else None
+        next_rawtext = None
+        if complete and tokens:
+            last = tokens[-1]
+            # Text may continue in the next chunk, and unfinished
+            # comments and the like run to the end of what was read.
+            if last.kind == 'text' and last.end == len(raw):
+                pending = 'text'
+                next_rawtext = last.name
+                tokens.pop()
+            elif last.kind in ('comment', 'other') \
+                    and not raw.endswith(b'>'):
+                pending = 'markup'
+                tokens.pop()
+            elif last.kind == 'start' and _has_raw_text(last.name):
+                next_rawtext = last.name
+        rawtext = next_rawtext
+        if tokens:
+            end = tokens[-1].end
+            yield bytes(raw[:end]), tokens
+            del raw[:end]
+            continued = True
+        if pending == 'text' and text_boundary is not None:
+            piece = _cut_text(raw, rawtext, continued, text_boundary)
+            if piece is not None:
+                yield piece
+                del raw[:len(piece[0])]
+                continued = True
+        scanned = len(raw)
+
+
+def _decode_attribute(raw, attribute):
+    if attribute.value_start is None:
+        return ''
+    value = raw[attribute.value_start:attribute.value_end]
+    if value[:1] in (b'"', b"'"):
+        value = value[1:-1]
+    value = value.replace(b'\r\n', b'\n').replace(b'\r', b'\n')
+    return html.unescape(value.decode('utf-8'))
+
+
+def escape_attribute(value):
+    return '"{}"'.format(
+        value.replace('&', '&amp;').replace('"', '&quot;')
+    ).encode('utf-8')
+
+
+def start_tag(element):
+    """The start tag of `element`, as serialized when splicing it in."""
+    return b''.join(
+        [b'<', element.tag.encode('utf-8')] + [
+            b' ' + name.encode('utf-8') + b'=' + escape_attribute(value)
+            for name, value in element.attrib.items()
+        ] + [b'>']
+    )
+
+
+def end_tag(element):
+    return b'</' + element.tag.encode('utf-8') + b'>'
+
+
+def apply_splices(raw, splices):
+    """Returns `raw` with the `(start, end, replacement)` splices
+    applied. Unchanged regions are copied straight from `raw`."""
+    view = memoryview(raw)
+    parts = []
+    pos = 0
+    for start, end, replacement in sorted(splices, key=lambda s: s[:2]):
+        if start < pos:
+            raise SpliceError("overlapping changes at byte {}".format(start))
+        parts.append(view[pos:start])
+        parts.append(replacement)
+        pos = end
+    parts.append(view[pos:])
+    return b''.join(parts)
+
+
+def _local_name(element):
+    return etree.QName(element).localname.lower()
+
+
+class TextMap(object):
+    """The text of a text token, with entities decoded and newlines
+    normalized like the parser does, that maps positions in the text
+    back to byte offsets."""
+
+    def __init__(self, raw, start, end, decode_entities=True):
+        # Pieces of text with their byte offsets. Decoded entities and
+        # newlines can only be mapped as a whole.
+        self.pieces = []
+        self._starts = []
+        parts = []
+        pos = 0
+        for m in text_piece_regex.finditer(raw, start, end):
+            piece = m.group()
+            literal = False
+            if piece.startswith(b'\r'):
+                text = '\n'
+            elif piece.startswith(b'&') and decode_entities:
+                text = html.unescape(piece.decode('ascii'))
+                literal = text == piece.decode('ascii')
+            else:
+                text = piece.decode('utf-8')
+                literal = True
+            self.pieces.append((pos, text, m.start(), m.end(), literal))
+            self._starts.append(pos)
+            parts.append(text)
+            pos += len(text)
+        self.text = ''.join(parts)
+
+    def byte_offset(self, pos):
+        i = max(0, bisect.bisect_right(self._starts, pos) - 1)
+        text_start, text, start, end, literal = self.pieces[i]
+        if pos == text_start:
+            return start
+        if pos == text_start + len(text):
+            return end
+        if literal:
+            return start + len(text[:pos - text_start].encode('utf-8'))
+        raise SpliceError("position {} is within an entity".format(pos))
+
+
+class OpenElements(object):
+    """Approximates the parser's stack of open elements, as far as the
+    start and end tags in the original bytes go."""
+
+    # End tags don't close elements beyond these.
+    scope_boundaries = {
+        'html', 'table', 'td', 'th', 'caption', 'applet', 'marquee',
+        'object', 'template',
+    }
+    table_parts = {
+        'tbody', 'thead', 'tfoot', 'tr', 'td', 'th', 'caption', 'col',
+        'colgroup',
+    }
+    headings = {'h1', 'h2', 'h3', 'h4', 'h5', 'h6'}
+
+    def __init__(self):
+        self.names = []
+
+    def __contains__(self, name):
+        return name in self.names
+
+    def start(self, token, in_body):
+        """Returns the number of elements that the start tag closed,
+        and whether it opened one, or `None` if the parser ignores the
+        start tag."""
+        name = token.name
+        if (name in ('html', 'body') and name in self.names) \
+                or (name == 'head' and (in_body or name in self.names)) \
+                or (name in self.table_parts and 'table' not in self.names):
+            return None
+        closed = 0
+        if name in self.headings and self.names \
+                and self.names[-1] in self.headings:
+            closed = self.end(self.names[-1])
+        elif name == 'a':
+            closed = self.end('a')
+        if name in void_elements \
+                or (token.self_closing and self.in_foreign_content()):
+            return closed, False
+        self.names.append(name)
+        return closed, True
+
+    def end(self, name):
+        """Returns the number of elements that the end tag closed."""
+        if name in ('html', 'body'):
+            # Anything after these still ends up in the body.
+            return 0
+        for k in reversed(range(len(self.names))):
+            if self.names[k] == name:
+                closed = len(self.names) - k
+                del self.names[k:]
+                return closed
+            if self.names[k] in self.scope_boundaries:
+                break
+        return 0
+
+    def in_foreign_content(self):
+        return 'svg' in self.names or 'math' in self.names
+
+    def in_table(self):
+        """Whether text is in a table, outside of its cells, where the
+        parser moves it out of the table."""
+        for name in reversed(self.names):
+            if name in table_elements:
+                return True
+            if name in ('td', 'th', 'caption'):
+                return False
+        return False
+
+
+def _line_numbers(raw, tokens):
+    """Pairs the tokens with the line they start on."""
+    line = 1
+    pos = 0
+    for token in tokens:
+        line += raw.count(b'\n', pos, token.start)
+        pos = token.start
+        yield token, line
+
+
+class Edits(object):
+    """Changes made to the parsed `tree` of the document `raw`."""
+
+    def __init__(self, raw, tree):
+        self.raw = raw
+        self.tree = tree
+
+    def splices(self):
+        """Returns the `(start, end, replacement)` splices of the changes
+        into the original bytes."""
+        raise NotImplementedError()
+
+    def splice(self):
+        """Returns the original bytes with the changes spliced in."""
+        check_encoding(self.raw)
+        splices = self.splices()
+        if not splices:
+            return self.raw
+        return apply_splices(self.raw, splices)
+
+
+class ElementEdits(Edits):
+    """Takes a snapshot of the elements of the tree, so that the
+    attributes that were changed and the elements that were removed
+    since can be spliced into the original bytes."""
+
+    def __init__(self, raw, tree):
+        super().__init__(raw, tree)
+        self.snapshot = [
+            (element, dict(element.attrib))
+            for element in tree.iter(etree.Element)
+        ]
+
+    def changes(self):
+        """Yields the index in the snapshot of each changed element, and
+        whether it was removed."""
+        # Removed elements still belong to the same document, so look
+        # for them in the tree instead.
+        current = set(self.tree.iter(etree.Element))
+        for i, (element, attrib) in enumerate(self.snapshot):
+            removed = element not in current
+            if removed or dict(element.attrib) != attrib:
+                yield i, removed
+
+    def _same_attributes(self, token, attrib):
+        seen = set()
+        for attribute in token.attributes:
+            # Attributes of which the name contains a prefix are
+            # renamed by the parser.
+            if attribute.name in seen or ':' in attribute.name:
+                continue
+            seen.add(attribute.name)
+            if attrib.get(attribute.name) != \
+                    _decode_attribute(self.raw, attribute):
+                return False
+        return True
+
+    def _start_tags(self):
+        """Returns the start tags in the original bytes with their line
+        numbers, the end tags that close them and the number of elements
+        that those closed by index, and the indices of the start tags
+        that closed elements or started the body."""
+        start_tags = []
+        end_tags = {}
+        implying = set()
+        open_elements = OpenElements()
+        # The indices of the start tags of the open elements.
+        open_tags = []
+        in_body = False
+        for token, line in _line_numbers(self.raw, tokenize(self.raw)):
+            if token.kind == 'start':
+                starts_body = not in_body \
+                    and token.name not in head_elements
+                in_body = in_body or starts_body
+                started = open_elements.start(token, in_body)
+                if started is None:
+                    continue
+                start_tags.append((token, line))
+                closed, opened = started
+                if closed or starts_body:
+                    implying.add(len(start_tags) - 1)
+                del open_tags[len(open_tags) - closed:]
+                if opened:
+                    open_tags.append(len(start_tags) - 1)
+            elif token.kind == 'end':
+                closed = open_elements.end(token.name)
+                if closed:
+                    end_tags[open_tags[-closed]] = (token, closed)
+                    del open_tags[-closed:]
+        return start_tags, end_tags, implying
+
+    def _align(self, start_tags):
+        """Maps the indices of the elements in the snapshot to the start
+        tags they were parsed from. Returns that, and the index of the
+        first element from which on the elements without a start tag
+        can't be told apart from the ones the parser moved."""
+        aligned = {}
+        seen = set()
+        # The elements that were taken to have no start tag.
+        implied = []
+        j = 0
+        for i, (element, attrib) in enumerate(self.snapshot):
+            name = _local_name(element)
+            while j < len(start_tags):
+                token, line = start_tags[j]
+                if token.name == name and line == element.sourceline \
+                        and self._same_attributes(token, attrib):
+                    aligned[i] = j
+                    j += 1
+                    break
+                if token.name in ('html', 'head', 'body') \
+                        and token.name in seen:
+                    # Merged into the element the parser already made.
+                    j += 1
+                    continue
+                if name in implied_elements:
+                    implied.append(i)
+                    break
+                return aligned, min(implied + [i])
+            seen.add(name)
+        if j < len(start_tags):
+            # Start tags were left over, so some of the elements taken
+            # to have no start tag were moved by the parser instead.
+            return aligned, min(implied + [len(self.snapshot)])
+        return aligned, len(self.snapshot)
+
+    def _attribute_splices(self, token, old_attrib, new_attrib):
+        attributes = {}
+        for attribute in token.attributes:
+            attributes.setdefault(attribute.name, attribute)
+        insert_at = token.attributes[-1].end if token.attributes \
+            else token.name_end
+        for name in set(old_attrib) | set(new_attrib):
+            old_value = old_attrib.get(name)
+            new_value = new_attrib.get(name)
+            if old_value == new_value:
+                continue
+            if name.startswith('{') or (
+                    old_value is not None and name not in attributes):
+                raise SpliceError(
+                    "attribute {} not found in the original".format(name)
+                )
+            if old_value is None:
+                yield (insert_at, insert_at, b' ' + name.encode('utf-8')
+                       + b'=' + escape_attribute(new_value))
+                continue
+            attribute = attributes[name]
+            if new_value is None:
+                start = attribute.start
+                if self.raw[start - 1:start].isspace():
+                    start -= 1
+                yield (start, attribute.end, b'')
+            elif attribute.value_start is None:
+                yield (attribute.end, attribute.end,
+                       b'=' + escape_attribute(new_value))
+            else:
+                yield (attribute.value_start, attribute.value_end,
+                       escape_attribute(new_value))
+
+    def _copies(self, aligned):
+        """Returns groups of indices of formatting elements in the
+        snapshot that might share a start tag, as the parser makes
+        copies of formatting elements when reopening them."""
+        groups = {}
+        for i, (element, attrib) in enumerate(self.snapshot):
+            if _local_name(element) in implied_elements:
+                key = (element.tag, element.sourceline,
+                       tuple(sorted(attrib.items())))
+                groups.setdefault(key, []).append(i)
+        return [
+            group for group in groups.values()
+            if len(group) > 1 and any(i not in aligned for i in group)
+        ]
+
+    def _check_copies(self, changes, copies):
+        """Raises if elements that might share a start tag weren't all
+        changed the same way."""
+        def outcome(i):
+            if changes.get(i):
+                return None
+            return dict(self.snapshot[i][0].attrib)
+
+        for group in copies:
+            if len({repr(outcome(i)) for i in group}) > 1:
+                element, _attrib = self.snapshot[group[0]]
+                raise SpliceError(
+                    "the <{}> element on line {} was reopened by the"
+                    " parser, and not all of its copies were"
+                    " changed".format(
+                        _local_name(element), element.sourceline
+                    )
+                )
+
+    def splices(self):
+        changes = dict(self.changes())
+        if not changes:
+            return []
+        start_tags, end_tags, implying = self._start_tags()
+        aligned, stop = self._align(start_tags)
+        copies = self._copies(aligned)
+        self._check_copies(changes, copies)
+        # Elements that were copied along with the element that they
+        # were copied from.
+        copied = {
+            i
+            for group in copies if any(j in aligned for j in group)
+            for i in group if i < stop and i not in aligned
+        }
+
+        splices = []
+        for i, removed in changes.items():
+            element, old_attrib = self.snapshot[i]
+            if i in copied:
+                continue
+            if i not in aligned:
+                raise SpliceError(
+                    "the <{}> element on line {} can't be found in the"
+                    " original".format(
+                        _local_name(element), element.sourceline
+                    )
+                )
+            token, _line = start_tags[aligned[i]]
+            if not removed:
+                splices.extend(self._attribute_splices(
+                    token, old_attrib, dict(element.attrib)
+                ))
+                continue
+            end_tag, closed = end_tags.get(aligned[i], (None, 0))
+            if aligned[i] in implying or closed > 1 or copies:
+                # Without its tags, the elements around it would be
+                # parsed differently. Formatting elements are reopened
+                # at the next start tag, which might be this one.
+                raise SpliceError(
+                    "removing the <{}> element on line {} changes how"
+                    " the original is parsed".format(
+                        token.name, element.sourceline
+                    )
+                )
+            splices.append((token.start, token.end, b''))
+            if end_tag is not None:
+                splices.append((end_tag.start, end_tag.end, b''))
+            elif token.name not in void_elements and not token.self_closing:
+                raise SpliceError(
+                    "the end tag of the <{}> element on line {} can't be"
+                    " found in the original".format(
+                        token.name, element.sourceline
+                    )
+                )
+        return splices
+
+
+class SearchedText(object):
+    """Tells which text tokens of a document are searched, fed with the
+    tokens one by one. Like the text that is searched in the parsed
+    document, text in `ignored_tags`, text in the head, and text
+    following (the end tag of) an ignored element or a comment isn't
+    searched."""
+
+    def __init__(self, ignored_tags):
+        self.ignored_tags = set(ignored_tags)
+        self.open_elements = OpenElements()
+        self.in_body = False
+        self.skip_tail = False
+
+    def __call__(self, raw, token):
+        open_elements = self.open_elements
+        # Tags that the parser ignores don't end the text (or tail)
+        # before them.
+        if token.kind == 'start':
+            self.in_body = self.in_body or token.name not in head_elements
+            if open_elements.start(token, self.in_body) is not None:
+                self.skip_tail = False
+        elif token.kind == 'end':
+            if token.name in ('body', 'html'):
+                self.in_body = True
+            if open_elements.end(token.name):
+                self.skip_tail = token.name in self.ignored_tags
+            elif token.name in ('p', 'br'):
+                # The parser makes an element for these instead.
+                self.skip_tail = False
+        elif token.kind != 'text':
+            # Comments (and anything parsed as one)
+            self.skip_tail = self.in_body
+        else:
+            if self.skip_tail or any(
+                    name in self.ignored_tags
+                    for name in open_elements.names):
+                return False
+            if not self.in_body:
+                if token.name is not None \
+                        or not raw[token.start:token.end].strip():
+                    return False
+                self.in_body = True
+            return True
+        return False
+
+
+def text_map(raw, token):
+    """The `TextMap` of a text token."""
+    return TextMap(
+        raw, token.start, token.end,
+        decode_entities=token.name not in rawtext_elements
+        and token.name != 'plaintext'
+    )
+
+
+class TextEdits(Edits):
+    """Records which matches of `pattern` in the text of the tree were
+    wrapped in a new element, so that those elements can be spliced
+    into the original bytes.
+
+    Like the text that is searched in the tree, text in `ignored_tags`,
+    text in the head, and text following (the end tag of) an ignored
+    element or a comment isn't searched in the original. If the same
+    matches aren't found in both, the edits can't be spliced.
+
+    """
+
+    def __init__(self, raw, tree, pattern, ignored_tags, raw_prefilter=None):
+        super().__init__(raw, tree)
+        self.pattern = pattern
+        self.ignored_tags = ignored_tags
+        self.raw_prefilter = raw_prefilter
+        self.matches = {}
+
+    def record(self, element, text_or_tail):
+        """Returns the list to append the matches in the text or tail of
+        `element` to, as `(match, wrapper)` pairs. The wrapper is the
+        element the match was wrapped in, or `None` if it wasn't."""
+        return self.matches.setdefault((element, text_or_tail), [])
+
+    def _tree_matches(self):
+        for event, element in etree.iterwalk(self.tree,
+                                              events=('start', 'end')):
+            key = (element, 'text' if event == 'start' else 'tail')
+            yield from self.matches.get(key, ())
+
+    def _raw_matches(self):
+        """Yields the matches in the original bytes, with the text they
+        were found in and their position in it."""
+        raw = self.raw
+        searched = SearchedText(self.ignored_tags)
+        for token in tokenize(raw):
+            if not searched(raw, token):
+                continue
+            if self.raw_prefilter is not None and \
+                    not self.raw_prefilter.search(
+                        raw, token.start, token.end):
+                continue
+            text = text_map(raw, token)
+            for m in self.pattern.finditer(text.text):
+                if searched.open_elements.in_table():
+                    raise SpliceError(
+                        "text in a table is moved out of it"
+                    )
+                yield m.group(), text, m.start(), m.end()
+
+    def splices(self):
+        tree_matches = list(self._tree_matches())
+        raw_matches = list(self._raw_matches())
+        if [match for match, _wrapper in tree_matches] != \
+                [match for match, _text, _start, _end in raw_matches]:
+            raise SpliceError(
+                "the matches in the original don't line up with those in"
+                " the document"
+            )
+        splices = []
+        for (_match, wrapper), (_, text, start, end) in zip(tree_matches,
+                                                           raw_matches):
+            if wrapper is None:
+                continue
+            start = text.byte_offset(start)
+            end = text.byte_offset(end)
+            splices.append((start, start, start_tag(wrapper)))
+            splices.append((end, end, end_tag(wrapper)))
+        return splices
+
+
+class CombinedEdits(Edits):
+    """The edits of several passes over the same tree, which are spliced
+    into the original bytes together."""
+
+    def __init__(self, raw, tree, edits):
+        super().__init__(raw, tree)
+        self.edits = edits
+
+    def splices(self):
+        return [
+            splice for edits in self.edits for splice in edits.splices()
+        ]
+
+
+def splice_or_tostring(input, currentpath):
+    """Splices the changes into the original document, if `input` holds
+    any edits. Otherwise, or if that isn't possible, serializes the
+    whole document."""
+    if hasattr(input, 'read'):
+        # Already written to a file, as it was read.
+        return input
+    if not isinstance(input, Edits):
+        return tostring(input)
+    try:
+        return input.splice()
+    except SpliceError as e:
+        echo("Can't splice the changes into {} ({}), writing the whole"
+             " document instead".format(os.path.relpath(currentpath), e),
+             verbosity=1)
+        return tostring(input.tree)
+
+
+splice_or_tostring.verbose_name = "Convert back to string"
+splice_or_tostring.verbosity = 1
@@ -56,6 +56,12 @@ class GlobalStats(object):
         if stat not in self.excluded:
             self.statistics[stat].add(value)
 
+    def merge(self, statistics):
+        """Adds statistics gathered elsewhere, e.g. in a worker process."""
+        for stat, values in statistics.items():
+            for value in values:
+                self.add(stat, value)
+
     def scope(self, src):
         return FileStats(self, src)
 
@@ -84,6 +90,7 @@ GlobalStats.register_statistic_formatter('processed', _format_file_stat)
 GlobalStats.register_statistic_formatter('saved', _format_file_stat)
 GlobalStats.register_statistic_formatter('failed', _format_file_stat)
 GlobalStats.register_statistic_formatter('changed', _format_file_stat)
+GlobalStats.register_statistic_formatter('skipped', _format_file_stat)
 
 global_stats = GlobalStats()
 format_summary = global_stats.format_summary
@@ -1,20 +1,34 @@
 from collections import namedtuple
 import functools as ft
 import bisect
+import os
 import re
+import tempfile
 
-import html5_parser as html5
-import lxml.sax
 from lxml.builder import E
 import lxml.etree
-from xml.sax import ContentHandler
 from inxs import Transformation, Rule, MatchesXPath
-import requests
 
-from webpub.handlers import handle_routes, ConstDestMimetypeRoute
-from webpub.linkfix.check import check_link_against_fallback
+from webpub.handlers import (
+    handle_routes, stream_routes, is_up_to_date, ConstDestMimetypeRoute,
+    AbortHandling
+)
+from webpub.http import shared_client
+from webpub.manifest import Manifest
+from webpub.parse import parse_document
+from webpub.linkfix.cache import LinkCheckCache
+from webpub.linkfix.check import (
+    check_link_against_fallback, is_cacheable_fallback
+)
+from webpub.linkfix.prefetch import prefetch_link_checks
+from webpub.splice import (
+    TextEdits, SearchedText, SpliceError, splice_or_tostring,
+    tokenize_chunks, text_map, check_encoding, apply_splices, start_tag,
+    end_tag
+)
 from webpub.util import (
-    guard_unchanged, guard_dry_run, guard_overwrite, tostring, write_out
+    guard_unchanged, guard_dry_run, guard_overwrite, write_out,
+    read_if_matches, open_if_matches
 )
 from webpub.ui import echo, choice_prompt
 
@@ -104,8 +118,39 @@ sutta_ref_regex = sutta_ref_regex_template.format(
     '|'.join(sutta_abbrev_urls.keys())
 )
 
+sutta_ref_pattern = re.compile(sutta_ref_regex)
+
+# Every reference starts with one of the abbreviations, optionally
+# followed by whitespace, and then a roman numeral or a digit.
+sutta_ref_prefilter = re.compile(r"(?:{})\s?[IXV0-9]".format(
+    '|'.join(sutta_abbrev_urls.keys())
+))
+
+# The same, for the raw bytes of a document. There, the whitespace may
+# also be written as an entity (e.g. &nbsp;), or be a non-ASCII space in
+# whichever encoding the document uses.
+sutta_ref_raw_prefilter = re.compile(
+    r"(?:{})(?:\s|[\x1c-\x1f]|&#?\w+;|[\x80-\xff]{{1,3}})?[IXV0-9]".format(
+        '|'.join(sutta_abbrev_urls.keys())
+    ).encode()
+)
+
+# Where `crossref_stream` may cut a long text: no reference can span
+# ASCII punctuation other than that of a reference itself or of an
+# entity, nor two whitespace characters in a row. A '<' is left out, as
+# it may be the start of a tag.
+sutta_ref_text_boundary = re.compile(
+    rb"[!\"$%'()*+,/=>?@[\\\]^_`{|}~]|\s\s"
+)
+
 ignored_elements = [ 'a', 'h1', 'h2', 'h3', 'h4', 'h5', 'h6',
                      lxml.etree.Comment, lxml.etree.ProcessingInstruction ]
+ignored_tags = [tag for tag in ignored_elements if isinstance(tag, str)]
+
+# How much of a document `crossref_stream` reads at a time.
+stream_chunk_size = 1 << 20
+# Streamed output is kept in memory up to this size.
+stream_spool_size = 16 << 20
 
 sutta_ref_choices = {
     'cont': ('continue without inserting a link', _continue),
@@ -128,14 +173,14 @@ def get_url_format_callable(ref):
         numeral=ref.numeral, text=ref.text, sep=ref.sep
     )
 
-def get_sutta_ref_url(ref, stats, session, fallback_url):
+def get_sutta_ref_url(ref, stats, session, fallback_url, link_cache=None):
     url_format = get_url_format_callable(ref)
     url = url_format()
     message = "Sutta link not found"
     while url is not None:
         try:
             working, link = check_link_against_fallback(
-                url, session, fallback_url
+                url, session, fallback_url, link_cache
             )
         except ValueError:
             return url
@@ -153,6 +198,14 @@ def get_sutta_ref_url(ref, stats, session, fallback_url):
         url = choice
 
 
+def could_contain_sutta_refs(text):
+    """Cheap prefilter: returns False if `text` cannot contain a sutta
+    reference, without running the full regex."""
+    if not text or len(text) < 2:
+        return False
+    return sutta_ref_prefilter.search(text) is not None
+
+
 def find_sutta_refs(text):
     """Returns pairs of references and the "tail text" between the end of
     the current reference and the next reference. Starts with a
@@ -161,75 +214,112 @@ def find_sutta_refs(text):
     `(None, text)`.
 
     """
-    tail_text = text
     latest_ref = None
-    matches = re.finditer(sutta_ref_regex, text)
-    offset = 0
+    pos = 0
 
-    for matchobj in matches:
-        full_match = matchobj.group(0)
-        numeral = matchobj.group('numeral')
-        section = matchobj.group('section')
-        text = matchobj.group('text') \
-            or matchobj.group('text_or_subsection')
-        subsection = sep = ''
-
-        start = matchobj.start() - offset
-        end = matchobj.end() - offset
-
-        preceding_text = tail_text[:start]
-
-        yield latest_ref, preceding_text
+    for matchobj in sutta_ref_pattern.finditer(text):
+        start, end = matchobj.span()
+        numeral, section, text_or_subsection, ref_text = matchobj.group(
+            'numeral', 'section', 'text_or_subsection', 'text'
+        )
 
-        tail_text = tail_text[end:]
+        yield latest_ref, text[pos:start]
 
-        if matchobj.group('text'):
-            subsection = matchobj.group('text_or_subsection')
+        if ref_text:
+            subsection = text_or_subsection
             sep = '_'
+        else:
+            ref_text = text_or_subsection
+            subsection = sep = ''
+
+        latest_ref = SuttaRef(
+            matchobj.group(0), section, subsection, numeral, ref_text, sep
+        )
+        pos = end
+    yield latest_ref, text[pos:]
 
-        latest_ref = SuttaRef(full_match, section, subsection, numeral, text, sep)
 
-        offset += end
-    yield latest_ref, tail_text
+def find_sutta_refs_batch(texts):
+    """Scans many text nodes in one call. Yields a list of the pairs
+    produced by `find_sutta_refs` for each text, or `None` for texts
+    that are rejected by the prefilter or contain no references.
 
+    """
+    for text in texts:
+        if not could_contain_sutta_refs(text):
+            yield None
+            continue
+        pairs = list(find_sutta_refs(text))
+        yield pairs if len(pairs) > 1 else None
 
-def crossref_text(text, stats, session, fallback_url):
-    preceding_text = text
 
-    ref_finder = find_sutta_refs(text)
+def _link_sutta_refs(ref_pairs, stats, session, fallback_url, link_cache,
+                     matches=None):
+    """Links the references in `ref_pairs`. If `matches` is given, the
+    references are recorded in it, as `TextEdits.record` describes."""
+    ref_pairs = iter(ref_pairs)
 
     # Get sentinel with the text leading up to first crossref
-    _, preceding_text = next(ref_finder)
-    last_element = None
+    _, preceding_text = next(ref_pairs)
+    preceding_parts = [preceding_text]
+    tail_parts = preceding_parts
     ref_elements = []
 
-    for ref, tail_text in ref_finder:
-        url = get_sutta_ref_url(ref, stats, session, fallback_url)
+    for ref, tail_text in ref_pairs:
+        url = get_sutta_ref_url(
+            ref, stats, session, fallback_url, link_cache
+        )
         if url:
             stats.set_changed()
-            last_element = E("a", ref.full_match, {'href': url, 'class': 'sutta-ref'})
-            last_element.tail = ''
-            ref_elements.append(last_element)
+            ref_elements.append((
+                E("a", ref.full_match, {'href': url, 'class': 'sutta-ref'}),
+                [],
+            ))
+            tail_parts = ref_elements[-1][1]
+            if matches is not None:
+                matches.append((ref.full_match, ref_elements[-1][0]))
         else:
-            if last_element is None:
-                # If no url is found for the first found reference, last_element is None.
-                # Therefore, just add it to the preceding text.
-                preceding_text += ref.full_match + tail_text
-                continue
-            last_element.tail += ref.full_match
-        last_element.tail += tail_text
+            if matches is not None:
+                matches.append((ref.full_match, None))
+            # If no url is found, the reference is added to the text
+            # following the last inserted link (or the preceding text,
+            # if there is no link yet).
+            tail_parts.append(ref.full_match)
+        tail_parts.append(tail_text)
+
+    for ref_element, parts in ref_elements:
+        ref_element.tail = ''.join(parts)
+
+    return (''.join(preceding_parts), [el for el, _ in ref_elements])
+
+
+def crossref_text(text, stats, session, fallback_url, link_cache=None):
+    if not could_contain_sutta_refs(text):
+        return (text, [])
+    return _link_sutta_refs(
+        find_sutta_refs(text), stats, session, fallback_url, link_cache
+    )
 
-    return (preceding_text, ref_elements)
 
+def crossref_element(element, stats, session, fallback_url, link_cache=None,
+                     edits=None):
+    text_pairs, tail_pairs = find_sutta_refs_batch(
+        (element.text, element.tail)
+    )
 
-def crossref_element(element, stats, session, fallback_url):
-    if element.text is not None:
-        element.text, new_child_elements = crossref_text(element.text, stats, session, fallback_url)
+    if text_pairs is not None:
+        element.text, new_child_elements = _link_sutta_refs(
+            text_pairs, stats, session, fallback_url, link_cache,
+            edits and edits.record(element, 'text')
+        )
         # Prepend elements to existing children.
         element[:0] = new_child_elements
 
-    if element.tail is not None:
-        new_tail, new_sibling_elements = crossref_text(element.tail, stats, session, fallback_url)
+    if tail_pairs is not None:
+        new_tail, new_sibling_elements = _link_sutta_refs(
+            tail_pairs, stats, session, fallback_url, link_cache,
+            edits and edits.record(element, 'tail')
+        )
         # Temporarily set tail to None before adding siblings.
         element.tail = None
 
@@ -238,29 +328,195 @@ def crossref_element(element, stats, session, fallback_url):
 
         element.tail = new_tail
 
-def crossref_document(routes, filepath, currentpath, stats, fallback_url):
-    with open(currentpath, mode='rb') as doc:
-        doc_tree = html5.parse(doc.read(), fallback_encoding='utf-8')
 
-    with requests.Session() as s:
-        iterator = lxml.etree.iterwalk(doc_tree.find('body'), events=('start',))
-        for (event, element) in iterator:
-            if element.tag in ignored_elements:
-                iterator.skip_subtree()
-                continue
-            crossref_element(element, stats, s, fallback_url)
-        return doc_tree
+def _crossref_elements(doc_tree):
+    """Yields the elements of which the text and tail may contain sutta
+    references, skipping (the subtrees of) ignored elements."""
+    iterator = lxml.etree.iterwalk(doc_tree.find('body'), events=('start',))
+    for (event, element) in iterator:
+        if element.tag in ignored_elements:
+            iterator.skip_subtree()
+            continue
+        yield element
+
+
+def crossref_tree(doc_tree, stats, session, fallback_url, link_cache=None,
+                  edits=None):
+    """Links the sutta references in the parsed document `doc_tree`, in
+    place."""
+    for element in _crossref_elements(doc_tree):
+        crossref_element(
+            element, stats, session, fallback_url, link_cache, edits
+        )
+
+
+def text_edits(input, doc_tree):
+    """The `TextEdits` to record the sutta references that are linked in
+    `doc_tree` with, to splice them into `input`."""
+    return TextEdits(
+        input, doc_tree, sutta_ref_pattern, ignored_tags,
+        sutta_ref_raw_prefilter
+    )
+
+
+def _stream_ref_texts(src, chunk_size=stream_chunk_size):
+    """Reads the document from the binary file `src` a chunk at a time,
+    without parsing it. Yields each piece of it, with the `TextMap` of
+    each text in it that is searched for references, like the text that
+    `crossref_tree` searches."""
+    searched = SearchedText(ignored_tags)
+    for raw, tokens in tokenize_chunks(src, chunk_size,
+                                       sutta_ref_text_boundary):
+        check_encoding(raw)
+        yield raw, [
+            text_map(raw, token) for token in tokens
+            if searched(raw, token)
+            and sutta_ref_raw_prefilter.search(raw, token.start, token.end)
+        ]
+
+
+def _ref_splices(text, stats, session, fallback_url, link_cache=None):
+    """Links the references in `text`, a `TextMap`, by splicing the start
+    and end tag of a link around each of them."""
+    splices = []
+    ref_pairs = find_sutta_refs(text.text)
+    _, preceding_text = next(ref_pairs)
+    pos = len(preceding_text)
+    for ref, tail_text in ref_pairs:
+        start, end = pos, pos + len(ref.full_match)
+        pos = end + len(tail_text)
+        url = get_sutta_ref_url(
+            ref, stats, session, fallback_url, link_cache
+        )
+        if not url:
+            continue
+        stats.set_changed()
+        link = E("a", ref.full_match, {'href': url, 'class': 'sutta-ref'})
+        start, end = text.byte_offset(start), text.byte_offset(end)
+        splices.append((start, start, start_tag(link)))
+        splices.append((end, end, end_tag(link)))
+    return splices
+
+
+def crossref_stream(src, stats, session, fallback_url, link_cache=None,
+                    chunk_size=stream_chunk_size):
+    """Links the sutta references in the document read from the binary
+    file `src`, as it is read. Only a chunk of the document is in memory
+    at a time. Returns the linked document as a (temporary) file.
+
+    The links are spliced into the original bytes, as with ``--output-mode
+    splice``, so the document must be encoded in UTF-8. Raises
+    `SpliceError` otherwise.
+
+    """
+    out = tempfile.SpooledTemporaryFile(max_size=stream_spool_size)
+    try:
+        for raw, texts in _stream_ref_texts(src, chunk_size):
+            splices = []
+            for text in texts:
+                splices.extend(_ref_splices(
+                    text, stats, session, fallback_url, link_cache
+                ))
+            out.write(apply_splices(raw, splices) if splices else raw)
+    except BaseException:
+        out.close()
+        raise
+    out.seek(0)
+    return out
+
+
+def prefilter_crossref(currentpath, stream_above=None):
+    if stream_above is not None \
+            and os.path.getsize(currentpath) >= stream_above:
+        raw = open_if_matches(
+            currentpath, sutta_ref_raw_prefilter, stream_chunk_size
+        )
+    else:
+        raw = read_if_matches(currentpath, sutta_ref_raw_prefilter)
+    if raw is None:
+        raise AbortHandling(
+            "File {} has no sutta references".format(
+                os.path.relpath(currentpath)
+            ), verbosity=1
+        )
+    return raw
+
+
+prefilter_crossref.verbose_name = "Look for sutta references"
+prefilter_crossref.verbosity = 2
+
+
+def crossref_document(input, routes, filepath, currentpath, stats,
+                      fallback_url, session=None, link_cache=None,
+                      output_mode='serialize', parser='auto'):
+    if hasattr(input, 'read'):
+        with input, shared_client(session) as client:
+            try:
+                return crossref_stream(
+                    input, stats, client, fallback_url, link_cache
+                )
+            except SpliceError as e:
+                echo("Can't stream {} ({}), reading the whole document"
+                     " instead".format(os.path.relpath(currentpath), e),
+                     verbosity=1)
+                input.seek(0)
+                input = input.read()
+    doc_tree = parse_document(input, parser)
+    edits = None
+    if output_mode == 'splice':
+        edits = text_edits(input, doc_tree)
+
+    with shared_client(session) as client:
+        crossref_tree(
+            doc_tree, stats, client, fallback_url, link_cache, edits
+        )
+        return edits or doc_tree
+
+
+def collect_sutta_ref_urls(currentpath, parser='auto', stream_above=None):
+    """Yields the URLs of the sutta references that `crossref_document`
+    looks up in the given document."""
+    if stream_above is not None \
+            and os.path.getsize(currentpath) >= stream_above:
+        src = open_if_matches(
+            currentpath, sutta_ref_raw_prefilter, stream_chunk_size
+        )
+        if src is None:
+            return
+        with src:
+            for _raw, texts in _stream_ref_texts(src):
+                for text in texts:
+                    for ref, _tail_text in list(
+                            find_sutta_refs(text.text))[1:]:
+                        url = get_url_format_callable(ref)()
+                        if url is not None:
+                            yield url
+        return
+    raw = read_if_matches(currentpath, sutta_ref_raw_prefilter)
+    if raw is None:
+        return
+    doc_tree = parse_document(raw, parser)
+
+    for element in _crossref_elements(doc_tree):
+        for pairs in find_sutta_refs_batch((element.text, element.tail)):
+            for ref, _tail_text in (pairs or ())[1:]:
+                url = get_url_format_callable(ref)()
+                if url is not None:
+                    yield url
 
 
 crossref_mime_handlers = {
-    'text/html': (crossref_document, guard_unchanged, guard_dry_run,
-                  guard_overwrite, tostring, write_out),
+    'text/html': (prefilter_crossref, crossref_document, guard_unchanged,
+                  guard_dry_run, guard_overwrite, splice_or_tostring,
+                  write_out),
     'application/xhtml+xml': 'text/html',
     '*/*': (),
 }
 
 
 class CrossRefRoute(ConstDestMimetypeRoute):
+    __slots__ = ()
+
     def get_mime_to_handlers(self):
         return crossref_mime_handlers
 
@@ -270,12 +526,57 @@ def cross_ref_routes(filenames):
         yield CrossRefRoute(src, root_dir)
 
 
-def cross_ref(filenames, fallback_url, dry_run, overwrite):
+def cross_ref(filenames, fallback_url, dry_run, overwrite, link_cache=None,
+              check_workers=0, check_per_host=4, jobs=1,
+              manifest_path=None, output_mode='serialize',
+              profile=None, parser='auto', stream_above=None,
+              http_client=None):
     context = {
         'dry_run': dry_run,
         'overwrite': overwrite,
+        'output_mode': output_mode,
         'output_dir': '.',
         'fallback_url': fallback_url,
+        'link_cache': link_cache,
+        'jobs': jobs,
+        'profile': profile,
+        'parser': parser,
+        'stream_above': stream_above,
     }
+    if manifest_path is not None:
+        context['manifest'] = Manifest(manifest_path, {
+            'command': 'suttaref',
+            'fallback_url': fallback_url,
+            'parser': parser,
+            'stream_above': stream_above,
+        })
     routes = cross_ref_routes(filenames)
-    handle_routes(routes, context)
+    with shared_client(http_client) as client:
+        context['session'] = client
+        if check_workers >= 1 and is_cacheable_fallback(fallback_url):
+            # First check all sutta links concurrently, so that only the
+            # broken ones need to be dealt with afterwards.
+            routes = list(routes)
+            if link_cache is None:
+                context['link_cache'] = LinkCheckCache()
+            checks = (
+                (url, fallback_url)
+                for route in routes if crossref_document in route.handlers
+                and not is_up_to_date(route, context)
+                for url in collect_sutta_ref_urls(
+                    route.src, parser, stream_above
+                )
+            )
+            prefetch_link_checks(
+                checks, context['link_cache'], check_workers,
+                check_per_host, client
+            )
+        try:
+            if manifest_path is None:
+                stream_routes(routes, context)
+            else:
+                # The manifest compares the whole route table.
+                handle_routes(routes, context)
+        finally:
+            if manifest_path is not None and not dry_run:
+                context['manifest'].save(context['routes'])
@@ -1,11 +1,35 @@
+import contextlib
+
 import click
 
 
 class UserInterfaceContext(object):
-    def __init__(self, verbosity=0, choice=None, apply_to_all=False):
+    def __init__(self, verbosity=0, choice=None, apply_to_all=False,
+                 defer_prompts=False):
         self.verbosity = verbosity
         self.choice = choice
         self.apply_to_all = apply_to_all
+        self.defer_prompts = defer_prompts
+        # The choices of each pass, while another pass is prompting.
+        self.choices = {}
+
+    @contextlib.contextmanager
+    def choosing(self, name):
+        """Remembers the choice made in prompts, and whether to apply it
+        to all, separately for `name`. Used when several passes with
+        their own prompts are run over the same files."""
+        saved = self.choice, self.apply_to_all
+        self.choice, self.apply_to_all = self.choices.get(name, (None, False))
+        try:
+            yield self
+        finally:
+            self.choices[name] = self.choice, self.apply_to_all
+            self.choice, self.apply_to_all = saved
+
+
+class DeferredPrompt(Exception):
+    """Raised instead of prompting when prompts are deferred, e.g. when
+    running in a worker process."""
 
 
 def get_ui_context():
@@ -48,6 +72,8 @@ def choice_prompt(prompt, apply_all_msg, choices, *args, **kwargs):
 
     default = ui_ctx.choice or choice.choices[0]
     value = default
+    if not ui_ctx.apply_to_all and ui_ctx.defer_prompts:
+        raise DeferredPrompt(prompt)
     if not ui_ctx.apply_to_all:
         value = click.prompt(
             '{}\n{}\nPlease enter (defaults to \'{}\')'.format(
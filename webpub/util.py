@@ -1,15 +1,80 @@
+from collections import namedtuple
+import codecs
 import os
 import shutil
+import threading
 import itertools as it
 import functools as ft
 from urllib.parse import urlparse
 
-from lxml import html
+from lxml import etree, html
 from inxs import Any, MatchesAttributes
 
 import webpub
 
 
+def read_if_matches(currentpath, pattern):
+    """Reads the raw bytes of a document, and returns them if `pattern`
+    matches them. Otherwise, returns `None`. Documents that don't use an
+    ASCII-compatible encoding are always returned."""
+    with open(currentpath, mode='rb') as doc:
+        raw = doc.read()
+    if not raw_matches(raw, pattern):
+        return None
+    return raw
+
+
+# Bytes of the previous chunk that are searched again with the next, so
+# that matches across chunks are found.
+stream_overlap = 64
+
+
+def open_if_matches(currentpath, pattern, chunk_size=1 << 20):
+    """Like `read_if_matches`, but searches the document a chunk at a
+    time, and returns it opened as a binary file instead of its raw
+    bytes."""
+    doc = open(currentpath, mode='rb')
+    try:
+        chunk = doc.read(chunk_size)
+        matches = raw_matches(chunk, pattern)
+        while chunk and not matches:
+            tail = chunk[-stream_overlap:]
+            chunk = doc.read(chunk_size)
+            matches = pattern.search(tail + chunk) is not None
+    except BaseException:
+        doc.close()
+        raise
+    if not matches:
+        doc.close()
+        return None
+    doc.seek(0)
+    return doc
+
+
+def raw_matches(raw, pattern):
+    """Whether `pattern` matches the raw bytes of a document, or might,
+    because the document doesn't use an ASCII-compatible encoding."""
+    if raw.startswith((codecs.BOM_UTF16_LE, codecs.BOM_UTF16_BE)):
+        return True
+    return pattern.search(raw) is not None
+
+
+def per_thread(factory):
+    """Returns a function that returns the object made by `factory` for
+    the calling thread, making it the first time. For objects that are
+    expensive to make, but can't be shared between threads, like inxs
+    Transformations, which keep the state of a call on themselves."""
+    local = threading.local()
+
+    def get():
+        try:
+            return local.value
+        except AttributeError:
+            local.value = factory()
+            return local.value
+    return get
+
+
 def tostring(input):
     return html.tostring(
         input,
@@ -68,9 +133,13 @@ guard_overwrite.verbose_name = "Check if file would be overwritten"
 guard_overwrite.verbosity = 2
 
 
-def copy_out(epub_zip, filepath, root_dir, routes, stats):
+def copy_out(epub_zip, filepath, root_dir, routes, stats, output_sink=None):
     src_zip_path = os.path.join(root_dir, filepath)
     routed_path = routes[filepath]
+    if output_sink is not None:
+        output_sink.copy_member(epub_zip, src_zip_path, routed_path)
+        stats.set('saved')
+        return
     dirname = os.path.dirname(routed_path)
     if dirname == '':
         dirname = './'
@@ -78,7 +147,7 @@ def copy_out(epub_zip, filepath, root_dir, routes, stats):
 
     with epub_zip.open(src_zip_path, 'r') as src:
         with open(routed_path, 'wb') as dst:
-            shutil.copyfileobj(src, dst, 8192)
+            shutil.copyfileobj(src, dst, 1 << 20)
     stats.set('saved')
 
 
@@ -86,8 +155,23 @@ copy_out.verbose_name = "Copy file"
 copy_out.verbosity = 1
 
 
-def write_out(input, filepath, routes, stats):
+def _copy_file_out(input, routed_path, stats):
+    os.makedirs(os.path.dirname(routed_path) or '.', exist_ok=True)
+    with input, open(routed_path, 'wb') as dst:
+        input.seek(0)
+        shutil.copyfileobj(input, dst, 1 << 20)
+    stats.set('saved')
+
+
+def write_out(input, filepath, routes, stats, output_sink=None):
     routed_path = routes[filepath]
+    if hasattr(input, 'read'):
+        # A file, which is copied without reading it into memory.
+        return _copy_file_out(input, routed_path, stats)
+    if output_sink is not None:
+        output_sink.write(routed_path, input)
+        stats.set('saved')
+        return
     dirname = os.path.dirname(routed_path)
     if dirname == '':
         dirname = './'
@@ -124,6 +208,10 @@ def ensure(result, error_message):
 has_link = Any(MatchesAttributes({'href': None}),
                MatchesAttributes({'src': None}),)
 
+# Selects the elements that `has_link` matches, all at once instead of
+# testing each element.
+link_elements = etree.XPath('descendant-or-self::*[@href or @src]')
+
 
 def matched_url(element):
     url = None
@@ -135,11 +223,34 @@ def matched_url(element):
         raise ValueError("No URL attribute found on element")
 
 
+# A parsed url, and whether it's a (relative or absolute) path.
+ClassifiedUrl = namedtuple(
+    'ClassifiedUrl', ['url', 'is_path', 'is_relative', 'is_absolute']
+)
+
+
+@ft.lru_cache(maxsize=4096)
+def classify_url(url_str):
+    """Parses and classifies a url. The result is cached, as the same
+    urls occur on many pages, and are looked at by several rules."""
+    url = urlparse(url_str)
+    path = not url.netloc and not url.scheme and bool(url.path)
+    absolute = path and os.path.isabs(url.path)
+    return ClassifiedUrl(url, path, path and not absolute, absolute)
+
+
+def element_url(element):
+    """Returns the url attribute of the element, and its classified
+    url, or raises `ValueError` if it has none."""
+    attrib, url_str = matched_url(element)
+    return attrib, classify_url(url_str)
+
+
 def _ensure_url(f):
     @ft.wraps(f)
     def wrapped(url_str):
         if isinstance(url_str, str):
-            return f(urlparse(url_str))
+            return getattr(classify_url(url_str), f.__name__)
         return f(url_str)
     return wrapped
 
@@ -161,23 +272,23 @@ def is_absolute(url):
 
 def has_path_url(element, transformation):
     try:
-        attrib, url = matched_url(element)
-        return is_path(url)
+        attrib, url = element_url(element)
+        return url.is_path
     except ValueError:
         return False
 
 
 def has_relative_url(element, transformation):
     try:
-        attrib, url = matched_url(element)
-        return is_relative(url)
+        attrib, url = element_url(element)
+        return url.is_relative
     except ValueError:
         return False
 
 
 def has_absolute_url(element, transformation):
     try:
-        attrib, url = matched_url(element)
-        return is_absolute(url)
+        attrib, url = element_url(element)
+        return url.is_absolute
     except ValueError:
         return False
@@ -0,0 +1,217 @@
+from collections import namedtuple
+import os
+import re
+
+
+Pattern = namedtuple('Pattern', ['regex', 'negated', 'dir_only'])
+
+
+def _translate(glob):
+    """Translates a glob, in which `*` and `?` don't match a `/` but
+    `**` does, into a regular expression."""
+    i, n = 0, len(glob)
+    regex = []
+    while i < n:
+        c = glob[i]
+        if glob.startswith('**/', i):
+            regex.append('(?:.*/)?')
+            i += 3
+            continue
+        if glob.startswith('**', i):
+            regex.append('.*')
+            i += 2
+            continue
+        i += 1
+        if c == '*':
+            regex.append('[^/]*')
+        elif c == '?':
+            regex.append('[^/]')
+        elif c == '\\' and i < n:
+            regex.append(re.escape(glob[i]))
+            i += 1
+        elif c == '[':
+            # A `]` right after the opening `[` or `[!` is a member.
+            start = i + 1 if glob[i:i + 1] == '!' else i
+            if glob[start:start + 1] == ']':
+                start += 1
+            end = glob.find(']', start)
+            if end < 0:
+                regex.append(re.escape(c))
+                continue
+            chars = glob[i:end].replace('\\', '\\\\').replace('[', '\\[')
+            i = end + 1
+            if chars.startswith('!'):
+                chars = '^' + chars[1:]
+            elif chars.startswith('^'):
+                chars = '\\' + chars
+            regex.append('(?!/)[{}]'.format(chars))
+        else:
+            regex.append(re.escape(c))
+    return ''.join(regex)
+
+
+def parse_pattern(line):
+    """Parses a line of an ignore file, like those of git. Returns
+    `None` for blank lines and comments."""
+    line = line.rstrip('\n\r')
+    # Trailing spaces are ignored, unless they're escaped.
+    stripped = line.rstrip(' ')
+    if stripped.endswith('\\') and len(stripped) < len(line):
+        stripped += ' '
+    line = stripped
+    if not line or line.startswith('#'):
+        return None
+    negated = line.startswith('!')
+    if negated:
+        line = line[1:]
+    elif line.startswith(('\\!', '\\#')):
+        line = line[1:]
+    dir_only = line.endswith('/')
+    line = line.rstrip('/')
+    if not line:
+        return None
+    # Patterns with a slash are relative to the directory of the ignore
+    # file, others match a name at any depth below it.
+    if '/' in line:
+        regex = _translate(line.lstrip('/'))
+    else:
+        regex = '(?:.*/)?' + _translate(line)
+    return Pattern(re.compile(regex, re.DOTALL), negated, dir_only)
+
+
+class PathRules(object):
+    """Ignore patterns for the paths below a directory."""
+
+    def __init__(self, base, lines):
+        self.base = base + '/' if base else ''
+        self.patterns = [
+            pattern for pattern in map(parse_pattern, lines)
+            if pattern is not None
+        ]
+
+    @classmethod
+    def from_file(cls, base, filename):
+        try:
+            with open(filename, encoding='utf-8', errors='replace') as f:
+                return cls(base, f)
+        except OSError:
+            return None
+
+    def match(self, path, is_dir):
+        """Whether a pattern excludes `path` (`True`), re-includes it
+        (`False`) or neither (`None`). The last pattern that matches
+        decides."""
+        if not path.startswith(self.base):
+            return None
+        path = path[len(self.base):]
+        for pattern in reversed(self.patterns):
+            if pattern.dir_only and not is_dir:
+                continue
+            if pattern.regex.fullmatch(path):
+                return not pattern.negated
+        return None
+
+
+def _posix(path):
+    return path if os.sep == '/' else path.replace(os.sep, '/')
+
+
+class FileWalker(object):
+    """Finds the files to process below `root`.
+
+    Paths are excluded by the `exclude` patterns and by the patterns in
+    files named one of `ignore_files` in the directories that are
+    walked, which are written like those of `.gitignore` files. If there
+    are `include` patterns, only files that match one of them are
+    included. Files for which `accept` of their name is false are left
+    out too. Excluded directories aren't walked at all.
+
+    """
+
+    def __init__(self, root, include=(), exclude=(), ignore_files=(),
+                 accept=None):
+        self.root = root
+        self.include = PathRules('', include) if include else None
+        self.exclude = PathRules('', exclude)
+        self.ignore_files = tuple(ignore_files)
+        self.accept = accept
+        self._dir_rules = {}
+
+    def _rules(self, parent_rules, dirpath):
+        """The rules of a directory: those of its parent directory, then
+        those of its own ignore files."""
+        rules = list(parent_rules)
+        for name in self.ignore_files:
+            dir_rules = PathRules.from_file(
+                dirpath, os.path.join(self.root, dirpath, name)
+            )
+            if dir_rules is not None:
+                rules.append(dir_rules)
+        return rules
+
+    def _is_excluded(self, rules, path, is_dir):
+        for path_rules in reversed(rules + [self.exclude]):
+            excluded = path_rules.match(path, is_dir)
+            if excluded is not None:
+                return excluded
+        return False
+
+    def _is_included(self, rules, path):
+        if self.accept is not None and not self.accept(path):
+            return False
+        if self.include is not None and not self.include.match(path, False):
+            return False
+        return not self._is_excluded(rules, path, False)
+
+    def __iter__(self):
+        if os.path.isfile(self.root):
+            yield os.path.dirname(self.root), os.path.basename(self.root)
+            return
+        stack = [('', self._rules((), ''))]
+        while stack:
+            dirpath, rules = stack.pop()
+            try:
+                with os.scandir(os.path.join(self.root, dirpath)) as entries:
+                    entries = list(entries)
+            except OSError:
+                continue
+            subdirs = []
+            for entry in entries:
+                path = dirpath + '/' + entry.name if dirpath else entry.name
+                try:
+                    is_dir = entry.is_dir()
+                except OSError:
+                    is_dir = False
+                if is_dir:
+                    # Like os.walk, symbolic links to directories aren't
+                    # followed.
+                    if not entry.is_symlink() \
+                            and not self._is_excluded(rules, path, True):
+                        subdirs.append(path)
+                elif self._is_included(rules, path):
+                    yield self.root, os.path.normpath(path)
+            # Walk the subdirectories in order, depth first.
+            for path in reversed(subdirs):
+                stack.append((path, self._rules(rules, path)))
+
+    def _rules_of(self, dirpath):
+        """The rules of a directory, or `None` if it's excluded."""
+        if dirpath in self._dir_rules:
+            return self._dir_rules[dirpath]
+        rules = None
+        if dirpath:
+            parent_rules = self._rules_of(dirpath.rpartition('/')[0])
+            if parent_rules is not None \
+                    and not self._is_excluded(parent_rules, dirpath, True):
+                rules = self._rules(parent_rules, dirpath)
+        else:
+            rules = self._rules((), '')
+        self._dir_rules[dirpath] = rules
+        return rules
+
+    def includes(self, relpath):
+        """Whether the file at `relpath`, relative to `root`, would be
+        found by walking the tree."""
+        path = _posix(relpath)
+        rules = self._rules_of(path.rpartition('/')[0])
+        return rules is not None and self._is_included(rules, path)